@@ -0,0 +1,168 @@
+"""
+Local stand-ins for the google sheet and the discord guild, so the scan and member update paths can run without
+network access or credentials.
+"""
+import asyncio
+import random
+from datetime import datetime, timedelta
+
+from discord.utils import SnowflakeList
+from gspread.utils import a1_to_rowcol
+
+FORM_HEADERS = [
+    'Timestamp', 'Member', 'Discord Username', 'P.T.N. Discord Nickname', 'CMDR Name', 'Carrier Name', 'Carrier ID',
+    'Good Conduct'
+]
+
+# Google forms write timestamps like this into the sheet
+FORM_TIMESTAMP_FORMAT = '%m/%d/%Y %H:%M:%S'
+
+
+def _carrier_id(rng):
+    alphabet = 'ABCDEFGHJKLMNPQRSTUVWXYZ0123456789'
+    return ''.join(rng.choices(alphabet, k=3)) + '-' + ''.join(rng.choices(alphabet, k=3))
+
+
+def make_form_rows(count, members, start=0, seed=1):
+    """
+    Generates synthetic form responses. Applicants are drawn from the members, with a few names that match nobody so
+    the lookup misses are exercised too.
+
+    :param int count: How many rows
+    :param list[FakeMember] members: The guild members applying
+    :param int start: The index of the first row, so appended rows get fresh timestamps
+    :param int seed: Random seed, the same seed gives the same rows
+    :returns: The rows as the sheet returns them, lists of strings
+    :rtype: list[list[str]]
+    """
+    rng = random.Random(seed + start)
+    first = datetime(2021, 1, 1)
+    rows = []
+    for index in range(start, start + count):
+        member = members[index % len(members)] if rng.random() > 0.02 else None
+        username = str(member) if member else f'Nobody#{index % 10000:04d}'
+        rows.append([
+            (first + timedelta(minutes=index)).strftime(FORM_TIMESTAMP_FORMAT),
+            rng.choice(['Yes', 'No']),
+            username,
+            member.display_name if member else f'Nobody {index}',
+            f'Cmdr {index}',
+            f'Carrier {index}',
+            _carrier_id(rng),
+            'Yes',
+        ])
+    return rows
+
+
+class FakeWorksheet:
+
+    def __init__(self, rows, latency=0.0):
+        """
+        Mimics the SheetsClient the scan reads the form through.
+
+        :param list[list[str]] rows: The form responses, without the header row
+        :param float latency: Seconds each call waits, to stand in for the google round trip
+        """
+        self.rows = [list(FORM_HEADERS)] + rows
+        self.latency = latency
+        self.calls = 0
+
+    async def _round_trip(self):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        else:
+            await asyncio.sleep(0)
+
+    async def open(self):
+        await self._round_trip()
+        return self
+
+    async def row_values(self, row):
+        await self._round_trip()
+        return list(self.rows[row - 1]) if row <= len(self.rows) else []
+
+    async def get_values(self, range_name):
+        await self._round_trip()
+        start, _, end = range_name.partition(':')
+        first_row, first_col = a1_to_rowcol(start)
+        last_row, last_col = a1_to_rowcol(end or start)
+        return [row[first_col - 1:last_col] for row in self.rows[first_row - 1:last_row]]
+
+    def close(self):
+        pass
+
+
+class FakeRole:
+
+    def __init__(self, role_id, name):
+        self.id = role_id
+        self.name = name
+        self.members = []
+
+    def __repr__(self):
+        return f'<FakeRole id={self.id} name={self.name}>'
+
+
+class FakeMember:
+
+    def __init__(self, member_id, name, discriminator, guild, roles, nick=None):
+        """
+        Carries the member attributes the bot reads, including the raw role ID array discord.py keeps.
+        """
+        self.id = member_id
+        self.name = name
+        self.discriminator = discriminator
+        self.nick = nick
+        self.guild = guild
+        self.roles = list(roles)
+        self._roles = SnowflakeList(role.id for role in self.roles)
+
+    @property
+    def display_name(self):
+        return self.nick or self.name
+
+    def __str__(self):
+        return f'{self.name}#{self.discriminator}'
+
+    def copy(self, roles=None, nick=None):
+        return FakeMember(self.id, self.name, self.discriminator, self.guild,
+                          self.roles if roles is None else roles, self.nick if nick is None else nick)
+
+
+class FakeGuild:
+
+    def __init__(self, guild_id, member_count, member_role_id, member_fraction=0.6, seed=1):
+        """
+        A guild with synthetic members, some of them holding the member role.
+
+        :param int guild_id: The guild ID, the bot guild ID so the listeners do not drop the events
+        :param int member_count: How many members
+        :param int member_role_id: The member role ID
+        :param float member_fraction: The share of members holding the member role
+        :param int seed: Random seed
+        """
+        rng = random.Random(seed)
+        self.id = guild_id
+        self.everyone = FakeRole(guild_id, '@everyone')
+        self.member_role = FakeRole(member_role_id, 'Member')
+        self.other_roles = [FakeRole(member_role_id + offset, f'Role {offset}') for offset in range(1, 6)]
+        self._roles = {role.id: role for role in [self.everyone, self.member_role] + self.other_roles}
+        self.members = []
+        for index in range(member_count):
+            roles = [self.everyone] + rng.sample(self.other_roles, rng.randint(0, 2))
+            if rng.random() < member_fraction:
+                roles.append(self.member_role)
+            member = FakeMember(10 ** 17 + index, f'pilot{index}', f'{index % 10000:04d}', self, roles)
+            self.members.append(member)
+            if self.member_role in roles:
+                self.member_role.members.append(member)
+
+    def get_role(self, role_id):
+        return self._roles.get(role_id)
+
+    def get_member_named(self, name):
+        for member in self.members:
+            if str(member) == name or member.name == name or member.display_name == name:
+                return member
+        return None
@@ -0,0 +1,272 @@
+"""
+Benchmarks the form scan, member update and snapshot paths against local stand-ins for the google sheet and the
+discord guild.
+
+    python -m benchmarks.run_benchmarks --sizes 1000 10000 100000
+
+Each size runs in its own process with its own throwaway home folder, so the bot's database, snapshots and the peak
+memory of one size do not leak into the next. The results are written as JSON so runs can be compared.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+DEFAULT_SIZES = (1000, 10000, 100000)
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+
+def _summary(samples):
+    """
+    :param list[float] samples: Latencies in seconds
+    :returns: Count, mean and percentiles in milliseconds
+    :rtype: dict
+    """
+    ordered = sorted(samples)
+
+    def _percentile(fraction):
+        return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))] * 1000
+
+    return {
+        'count': len(ordered),
+        'mean_ms': statistics.fmean(ordered) * 1000,
+        'min_ms': ordered[0] * 1000,
+        'p50_ms': _percentile(0.5),
+        'p90_ms': _percentile(0.9),
+        'p99_ms': _percentile(0.99),
+        'max_ms': ordered[-1] * 1000,
+    }
+
+
+def _stage_seconds(scan):
+    """
+    :param dict scan: What the scan returned
+    :returns: The seconds spent in each scan stage. The stages overlap, so they add up to more than the scan took.
+    :rtype: dict[str, float]
+    """
+    return {name: timing['seconds'] for name, timing in scan['stages'].items()}
+
+
+def _mean_stage_seconds(runs):
+    return {name: statistics.fmean(run[name] for run in runs) for name in runs[0]} if runs else {}
+
+
+class _Scenario:
+
+    def __init__(self, trace_memory):
+        self.trace_memory = trace_memory
+
+    def __enter__(self):
+        if self.trace_memory:
+            tracemalloc.start()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.started
+        self.peak_mb = None
+        if self.trace_memory:
+            self.peak_mb = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+            tracemalloc.stop()
+
+
+async def _run_size(rows, members, repeat, sheet_latency, trace_memory):
+    """
+    Runs every scenario for one data size. Imports the bot here, once the environment points it at a throwaway home.
+
+    :returns: The scenario results
+    :rtype: dict
+    """
+    from benchmarks.fakes import FakeGuild, FakeWorksheet, make_form_rows
+    from ptn.aco.commands import DatabaseInteraction as database_interaction
+    from ptn.aco.commands.DiscordBotCommands import DiscordBotCommands
+    from ptn.aco.constants import bot, bot_guild_id, get_member_role_id
+    from ptn.aco.database.database import affiliator_service, affiliator_snapshots, build_database_on_startup
+    from ptn.aco.database.normalise import username_key, timestamp_epoch
+    from ptn.aco.database.writebehind import membertracking_writes
+    from ptn.aco.members import member_directory
+
+    build_database_on_startup()
+    guild = FakeGuild(bot_guild_id(), members, get_member_role_id())
+    bot.get_guild = lambda guild_id: guild if guild_id == guild.id else None
+    member_directory.build(guild)
+
+    # Track most role holders long enough to be eligible, and a few only recently
+    now = datetime.now()
+    await affiliator_service.executemany(
+        "INSERT INTO membertracking(member_id, discord_username, date, date_epoch, username_key) VALUES(?, ?, ?, ?, ?)",
+        [
+            (member.id, str(member), since, timestamp_epoch(since), username_key(member))
+            for since, member in (
+                (now - timedelta(days=30 if index % 5 else 3), member)
+                for index, member in enumerate(guild.member_role.members)
+            )
+        ]
+    )
+
+    cog = database_interaction.DatabaseInteraction()
+    sheet = FakeWorksheet(make_form_rows(rows, guild.members), latency=sheet_latency)
+    cog.tracking_sheet = sheet
+    results = {'rows': rows, 'members': members}
+
+    # Every row is new
+    with _Scenario(trace_memory) as scenario:
+        scan = await cog._update_db()
+    await affiliator_snapshots.wait()
+    results['scan_cold'] = {
+        'seconds': scenario.elapsed, 'rows_per_second': rows / scenario.elapsed, 'added': scan['added_count'],
+        'sheet_calls': sheet.calls, 'peak_traced_mb': scenario.peak_mb, 'stages': _stage_seconds(scan),
+    }
+
+    # A handful of new rows on top of the existing ones, the common case
+    batch = max(1, rows // 100)
+    samples = []
+    stages = []
+    peak = 0
+    for attempt in range(repeat):
+        sheet.rows.extend(make_form_rows(batch, guild.members, start=rows + attempt * batch))
+        with _Scenario(trace_memory) as scenario:
+            scan = await cog._update_db()
+        await affiliator_snapshots.wait()
+        samples.append(scenario.elapsed)
+        stages.append(_stage_seconds(scan))
+        peak = max(peak, scenario.peak_mb or 0)
+    results['scan_incremental'] = {
+        'new_rows_per_scan': batch, **_summary(samples), 'peak_traced_mb': peak if trace_memory else None,
+        'stages': _mean_stage_seconds(stages),
+    }
+
+    # Re-checking every row when nothing is new, which is all diff
+    samples = []
+    stages = []
+    peak = 0
+    for _ in range(repeat):
+        with _Scenario(trace_memory) as scenario:
+            scan = await cog._update_db(full_rescan=True)
+        samples.append(scenario.elapsed)
+        stages.append(_stage_seconds(scan))
+        peak = max(peak, scenario.peak_mb or 0)
+    results['scan_full_rescan'] = {
+        'rows_checked': len(sheet.rows) - 1, **_summary(samples), 'peak_traced_mb': peak if trace_memory else None,
+        'stages': _mean_stage_seconds(stages),
+    }
+
+    # Role, nickname and unrelated updates in the proportions a busy guild sees them
+    listener = DiscordBotCommands(bot)
+    other_role = guild.other_roles[0]
+    events = []
+    for index, member in enumerate(guild.members[:rows]):
+        kind = index % 10
+        if kind < 2:
+            roles = [role for role in member.roles if role is not guild.member_role] \
+                if guild.member_role in member.roles else member.roles + [guild.member_role]
+            events.append((member, member.copy(roles=roles)))
+        elif kind < 4:
+            events.append((member, member.copy(nick=f'Nick {index}')))
+        elif kind < 6:
+            roles = [role for role in member.roles if role is not other_role] \
+                if other_role in member.roles else member.roles + [other_role]
+            events.append((member, member.copy(roles=roles)))
+        else:
+            events.append((member, member.copy()))
+
+    samples = []
+    with _Scenario(trace_memory) as scenario:
+        for before, after in events:
+            started = time.perf_counter()
+            await listener.on_member_update(before, after)
+            samples.append(time.perf_counter() - started)
+        flush_started = time.perf_counter()
+        written = await membertracking_writes.flush()
+        flush_seconds = time.perf_counter() - flush_started
+    results['member_updates'] = {
+        'events': len(events), 'events_per_second': len(events) / scenario.elapsed, 'written': written,
+        'flush_ms': flush_seconds * 1000, **_summary(samples), 'peak_traced_mb': scenario.peak_mb,
+    }
+
+    # The background database snapshot
+    samples = []
+    path = None
+    for _ in range(repeat):
+        with _Scenario(False) as scenario:
+            path = await affiliator_snapshots.snapshot()
+        samples.append(scenario.elapsed)
+    results['snapshot'] = {'bytes': os.path.getsize(path), **_summary(samples)}
+
+    results['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return results
+
+
+def _run_child(args):
+    home = tempfile.mkdtemp(prefix='aco-bench-')
+    os.environ['HOME'] = home
+    os.environ['ACO_METRICS_PORT'] = '0'
+    os.environ.setdefault('ACO_LOG_LEVEL', 'ERROR')
+    results = asyncio.run(_run_size(
+        args.child, args.members or max(100, args.child // 2), args.repeat, args.sheet_latency, args.tracemalloc
+    ))
+    json.dump(results, sys.stdout)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='Form rows per run')
+    parser.add_argument('--members', type=int, default=None, help='Guild members, defaults to half the rows')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs of each repeated scenario')
+    parser.add_argument('--sheet-latency', type=float, default=0.0, help='Seconds added to every sheet call')
+    parser.add_argument('--no-tracemalloc', dest='tracemalloc', action='store_false',
+                        help='Skip the traced memory peaks, which slow the timed scenarios down')
+    parser.add_argument('--output', default=None, help='Where to write the JSON results')
+    parser.add_argument('--child', type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        return _run_child(args)
+
+    runs = []
+    for size in args.sizes:
+        print(f'Benchmarking {size} rows ...', file=sys.stderr)
+        command = [sys.executable, '-m', 'benchmarks.run_benchmarks', '--child', str(size), '--repeat',
+                   str(args.repeat), '--sheet-latency', str(args.sheet_latency)]
+        if args.members:
+            command += ['--members', str(args.members)]
+        if not args.tracemalloc:
+            command.append('--no-tracemalloc')
+        completed = subprocess.run(command, check=True, stdout=subprocess.PIPE, text=True)
+        result = json.loads(completed.stdout)
+        runs.append(result)
+        print(f'  cold scan {result["scan_cold"]["seconds"]:.2f}s, '
+              f'incremental p50 {result["scan_incremental"]["p50_ms"]:.1f}ms, '
+              f'full rescan p50 {result["scan_full_rescan"]["p50_ms"]:.1f}ms, '
+              f'member updates {result["member_updates"]["events_per_second"]:.0f}/s, '
+              f'snapshot p50 {result["snapshot"]["p50_ms"]:.1f}ms, peak RSS {result["peak_rss_mb"]:.0f} MiB',
+              file=sys.stderr)
+        print('  cold scan stages ' + ', '.join(
+            f'{name} {seconds:.2f}s' for name, seconds in result['scan_cold']['stages'].items()
+        ), file=sys.stderr)
+
+    report = {
+        'created': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'options': {key: value for key, value in vars(args).items() if key != 'child'},
+        'runs': runs,
+    }
+    output = args.output or os.path.join(RESULTS_DIR, f'bench-{datetime.now().strftime("%Y%m%dT%H%M%S")}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Results written to {output}', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
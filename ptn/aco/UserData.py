@@ -1,7 +1,61 @@
 import re
 
+# Carrier IDs look like XXX-XXX, compiled once rather than per application
+CARRIER_ID_PATTERN = re.compile(r'\w{3}-\w{3}')
+
+# The attributes, in the order of the matching acoapplications columns
+FIELDS = (
+    'timestamp', 'user_claims_member', 'discord_username', 'ptn_nickname', 'cmdr_name', 'fleet_carrier_name',
+    'fleet_carrier_id', 'ack'
+)
+
+# The form question behind each attribute
+SHEET_HEADERS = {
+    'timestamp': 'Timestamp',
+    'user_claims_member': 'Member',
+    'discord_username': 'Discord Username',
+    'ptn_nickname': 'P.T.N. Discord Nickname',
+    'cmdr_name': 'CMDR Name',
+    'fleet_carrier_name': 'Carrier Name',
+    'fleet_carrier_id': 'Carrier ID',
+    'ack': 'Good Conduct',
+}
+
+# The attributes an application cannot be recorded without
+REQUIRED_FIELDS = ('discord_username', 'ptn_nickname', 'cmdr_name', 'fleet_carrier_name', 'fleet_carrier_id')
+
+
+def validate_carrier_id(fleet_carrier_id, fleet_carrier_name=None):
+    """
+    Upper cases a carrier ID and checks it has the XXX-XXX shape.
+
+    :param str fleet_carrier_id: The carrier ID as entered on the form
+    :param str fleet_carrier_name: The carrier name, for the error message
+    :returns: The carrier ID in upper case
+    :rtype: str
+    :raises ValueError: If the carrier ID does not match
+    """
+    # Cast the carrier ID to upper case for consistency
+    fleet_carrier_id = str(fleet_carrier_id).upper()
+    if not CARRIER_ID_PATTERN.match(fleet_carrier_id):
+        raise ValueError(f'Incompatible carrier ID found: {fleet_carrier_id} - {fleet_carrier_name}')
+    return fleet_carrier_id
+
+
+def sheet_columns(headers):
+    """
+    Works out where each attribute sits in the form's rows, once per scan rather than once per row.
+
+    :param list[str] headers: The form's header row
+    :returns: The column index of each attribute in FIELDS order, None where the form lacks the question
+    :rtype: tuple[int]
+    """
+    positions = {header: index for index, header in enumerate(headers)}
+    return tuple(positions.get(SHEET_HEADERS[field]) for field in FIELDS)
+
 
 class UserData:
+    __slots__ = FIELDS
 
     def __init__(self, info_dict=None):
         """
@@ -18,28 +72,42 @@ class UserData:
 
         # Because we also pass a DB object, we should also covert those to the same fields. Check for form first,
         # DB second
-        self.timestamp = info_dict.get('Timestamp', None) or info_dict.get('timestamp', None)
+        self._assign(*(info_dict.get(SHEET_HEADERS[field]) or info_dict.get(field) for field in FIELDS))
+
+    def _assign(self, timestamp, user_claims_member, discord_username, ptn_nickname, cmdr_name, fleet_carrier_name,
+                fleet_carrier_id, ack):
+        self.timestamp = timestamp or None
 
         # Users claim to have the member role, they might not actually have it. Track their response here
-        self.user_claims_member = info_dict.get('Member', None) or info_dict.get('user_claims_member', None)
+        self.user_claims_member = user_claims_member or None
 
-        self.discord_username = info_dict.get('Discord Username', None) or info_dict.get('discord_username', None)
-        if self.discord_username:
-            self.discord_username = self.discord_username.strip()
+        self.discord_username = str(discord_username).strip() if discord_username else None
+        self.ptn_nickname = ptn_nickname or None
+        self.cmdr_name = cmdr_name or None
+        self.fleet_carrier_name = fleet_carrier_name or None
+        self.fleet_carrier_id = validate_carrier_id(fleet_carrier_id, fleet_carrier_name) if fleet_carrier_id else None
+        self.ack = ack or None
 
-        self.ptn_nickname = info_dict.get('P.T.N. Discord Nickname', None) or info_dict.get('ptn_nickname', None)
-        self.cmdr_name = info_dict.get('CMDR Name', None) or info_dict.get('cmdr_name', None)
-        self.fleet_carrier_name = info_dict.get('Carrier Name', None) or info_dict.get('fleet_carrier_name', None)
-        self.fleet_carrier_id = info_dict.get('Carrier ID', None) or info_dict.get('fleet_carrier_id', None)
-        if self.fleet_carrier_id:
-            # Cast the carrier ID to upper case for consistency
-            self.fleet_carrier_id = self.fleet_carrier_id.upper()
+    @classmethod
+    def from_sheet_row(cls, row, columns):
+        """
+        Builds the application straight from a form row, without going through a dict.
 
-            # make sure it matches the regex
-            if not re.match(r"\w{3}-\w{3}", self.fleet_carrier_id):
-                raise ValueError(f'Incompatible carrier ID found: {self.fleet_carrier_id} - {self.fleet_carrier_name}')
+        :param list[str] row: The row as the sheet returns it
+        :param tuple[int] columns: Where each attribute is in the row, see sheet_columns
+        :rtype: UserData
+        """
+        user = cls.__new__(cls)
+        width = len(row)
+        user._assign(*(row[index] if index is not None and index < width else None for index in columns))
+        return user
 
-        self.ack = info_dict.get('Good Conduct', None) or info_dict.get('ack', None)
+    def missing_fields(self):
+        """
+        :returns: The form questions for the required attributes left blank
+        :rtype: list[str]
+        """
+        return [SHEET_HEADERS[field] for field in REQUIRED_FIELDS if getattr(self, field) is None]
 
     def to_dictionary(self):
         """
@@ -49,7 +117,8 @@ class UserData:
         :rtype: dict
         """
         response = {}
-        for key, value in vars(self).items():
+        for key in FIELDS:
+            value = getattr(self, key)
             if value is not None:
                 response[key] = value
         return response
@@ -71,7 +140,7 @@ class UserData:
 
         :rtype: bool
         """
-        return any([value for key, value in vars(self).items() if value])
+        return any(getattr(self, key) for key in FIELDS)
 
     def __eq__(self, other):
         """
@@ -81,5 +150,5 @@ class UserData:
         :rtype: bool
         """
         if isinstance(other, UserData):
-            return self.__dict__ == other.__dict__
+            return all(getattr(self, key) == getattr(other, key) for key in FIELDS)
         return False
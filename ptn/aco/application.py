@@ -1,11 +1,68 @@
+# Imported first, so the startup report includes the time spent importing everything else
+from ptn.aco.startup import startup_timer
+
+import asyncio
+import functools
+import logging
+import sys
+
+from discord_slash import SlashCommand
+
 from ptn.aco.commands.DatabaseInteraction import DatabaseInteraction
-from ptn.aco.commands.DiscordBotCommands import DiscordBotCommands
+from ptn.aco.commands.DiscordBotCommands import DiscordBotCommands, save_for_restart
 from ptn.aco.commands.Helper import Helper
 from ptn.aco.constants import bot, TOKEN, _production
-from ptn.aco.database.database import build_database_on_startup
+from ptn.aco.database.database import start_database_build
+from ptn.aco.metrics import instrument_discord
+
+log = logging.getLogger(__name__)
+
+
+log.info(f'The affiliator bot is connecting against production: {_production}.')
 
 
-print(f'The affiliator bot is connecting against production: {_production}.')
+def _build_failed(build):
+    """
+    :param asyncio.Future build: The database build task
+    :returns: Whether the build finished with an error
+    :rtype: bool
+    """
+    return build.done() and not build.cancelled() and build.exception() is not None
+
+
+def _stop_on_build_failure(build):
+    """
+    Stops the bot when the database cannot be restored or migrated, rather than staying online with every database
+    call failing. The process then exits non-zero, so the service manager can restart it or flag it.
+
+    :param asyncio.Future build: The finished database build task
+    :returns: None
+    """
+    if not _build_failed(build):
+        return
+    log.critical('Failed building the database, stopping the bot', exc_info=build.exception())
+    asyncio.ensure_future(bot.close())
+
+
+def _save_on_close(client, build):
+    """
+    Writes out the pending member tracking changes and the warm restart state before the bot closes. discord.py
+    closes the bot on SIGINT and SIGTERM too, so a service restart neither drops the changes still held by the
+    write-behind buffer nor starts cold. Nothing is written when the database could not be built.
+
+    :param discord.Client client: The bot
+    :param asyncio.Future build: The database build task
+    :returns: None
+    """
+    close = client.close
+
+    @functools.wraps(close)
+    async def _close():
+        if not client.is_closed() and not _build_failed(build):
+            await save_for_restart('close')
+        await close()
+
+    client.close = _close
 
 
 def run():
@@ -14,11 +71,25 @@ def run():
 
     :returns: None
     """
-    build_database_on_startup()
-    bot.add_cog(DiscordBotCommands(bot))
-    bot.add_cog(DatabaseInteraction())
-    bot.add_cog(Helper())
-    bot.run(TOKEN)
+    startup_timer.mark('imports')
+    with startup_timer.phase('cogs'):
+        SlashCommand(bot, sync_commands=True)
+        instrument_discord(bot)
+        bot.add_cog(DiscordBotCommands(bot))
+        bot.add_cog(DatabaseInteraction())
+        bot.add_cog(Helper())
+
+    # The database is restored and migrated on its worker thread while the bot logs in and connects, the ready
+    # handlers wait for it before touching the database
+    build = start_database_build(bot.loop)
+    build.add_done_callback(_stop_on_build_failure)
+    _save_on_close(bot, build)
+    startup_timer.begin('discord_connect')
+    try:
+        bot.run(TOKEN)
+    finally:
+        if _build_failed(build):
+            sys.exit('The database could not be built, see the log.')
 
 
 if __name__ == '__main__':
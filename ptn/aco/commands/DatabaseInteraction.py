@@ -1,98 +1,160 @@
-import traceback
+import asyncio
+import logging
+import sqlite3
+import time
 from datetime import datetime, timedelta
-import os.path
 
 import discord
-from dateutil import parser
 from discord import NotFound, HTTPException
-from discord.ext import tasks, commands
+from discord.ext import commands
 from discord_slash import cog_ext, SlashContext
 from discord_slash.model import SlashCommandPermissionType
 from discord_slash.utils.manage_commands import create_permission, create_option
-from oauth2client.service_account import ServiceAccountCredentials
-import gspread
 from discord.ext.commands import Cog
 
-from ptn.aco.UserData import UserData
 from ptn.aco.constants import bot_guild_id, server_admin_role_id, server_mod_role_id, bot, get_bot_notification_channel, \
-    get_server_aco_role_id, get_member_role_id
-from ptn.aco.database.database import affiliator_db, affiliator_conn, dump_database, affiliator_lock
+    get_server_aco_role_id, get_scan_interval, get_scan_jitter, get_scan_max_backoff
+from ptn.aco.database.database import affiliator_service, affiliator_snapshots, database_ready
+from ptn.aco.database.normalise import username_key
+from ptn.aco.database.writebehind import membertracking_writes
+from ptn.aco.events import summarise_event_counts
+from ptn.aco.members import member_directory, find_member, member_role_holders
+from ptn.aco.metrics import scan_duration, scan_stage_duration, scan_rows_fetched, scan_rows_new, db_latency, \
+    discord_latency, discord_rate_limits, snapshot_duration
+from ptn.aco.notifications import NotificationDispatcher
+from ptn.aco.outbox import NotificationOutbox
+from ptn.aco.quarantine import list_quarantined
+from ptn.aco.reconcile import reconcile_members
+from ptn.aco.scan import FormScan, fetch_watermark
+from ptn.aco.scheduler import ChangeProbeScheduler
+from ptn.aco.sheets import SheetsClient, SheetUnavailable, rowcol_to_a1
+from ptn.aco.startup import startup_timer
+from ptn.aco.warmrestart import warm_restart
+
+log = logging.getLogger(__name__)
+
+# How long the form can go without new applications before we ping the channel to show we are still running
+HEARTBEAT_INTERVAL = timedelta(hours=24)
+
+# How many quarantined rows fit in the listing embed
+QUARANTINE_LIST_LIMIT = 25
+
+# How long the member role has to be held before applying for ACO
+SECONDS_PER_DAY = 24 * 60 * 60
+ACO_ELIGIBLE_AFTER_SECONDS = 14 * SECONDS_PER_DAY
 
 
 class InvalidUser(Exception):
     pass
 
 
+def _fetch_tracking_form(affiliator_db):
+    return dict(affiliator_db.execute(
+        "SELECT * FROM trackingforms"
+    ).fetchone())
+
+
 class DatabaseInteraction(Cog):
 
     @commands.Cog.listener()
     async def on_ready(self):
-        print('Starting the polling task')
-        await self.timed_scan.start()
-
-    @tasks.loop(hours=24)
-    async def timed_scan(self):
-        print(f'Automatic database polling started at {datetime.now()}')
-        self.running_scan = True
-        result = await self._update_db()
-        self.running_scan = False
-        print('Automatic database scan completed, next scan in 24 hours')
-
-        if result['added_count'] == 0:
-            # Nothing happened, lets ping the channel just to show we are still running.
-            notification_channel = bot.get_channel(get_bot_notification_channel())
-
-            # Ok no updates were requested, just drop a message saying it was triggered.
-            message = await notification_channel.send(
-                "No new ACO applications were detected today. Next scan in 24 hours."
-            )
-            await message.add_reaction('👁️')
-
-    @timed_scan.after_loop
-    async def timed_scan_after_loop(self):
-        self.running_scan = False
-        if self.timed_scan.failed():
-            print("timed_scan after_loop().Task has failed.")
-
-    @timed_scan.error
-    async def timed_scan_error(self, error):
-        self.running_scan = False
-        if not self.timed_scan.is_running() or self.timed_scan.failed():
-            print("timed_scan error(). task has failed.")
-        print(error)
-        traceback.print_exc()
+        await startup_timer.run('tracking_form', self._load_tracking_form())
+
+        # Deliver anything left in the outbox from before a restart
+        self.outbox.start()
+        self.outbox.kick()
+
+        if not self.scan_scheduler.is_running():
+            log.info('Starting the polling task')
+            self.last_heartbeat = datetime.now()
+            warm = warm_restart.take('scan')
+            if warm is not None and warm['form_entry'] == self.form_entry:
+                # Carry on from before the restart rather than probing straight away and resetting the heartbeat
+                self.last_heartbeat = datetime.fromtimestamp(warm['last_heartbeat'])
+                self.scan_scheduler.restore_state(warm['scheduler'])
+            self.scan_scheduler.start()
+
+    async def _probe_for_new_rows(self):
+        """
+        Cheap check for new applications: reads the single cell just after the watermark rather than the whole form.
 
-    def __init__(self):
-        scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+        :returns: True if a scan should run
+        :rtype: bool
+        """
+        await self._check_heartbeat()
+        if self.scan_lock.locked():
+            return False
+
+        watermark = await affiliator_service.read(fetch_watermark, self.form_entry)
+        return any(any(row) for row in await self.tracking_sheet.get_values(rowcol_to_a1(watermark + 1, 1)))
 
-        if not os.path.join(os.path.expanduser('~'), '.ptnuserdata.json'):
-            raise EnvironmentError('Cannot find the user data json file.')
+    async def _scheduled_scan(self):
+        log.info(f'Automatic database scan started at {datetime.now()}')
+        async with self.scan_lock:
+            result = await self._update_db()
+        log.info(f'Automatic database scan completed, {result["added_count"]} applications added')
 
-        credentials = ServiceAccountCredentials.from_json_keyfile_name(
-            os.path.join(os.path.expanduser('~'), '.ptnuserdata.json'), scope)
+        if result['added_count']:
+            self.last_heartbeat = datetime.now()
 
-        # authorize the client sheet
-        self.client = gspread.authorize(credentials)
+    async def _check_heartbeat(self):
+        """
+        Pings the channel when nothing has been posted for a day, just to show we are still running.
 
-        affiliator_db.execute(
-            "SELECT * FROM trackingforms"
+        :returns: None
+        """
+        if datetime.now() - self.last_heartbeat < HEARTBEAT_INTERVAL:
+            return
+
+        self.last_heartbeat = datetime.now()
+        notification_channel = bot.get_channel(get_bot_notification_channel())
+
+        # Ok no updates were found, just drop a message saying we are still checking.
+        await self.dispatcher.send(
+            notification_channel,
+            "No new ACO applications were detected today. Still watching the form.",
+            reactions=('👁️',)
         )
-        forms = dict(affiliator_db.fetchone())
 
-        self.worksheet_key = forms['worksheet_key']
+    def __init__(self):
+        # The form details are read from the database once it is built, see _load_tracking_form, so loading the cog
+        # touches neither the database nor google
+        self.form_entry = None
+        self.worksheet_key = None
+        self.worksheet_with_data_id = None
+        self.tracking_sheet = None
+        self.dispatcher = NotificationDispatcher()
+        self.outbox = NotificationOutbox(
+            affiliator_service, lambda: bot.get_channel(get_bot_notification_channel()), self.dispatcher
+        )
+        # Held by whichever scan is running, scheduled, manual or a quarantine retry, so only one writes at a time
+        self.scan_lock = asyncio.Lock()
+        self.last_heartbeat = datetime.now()
+        self.scan_scheduler = ChangeProbeScheduler(
+            probe=self._probe_for_new_rows,
+            action=self._scheduled_scan,
+            interval=get_scan_interval(),
+            jitter=get_scan_jitter(),
+            max_backoff=get_scan_max_backoff(),
+            name='ACO application scan'
+        )
+        warm_restart.register('scan', self._scan_warm_state)
 
-        # On which sheet is the actual data.
-        self.worksheet_with_data_id = forms['worksheet_with_data_id']
+    def _scan_warm_state(self):
+        """
+        The scan progress itself is in the database, as the watermark moves with each page written. What is carried
+        over a restart is the polling schedule and the heartbeat.
 
-        print(f'Building worksheet with the key: {self.worksheet_key}')
-        self.running_scan = False
-        try:
-            workbook = self.client.open_by_key(self.worksheet_key)
-            print(workbook)
-            print(len(workbook.worksheets()))
-            self.tracking_sheet = workbook.get_worksheet(self.worksheet_with_data_id)
-        except gspread.exceptions.APIError as e:
-            print(f'Error reading the worksheet: {e}')
+        :returns: The section, or None before the tracking form is loaded
+        :rtype: dict
+        """
+        if self.form_entry is None:
+            return None
+        return {
+            'form_entry': self.form_entry,
+            'last_heartbeat': self.last_heartbeat.timestamp(),
+            'scheduler': self.scan_scheduler.export_state(),
+        }
 
     @cog_ext.cog_slash(
         name='find_user',
@@ -107,16 +169,24 @@ class DatabaseInteraction(Cog):
         },
     )
     async def find_user_test(self, ctx: SlashContext, member: str):
-        print(f'Looking for: {member}')
+        log.info(f'Looking for: {member}')
         bot_guild = bot.get_guild(bot_guild_id())
-        dc_user = bot_guild.get_member_named(member)
-        print(f'Result: {dc_user}')
+        dc_user = await find_member(bot_guild, member)
+        log.info(f'Result: {dc_user}')
         return await ctx.send(f'User {dc_user.name} has roles: {dc_user.roles}')
 
     @cog_ext.cog_slash(
         name="scan_aco_applications",
         guild_ids=[bot_guild_id()],
         description="Populates the ACO database from the updated google sheet. Admin/Mod role required.",
+        options=[
+            create_option(
+                name='full_rescan',
+                description='Re-check every row of the form rather than only the rows added since the last scan.',
+                option_type=5,  # boolean
+                required=False
+            )
+        ],
         permissions={
             bot_guild_id(): [
                 create_permission(server_admin_role_id(), SlashCommandPermissionType.ROLE, True),
@@ -125,191 +195,354 @@ class DatabaseInteraction(Cog):
             ]
         },
     )
-    async def user_update_database_from_googlesheets(self, ctx: SlashContext):
+    async def user_update_database_from_googlesheets(self, ctx: SlashContext, full_rescan: bool = False):
         """
         Slash command for updating the database from the GoogleSheet.
 
+        :param SlashContext ctx: The discord slash context
+        :param bool full_rescan: Scan the whole form instead of starting from the watermark
         :returns: A discord embed to the user.
         :rtype: None
         """
-        print(f'User {ctx.author} requested to re-populate the database at {datetime.now()}')
-        if self.running_scan:
+        log.info(f'User {ctx.author} requested to re-populate the database at {datetime.now()}')
+        if self.scan_lock.locked():
             return await ctx.send('DB scan is already in progress.')
 
         try:
-            result = await self._update_db()
+            async with self.scan_lock:
+                result = await self._update_db(full_rescan=full_rescan)
             msg = 'Check the ACO application channel for new applications' if result['added_count'] > 0 \
                 else 'No new applications found'
             embed = discord.Embed(title="ACO DB Update ran successfully.")
             embed.add_field(name='Scan completed', value=msg, inline=False)
+            if result['quarantined_count']:
+                embed.add_field(name='Rows quarantined', inline=False,
+                                value=f'{result["quarantined_count"]} rows could not be recorded, see /quarantine')
 
             return await ctx.send(embed=embed)
 
-        except ValueError as ex:
+        except (ValueError, EnvironmentError) as ex:
             return await ctx.send(str(ex))
+        except sqlite3.Error as ex:
+            log.exception('The database scan failed')
+            return await ctx.send(f'The scan failed on a database error, the failed page was not recorded: {ex}')
+
+    @cog_ext.cog_slash(
+        name='reconcile_members',
+        guild_ids=[bot_guild_id()],
+        description='Brings member tracking in line with who holds the member role. Admin/Mod role required.',
+        options=[
+            create_option(
+                name='dry_run',
+                description='Report what would change without changing anything. On unless set to false.',
+                option_type=5,  # boolean
+                required=False
+            )
+        ],
+        permissions={
+            bot_guild_id(): [
+                create_permission(server_admin_role_id(), SlashCommandPermissionType.ROLE, True),
+                create_permission(server_mod_role_id(), SlashCommandPermissionType.ROLE, True),
+                create_permission(bot_guild_id(), SlashCommandPermissionType.ROLE, False),
+            ]
+        },
+    )
+    async def reconcile_member_tracking(self, ctx: SlashContext, dry_run: bool = True):
+        """
+        Slash command for reconciling membertracking against the member role, reporting progress as it goes. Unlike
+        the reconciliation on startup, this also stops tracking anyone who no longer holds the role, so it only
+        reports the changes unless dry_run is turned off.
 
-    async def _update_db(self):
+        :param SlashContext ctx: The discord slash context
+        :param bool dry_run: Report the changes without applying them
+        :returns: None
         """
-        Private method to wrap the DB update commands.
+        log.info(f'User {ctx.author} requested a member tracking reconciliation at {datetime.now()}')
+        if member_directory.member_role is None:
+            return await ctx.send('Member role not found, cannot reconcile member tracking.')
+
+        progress_message = await ctx.send('Reconciling member tracking...')
+        await membertracking_writes.flush()
+        lines = []
+
+        async def _progress(line):
+            lines.append(line)
+            await progress_message.edit(content='\n'.join(lines))
+
+        holders = await member_role_holders(member_directory.guild, member_directory.member_role_id)
+        report = await reconcile_members(affiliator_service, holders, dry_run=dry_run, remove=True, progress=_progress)
+
+        embed = discord.Embed(title=f'Member tracking reconciliation{" (dry run)" if dry_run else ""}')
+        renamed = [f'{before} -> {after}' for before, after in report['renamed']]
+        for name, usernames in (('Added', report['added']), ('Renamed', renamed), ('Removed', report['removed'])):
+            # Embed field values are limited to 1024 characters
+            value = ', '.join(usernames) or 'None'
+            embed.add_field(name=f'{name} ({len(usernames)})', value=value[:1021] + '...' if len(value) > 1024
+                            else value, inline=False)
+        return await ctx.send(embed=embed)
+
+    @cog_ext.cog_slash(
+        name='metrics',
+        guild_ids=[bot_guild_id()],
+        description='Shows scan, database and discord timings since the bot started. Admin/Mod role required.',
+        permissions={
+            bot_guild_id(): [
+                create_permission(server_admin_role_id(), SlashCommandPermissionType.ROLE, True),
+                create_permission(server_mod_role_id(), SlashCommandPermissionType.ROLE, True),
+                create_permission(bot_guild_id(), SlashCommandPermissionType.ROLE, False),
+            ]
+        },
+    )
+    async def show_metrics(self, ctx: SlashContext):
+        """
+        Slash command summarising the metrics, the full set is on the local Prometheus endpoint.
 
-        :returns:
-        :rtype:
+        :param SlashContext ctx: The discord slash context
+        :returns: None
+        """
+        log.info(f'User {ctx.author} requested the metrics')
+
+        def _timings(histogram, limit=10):
+            # The busiest label sets first, as count and mean
+            rows = sorted(histogram.summary().items(), key=lambda item: item[1][0], reverse=True)[:limit]
+            lines = [
+                f'{",".join(str(value) for _, value in labels) or "all"}: {count} in {total / count * 1000:.1f}ms avg'
+                for labels, (count, total) in rows if count
+            ]
+            return '\n'.join(lines)[:1024] or 'None yet'
+
+        embed = discord.Embed(title='ACO Bot metrics')
+        embed.add_field(name='Scans', value=f'{_timings(scan_duration)}\nRows read: {scan_rows_fetched.total()}, '
+                                            f'new: {scan_rows_new.total()}', inline=False)
+        embed.add_field(name='Scan stages, per page', value=_timings(scan_stage_duration), inline=False)
+        embed.add_field(name='Database calls', value=_timings(db_latency), inline=False)
+        embed.add_field(name='Snapshots', value=_timings(snapshot_duration), inline=False)
+        embed.add_field(name='Discord requests', value=_timings(discord_latency), inline=False)
+        embed.add_field(name='Discord rate limits', value=str(discord_rate_limits.total()), inline=False)
+        embed.add_field(name='Gateway events', value=summarise_event_counts()[:1024], inline=False)
+        embed.add_field(name='Startup', value=startup_timer.report()[:1024] or 'Not recorded', inline=False)
+        return await ctx.send(embed=embed, hidden=True)
+
+    async def _membership_status(self, bot_guild, user):
         """
-        if not self.tracking_sheet:
+        Works out whether the applicant has the member role and has held it long enough to be eligible.
+
+        :param discord.Guild bot_guild: The PTN guild
+        :param UserData user: The application
+        :returns: The member, eligible_for_aco and reason values for the notification
+        :rtype: dict
+        """
+        reason = ""
+        eligible_for_aco = 'Unknown'
+
+        try:
+            dc_user = await find_member(bot_guild, user.discord_username)
+            if not dc_user:
+                log.warning('Invalid user', extra={'discord_username': user.discord_username})
+                raise InvalidUser(f'Invalid user for: {user.discord_username}')
+
+            log.debug('Found the applicant in the guild', extra={'member_id': dc_user.id})
+            member = member_directory.has_member_role(dc_user)
+
+            if member:
+                log.debug('User has the member role', extra={'user': dc_user})
+                # We have the role, go check member since when
+                try:
+                    # Rows tracked before member IDs were stored are matched on the username until claimed
+                    member_tracking_since = dict(await affiliator_service.query_one('''
+                        SELECT date_epoch FROM membertracking
+                        WHERE member_id = ?1 OR (member_id IS NULL AND username_key = ?2)
+                        ORDER BY member_id IS NULL
+                        LIMIT 1
+                    ''', (dc_user.id, username_key(dc_user))))
+                    # Whole seconds since the epoch on both sides, so this is an integer comparison
+                    seconds_with_role = int(time.time()) - member_tracking_since['date_epoch']
+                    if seconds_with_role >= ACO_ELIGIBLE_AFTER_SECONDS:
+                        eligible_for_aco = True
+                    else:
+                        eligible_from = datetime.fromtimestamp(
+                            member_tracking_since['date_epoch'] + ACO_ELIGIBLE_AFTER_SECONDS
+                        )
+                        eligible_for_aco = False
+                        reason = f'**Reason:** User member for: {seconds_with_role // SECONDS_PER_DAY} days.\n' \
+                                 f'**Eligible from**: {eligible_from.strftime("%Y-%m-%d %H:%M:%S")}.\n'
+                except TypeError as ex:
+                    reason = f'**Reason:** User not found in Database.\n'
+                    log.warning('Error when converting the membertracking object to a dict - is the user present?',
+                                extra={'user': dc_user, 'error': ex})
+            else:
+                eligible_for_aco = False
+                log.debug('User has no member role', extra={'user': dc_user})
+                reason = '**Reason:** No member role found.\n'
+        except (InvalidUser, NotFound, HTTPException) as ex:
+            log.warning('Unable to determine the member status',
+                        extra={'discord_username': user.discord_username, 'error': ex})
+            member = 'Unknown.'
+            reason = 'Unable to determine membership\n'
+
+        return {
+            'member': member,
+            'eligible_for_aco': eligible_for_aco,
+            'reason': reason,
+        }
+
+    async def _load_tracking_form(self):
+        """
+        Reads which form to track from the database, the first time it is needed.
+
+        :returns: None
+        """
+        if self.form_entry is not None:
+            return
+        await database_ready()
+        forms = await affiliator_service.read(_fetch_tracking_form)
+
+        self.form_entry = forms['entry']
+        self.worksheet_key = forms['worksheet_key']
+
+        # On which sheet is the actual data.
+        self.worksheet_with_data_id = forms['worksheet_with_data_id']
+
+        # The sheet is only authorized and opened when first used, so loading the form makes no google calls
+        if self.tracking_sheet is None:
+            self.tracking_sheet = SheetsClient(self.worksheet_key, self.worksheet_with_data_id)
+
+    async def _form_scan(self, sheet_rows=None):
+        """
+        Opens the tracking form and sets up a scan of it.
+
+        :param list[int] sheet_rows: Only scan these rows, see FormScan
+        :rtype: FormScan
+        """
+        await self._load_tracking_form()
+        try:
+            await self.tracking_sheet.open()
+        except SheetUnavailable as e:
+            log.error('Error reading the worksheet', extra={'error': e})
             raise EnvironmentError('Sorry this cannot be ran as we have no form for tracking ACOs presently. '
                                    'Please set a new form first.')
 
-        updated_db = False
-        added_count = 0
-        embed_list = []  #: [discord.Embed]
+        bot_guild = bot.get_guild(bot_guild_id())
 
-        # A JSON form tracking all the records
-        records_data = self.tracking_sheet.get_all_records()
+        async def _membership_status(user):
+            return await self._membership_status(bot_guild, user)
 
-        total_users = len(records_data)
-        print(f'Updating the database we have: {total_users} records in the tracking form.')
-        bot_guild = bot.get_guild(bot_guild_id())
+        # The new applications and their notifications are written a page at a time, and the outbox is kicked after
+        # each so they are posted while the rest of the form is still being scanned
+        return FormScan(affiliator_service, self.tracking_sheet, self.form_entry, _membership_status,
+                        notify=self.outbox.kick, sheet_rows=sheet_rows)
 
-        # First row is the headers, drop them.
-        for record in records_data:
-            print(record)
-            # Iterate over the records and populate the database as required.
+    @scan_duration.timed()
+    async def _update_db(self, full_rescan=False):
+        """
+        Private method to wrap the DB update commands.
 
-            # Check if it is in the database already by checking timestamp and carrier ID. This allows multiple
-            # applications
+        :param bool full_rescan: Scan the whole form instead of starting from the watermark
+        :returns: Whether the database was updated, the number of new applications and quarantined rows, and the scan
+            stage timings
+        :rtype: dict
+        """
+        scan = await self._form_scan()
+        result = await scan.run(full_rescan=full_rescan)
 
-            affiliator_db.execute(
-                "SELECT * FROM acoapplications WHERE fleet_carrier_id LIKE (?) AND timestamp = (?)",
-                (f'%{record["Carrier ID"].upper()}%', f'{record["Timestamp"]}')
-            )
-            userdata = [UserData(user) for user in affiliator_db.fetchall()]
-            if len(userdata) > 1:
-                raise ValueError(f'{len(userdata)} users are listed with this carrier ID:'
-                                 f' {record["Carrier ID"].upper()}. Problem in the DB!')
+        if result['updated_db']:
+            # The database is already written, snapshot it in the background
+            affiliator_snapshots.request()
 
-            if userdata:
-                # We have a user object, just check the values and update it if needed.
-                print(f'The user for {record["Carrier ID"].upper()} exists, no notification required')
+        return result
 
-            else:
-                added_count += 1
-                user = UserData(record)
-                print(user.to_dictionary())
-                print(f'Application for "{record["Carrier Name"]}" is not yet in the database - adding it')
+    @cog_ext.cog_slash(
+        name='quarantine',
+        guild_ids=[bot_guild_id()],
+        description='Lists the form rows held back from the database and why. Admin/Mod role required.',
+        permissions={
+            bot_guild_id(): [
+                create_permission(server_admin_role_id(), SlashCommandPermissionType.ROLE, True),
+                create_permission(server_mod_role_id(), SlashCommandPermissionType.ROLE, True),
+                create_permission(bot_guild_id(), SlashCommandPermissionType.ROLE, False),
+            ]
+        },
+    )
+    async def list_quarantine(self, ctx: SlashContext):
+        """
+        Slash command listing the quarantined form rows.
 
-                # TODO: We could track in DB the member role when it is added, as a reference point and use that
-                #  here? Probably overkill?
-                try:
-                    affiliator_lock.acquire()
-                    affiliator_db.execute(''' 
-                    INSERT INTO acoapplications VALUES(NULL, ?, ?, ?, ?, ?, ?, ?, ?) 
-                    ''', (
-                        user.discord_username, user.ptn_nickname, user.cmdr_name,
-                        user.fleet_carrier_name, user.fleet_carrier_id, user.ack,
-                        user.user_claims_member, user.timestamp
-                        )
-                    )
-                finally:
-                    affiliator_lock.release()
+        :param SlashContext ctx: The discord slash context
+        :returns: None
+        """
+        log.info(f'User {ctx.author} requested the quarantined rows')
+        await self._load_tracking_form()
+        rows = await affiliator_service.read(list_quarantined, self.form_entry)
+        embed = discord.Embed(title=f'Quarantined form rows ({len(rows)})')
+        if not rows:
+            embed.description = 'Nothing is quarantined.'
+        # Embeds are limited to 25 fields
+        for row in rows[:QUARANTINE_LIST_LIMIT]:
+            embed.add_field(
+                name=f'Row {row["sheet_row"]}, {row["attempts"]} attempt{"s" if row["attempts"] != 1 else ""}',
+                value=row['reason'][:1024], inline=False
+            )
+        if len(rows) > QUARANTINE_LIST_LIMIT:
+            embed.set_footer(text=f'And {len(rows) - QUARANTINE_LIST_LIMIT} more')
+        return await ctx.send(embed=embed, hidden=True)
 
-                reason = ""
-                eligible_for_aco = 'Unknown'
+    @cog_ext.cog_slash(
+        name='retry_quarantine',
+        guild_ids=[bot_guild_id()],
+        description='Reads quarantined form rows again, once they are fixed in the form. Admin/Mod role required.',
+        options=[
+            create_option(
+                name='row',
+                description='Only retry this form row, rather than every quarantined row.',
+                option_type=4,  # integer
+                required=False
+            )
+        ],
+        permissions={
+            bot_guild_id(): [
+                create_permission(server_admin_role_id(), SlashCommandPermissionType.ROLE, True),
+                create_permission(server_mod_role_id(), SlashCommandPermissionType.ROLE, True),
+                create_permission(bot_guild_id(), SlashCommandPermissionType.ROLE, False),
+            ]
+        },
+    )
+    async def retry_quarantine(self, ctx: SlashContext, row: int = None):
+        """
+        Slash command re-reading the quarantined rows from the form. Rows that now record, or turn out to be in the
+        database already, leave the quarantine.
 
-                try:
-                    dc_user = bot_guild.get_member_named(user.discord_username)
-                    if not dc_user:
-                        print(f'Invalid user for: {user.discord_username}')
-                        raise InvalidUser(f'Invalid user for: {user.discord_username}')
-
-                    print(f'USER: {dir(dc_user)}')
-                    print(type(dc_user))
-                    member_role = discord.utils.get(bot_guild.roles, id=get_member_role_id())
-                    print(member_role)
-                    member = member_role in dc_user.roles
-
-                    if member:
-                        print(f'User {dc_user} has the member role.')
-                        # We have the role, go check member since when
-                        try:
-                            affiliator_db.execute(
-                                "SELECT * FROM membertracking WHERE discord_username LIKE (?)", (f'%{dc_user}%',)
-                            )
-                            member_tracking_since = dict(affiliator_db.fetchone())
-                            print(f'User data: {user}')
-                            now = datetime.now()
-                            role_since = parser.parse(member_tracking_since['date'])
-
-                            time_with_role = now - role_since
-                            if time_with_role.days >= 14:
-                                eligible_for_aco = True
-                            else:
-                                eligible_from = role_since + timedelta(days=14)
-                                eligible_for_aco = False
-                                reason = f'**Reason:** User member for: {time_with_role.days} days.\n' \
-                                         f'**Eligible from**: {eligible_from.strftime("%Y-%m-%d %H:%M:%S")}.\n'
-                        except TypeError as ex:
-                            reason = f'**Reason:** User not found in Database.\n'
-                            print('Error when converting the membertracking object to a dict - is the user present?')
-                            print(ex)
-                    else:
-                        eligible_for_aco = False
-                        print(f'User {dc_user} has no member role: {dc_user.roles}')
-                        reason = '**Reason:** No member role found.\n'
-                except (InvalidUser, NotFound, HTTPException) as ex:
-                    print(f'Unable to member status for user {user.discord_username}: {ex}')
-                    member = 'Unknown.'
-                    reason = 'Unable to determine membership\n'
-
-                # Allow flagging of multiple attempts to join
-                affiliator_db.execute(
-                    "SELECT * FROM acoapplications WHERE fleet_carrier_id LIKE (?)",
-                    (f'%{record["Carrier ID"].upper()}%',)
-                )
-                # We already stuck it in the DB, so the counter is this current value.
-                application_attempt = len([UserData(user) for user in affiliator_db.fetchall()])
-
-                embed = discord.Embed(
-                    title='New ACO application detected.',
-                    description=f'**User:** {user.ptn_nickname}\n'
-                                f'**Discord Username:** {user.discord_username}\n'
-                                f'**Cmdr Name:** {user.cmdr_name}\n'
-                                f'**Fleet Carrier:** {user.fleet_carrier_name} ({user.fleet_carrier_id})\n'
-                                f'**Has member role:** {member}.\n'
-                                f'**Eligible for ACO:** {eligible_for_aco}\n'
-                                f'{reason}'
-                                f'**Applied At:** {user.timestamp}\n'
-                                f'**Application Attempt:** {application_attempt}'
-                )
-                embed.set_footer(text='Please validate membership and vote on this proposal')
-                embed_list.append(embed)
-                updated_db = True
-                print('Added ACO application to the database')
-
-        if updated_db:
-            # Write the database and then dump the updated SQL
-            try:
-                affiliator_lock.acquire()
-                affiliator_conn.commit()
-            finally:
-                affiliator_lock.release()
-            dump_database()
-            print('Wrote the database and dumped the SQL')
+        :param SlashContext ctx: The discord slash context
+        :param int row: Only retry this sheet row
+        :returns: None
+        """
+        log.info(f'User {ctx.author} requested a retry of the quarantined rows', extra={'sheet_row': row})
+        if self.scan_lock.locked():
+            return await ctx.send('DB scan is already in progress.')
 
-            # Send all the notifications now
-            notification_channel = bot.get_channel(get_bot_notification_channel())
+        await self._load_tracking_form()
+        quarantined = await affiliator_service.read(list_quarantined, self.form_entry, row)
+        if not quarantined:
+            return await ctx.send(f'Row {row} is not quarantined.' if row else 'Nothing is quarantined.')
 
-            await notification_channel.send(f'Priority transmission {len(embed_list)} application'
-                                            f'{"s" if len(embed_list) > 1 else ""} incoming.')
+        try:
+            async with self.scan_lock:
+                scan = await self._form_scan(sheet_rows=[entry['sheet_row'] for entry in quarantined])
+                result = await scan.run()
+        except (ValueError, EnvironmentError) as ex:
+            return await ctx.send(str(ex))
+        except sqlite3.Error as ex:
+            log.exception('The quarantine retry failed')
+            return await ctx.send(f'The retry failed on a database error: {ex}')
 
-            for entry in embed_list:
-                message = await notification_channel.send(embed=entry)
-                await message.add_reaction('👍')
-                await message.add_reaction('👎')
+        if result['updated_db']:
+            affiliator_snapshots.request()
 
-        return {
-            'updated_db': updated_db,
-            'added_count': added_count,
-        }
+        embed = discord.Embed(title='Quarantine retry completed')
+        embed.add_field(name='Rows retried', value=str(len(quarantined)), inline=False)
+        embed.add_field(name='Applications added', value=str(result['added_count']), inline=False)
+        embed.add_field(name='Released without an application', value=str(result['released_count']), inline=False)
+        embed.add_field(name='Still quarantined', value=str(result['quarantined_count']), inline=False)
+        return await ctx.send(embed=embed)
 
     @cog_ext.cog_slash(
         name='grant_affiliate_status',
@@ -332,30 +565,30 @@ class DatabaseInteraction(Cog):
         },
     )
     async def toggle_aco_role(self, ctx: SlashContext, user: discord.Member):
-        print(f"toggle_aco_role called by {ctx.author} in {ctx.channel} for {user}")
+        log.info(f"toggle_aco_role called by {ctx.author} in {ctx.channel} for {user}")
         # set the target role
-        print(f"ACO role ID is {get_server_aco_role_id()}")
+        log.info(f"ACO role ID is {get_server_aco_role_id()}")
         role = discord.utils.get(ctx.guild.roles, id=get_server_aco_role_id())
-        print(f"ACO role name is {role.name}")
+        log.info(f"ACO role name is {role.name}")
 
         if role in user.roles:
             # toggle off
-            print(f"{user} is already an ACO, removing the role.")
+            log.info(f"{user} is already an ACO, removing the role.")
             try:
                 await user.remove_roles(role)
                 response = f"{user.display_name} no longer has the ACO role."
                 return await ctx.send(content=response)
             except Exception as e:
-                print(e)
+                log.exception(f'Failed removing the ACO role from {user}')
                 await ctx.send(f"Failed removing role from {user}: {e}")
         else:
             # toggle on
-            print(f"{user} is not an ACO, adding the role.")
+            log.info(f"{user} is not an ACO, adding the role.")
             try:
                 await user.add_roles(role)
-                print(f"Added ACO role to {user}")
+                log.info(f"Added ACO role to {user}")
                 response = f"{user.display_name} now has the ACO role."
                 return await ctx.send(content=response)
             except Exception as e:
-                print(e)
+                log.exception(f'Failed adding the ACO role to {user}')
                 await ctx.send(f"Failed adding role to {user}: {e}")
@@ -1,14 +1,43 @@
-import datetime
+import asyncio
+import logging
 import os
 import sys
 
-import discord
 from discord.ext import commands
 from discord_slash.utils.manage_commands import remove_all_commands
 
-from ptn.aco.constants import bot_guild_id, TOKEN, get_bot_control_channel, get_member_role_id, bot
+from ptn.aco.constants import bot_guild_id, TOKEN, get_bot_control_channel, get_member_role_id, get_intents_profile, \
+    is_lean_member_cache
 from ptn.aco._metadata import __version__
-from ptn.aco.database.database import affiliator_db, affiliator_lock, affiliator_conn
+from ptn.aco.database.database import affiliator_service, database_ready
+from ptn.aco.database.writebehind import membertracking_writes
+from ptn.aco.events import member_update_changes, user_update_changes, summarise_event_counts, event_counts
+from ptn.aco.log import stop_logging
+from ptn.aco.members import member_directory, member_lookup_cache, member_role_holders
+from ptn.aco.metrics import metrics_server
+from ptn.aco.reconcile import reconcile_members
+from ptn.aco.startup import startup_timer
+from ptn.aco.warmrestart import warm_restart
+
+log = logging.getLogger(__name__)
+
+
+async def save_for_restart(reason):
+    """
+    Writes out the pending member tracking changes and the warm restart state before the process goes away. Any
+    changes that fail to write are kept in the warm restart state instead.
+
+    :param str reason: Why the bot is stopping
+    :returns: None
+    """
+    try:
+        await membertracking_writes.flush()
+    except Exception:
+        log.exception('Failed writing the member tracking changes, keeping them for the restart')
+    try:
+        warm_restart.save(reason)
+    except OSError:
+        log.exception('Failed writing the warm restart state, the next start is cold')
 
 
 class DiscordBotCommands(commands.Cog):
@@ -19,6 +48,11 @@ class DiscordBotCommands(commands.Cog):
         :param discord.ext.commands.Bot bot: The discord bot object
         """
         self.bot = bot
+        # Whether the member role holders are known, so they are only carried over a restart once they are
+        self.members_caught_up = False
+        self._catch_up_task = None
+        warm_restart.register('members', self._members_warm_state)
+        warm_restart.register('membertracking_writes', membertracking_writes.export_pending)
 
     @commands.Cog.listener()
     async def on_ready(self):
@@ -27,13 +61,93 @@ class DiscordBotCommands(commands.Cog):
 
         :returns: None
         """
-        print(f'{self.bot.user.name} has connected to Discord server version: {__version__}')
+        log.info(f'{self.bot.user.name} has connected to Discord server version: {__version__}')
+        startup_timer.end('discord_connect')
+
+        # None of these depend on each other
+        await asyncio.gather(
+            startup_timer.run('metrics_server', metrics_server.start()),
+            startup_timer.run('member_tracking', self._catch_up_member_tracking()),
+            startup_timer.run('announce', self._announce()),
+        )
+        startup_timer.log_report()
+
+    async def _catch_up_member_tracking(self):
+        """
+        Indexes the guild members, then catches up on member role changes made while the bot was offline.
+
+        :returns: None
+        """
+        guild = self.bot.get_guild(bot_guild_id())
+        member_directory.build(guild, index_members=not is_lean_member_cache())
+
+        await database_ready()
+        pending = warm_restart.take('membertracking_writes')
+        if pending:
+            membertracking_writes.restore_pending(pending)
+
+        if member_directory.member_role is None:
+            log.warning(f'Member role {get_member_role_id()} not found, skipping the member tracking reconciliation')
+            return
+
+        warm = warm_restart.take('members')
+        if warm is not None and is_lean_member_cache():
+            # Paging every member in from discord is the slow part of a lean start. The role holders known when the
+            # bot stopped are used straight away, and the role changes made while it was down are caught up on in
+            # the background.
+            member_directory.role_holder_ids = set(warm['role_holder_ids'])
+            member_lookup_cache.restore_misses(warm['lookup_misses'])
+            log.info('Restored the member role holders, catching up on member tracking in the background', extra={
+                'holders': len(member_directory.role_holder_ids)
+            })
+            self.members_caught_up = True
+            self._catch_up_task = asyncio.ensure_future(self._reconcile_in_background(guild))
+            return
+
+        await self._reconcile_member_tracking(guild)
+
+    async def _reconcile_member_tracking(self, guild):
+        """
+        Pages in the member role holders and adds any missing from member tracking.
+
+        :param discord.Guild guild: The bot guild
+        :returns: None
+        """
+        holders = await member_role_holders(guild, get_member_role_id())
+        if is_lean_member_cache():
+            member_directory.role_holder_ids = {member.id for member in holders}
+        await membertracking_writes.flush()
+        await reconcile_members(affiliator_service, holders)
+        self.members_caught_up = True
+
+    async def _reconcile_in_background(self, guild):
+        try:
+            await startup_timer.run('member_tracking_catch_up', self._reconcile_member_tracking(guild))
+        except Exception:
+            log.exception('Failed catching up on member tracking after a warm restart')
+
+    def _members_warm_state(self):
+        """
+        Without a member cache, the member role holders and the cached lookup misses are carried over a restart. With
+        one, the directory is rebuilt from the member cache on start, which is cheap.
+
+        :returns: The section, or None when there is nothing worth keeping
+        :rtype: dict
+        """
+        if not is_lean_member_cache() or not self.members_caught_up:
+            return None
+        return {
+            'role_holder_ids': list(member_directory.role_holder_ids),
+            'lookup_misses': member_lookup_cache.export_misses(),
+        }
+
+    async def _announce(self):
         bot_channel = self.bot.get_channel(get_bot_control_channel())
         await bot_channel.send(f'{self.bot.user.name} has connected to Discord server version: {__version__}')
 
     @commands.Cog.listener()
     async def on_disconnect(self):
-        print(f'Booze bot has disconnected from discord server, version: {__version__}.')
+        log.warning(f'Booze bot has disconnected from discord server, version: {__version__}.')
 
     @commands.command(name='ping', help='Ping the bot')
     @commands.has_role('Admin')
@@ -56,7 +170,8 @@ class DiscordBotCommands(commands.Cog):
         :param discord.ext.commands.Context ctx: The Discord context object
         :returns: None
         """
-        print(f'User {ctx.author} requested to exit')
+        log.info(f'User {ctx.author} requested to exit')
+        await save_for_restart('exit')
         await remove_all_commands(self.bot.user.id, TOKEN, [bot_guild_id()])
         await ctx.send(f"Ahoy! k thx bye")
         await sys.exit("User requested exit.")
@@ -87,7 +202,10 @@ class DiscordBotCommands(commands.Cog):
         """
         Restarts the application for updates to take affect on the local system.
         """
-        print(f'Restarting the application to perform updates requested by {ctx.author}')
+        log.info(f'Restarting the application to perform updates requested by {ctx.author}')
+        await save_for_restart('update')
+        # execv skips the atexit hooks, so write out the queued log records first
+        stop_logging()
         os.execv(sys.executable, ['python'] + sys.argv)
 
     @commands.command(name='version', help="Logs the bot version")
@@ -99,9 +217,49 @@ class DiscordBotCommands(commands.Cog):
         :param discord.ext.commands.Context ctx: The Discord context object
         :returns: None
         """
-        print(f'User {ctx.author} requested the version: {__version__}.')
+        log.info(f'User {ctx.author} requested the version: {__version__}.')
         await ctx.send(f"{self.bot.user.name} is on version: {__version__}.")
 
+    @commands.command(name='events', help="Shows how many gateway events were handled and dropped early")
+    @commands.has_role('Admin')
+    async def events(self, ctx):
+        """
+        Posts the gateway event counters.
+
+        :param discord.ext.commands.Context ctx: The Discord context object
+        :returns: None
+        """
+        log.info(f'User {ctx.author} requested the event counters.')
+        await ctx.send(f'Intents profile: {get_intents_profile()}\n```\n{summarise_event_counts()}\n```')
+
+    @commands.Cog.listener()
+    async def on_member_join(self, member):
+        """
+        Keeps the member directory current.
+
+        :returns: None
+        """
+        if member.guild.id == bot_guild_id():
+            if member_directory.indexed:
+                member_directory.add(member)
+            member_lookup_cache.invalidate_names(str(member), member.name, member.display_name)
+
+    @commands.Cog.listener()
+    async def on_member_remove(self, member):
+        """
+        Keeps the member directory current.
+
+        :returns: None
+        """
+        if member.guild.id == bot_guild_id():
+            member_directory.remove(member)
+            member_lookup_cache.invalidate_member(member.id)
+
+    @commands.Cog.listener()
+    async def on_guild_role_update(self, before, after):
+        if after.id == get_member_role_id():
+            member_directory.refresh_role()
+
     @commands.Cog.listener()
     async def on_member_update(self, before, after):
         """
@@ -109,60 +267,88 @@ class DiscordBotCommands(commands.Cog):
 
         :returns: None
         """
+        nick_changed, role_changed = member_update_changes(before, after, bot_guild_id(), get_member_role_id())
 
-        # Check if the user had the member role initially.
-        bot_guild = bot.get_guild(bot_guild_id())
-        member_role = discord.utils.get(bot_guild.roles, id=get_member_role_id())
-        initial = member_role in before.roles
-        post = member_role in after.roles
+        if nick_changed and member_directory.indexed:
+            member_directory.add(after)
+        if nick_changed or role_changed:
+            member_lookup_cache.invalidate_member(after.id)
 
-        # Compare them, if they changed we need to do something
-        if initial != post:
+        if role_changed:
+            post = after._roles.has(get_member_role_id())
             change = 'Added' if post else 'Removed'
-            print(f'Member role {change} for user: {before}')
+            log.info(f'Member role {change} for user: {before}')
 
+            # Written in batches by the write-behind buffer
             if post:
-                # Add the role - add to DB
-                affiliator_db.execute(
-                    "SELECT * FROM membertracking WHERE discord_username LIKE (?)", (f'%{before}%',)
-                )
-                user = affiliator_db.fetchone()
-
-                if user:
-                    print(f'Some problem - user {before} is already in the tracking DB with the data: {dict(user)}.')
-                    return
-
-                try:
-                    affiliator_lock.acquire()
-                    affiliator_db.execute(
-                        '''INSERT INTO membertracking VALUES(NULL, ?, ?)''',
-                        (
-                            str(before),
-                            datetime.datetime.now()
-                        )
-                    )
-                    affiliator_conn.commit()
-                finally:
-                    affiliator_lock.release()
-                    print(f'Member tracking status was added into DB for user: {before} at {datetime.datetime.now()}')
+                member_directory.role_holder_ids.add(after.id)
+                membertracking_writes.add(after.id, after)
             else:
-                # Remove the role - delete from DB if it is there
-                affiliator_db.execute(
-                    "SELECT * FROM membertracking WHERE discord_username LIKE (?)", (f'%{before}%',)
-                )
-                user = dict(affiliator_db.fetchone())
-                if not user:
-                    print(f'User had the member role removed, but was not in the DB: {before}')
-                    return
-
-                try:
-                    affiliator_lock.acquire()
-                    affiliator_db.execute(
-                        "DELETE FROM membertracking WHERE discord_username LIKE (?)", (f'%{before.name}%',)
-                    )
-                    affiliator_conn.commit()
-                    print(f'Member tracking status was deleted from DB for user: {before} at {datetime.datetime.now()}')
-                finally:
-                    affiliator_lock.release()
+                member_directory.role_holder_ids.discard(after.id)
+                membertracking_writes.remove(after.id, after)
 
+    @commands.Cog.listener()
+    async def on_user_update(self, before, after):
+        """
+        Username and discriminator changes only arrive here, not as member updates. Re-indexes the member under their
+        new names, which drops the old ones, forgets any lookups cached under either, and renames their tracked row so
+        the eligibility check still finds it.
+
+        :param discord.User before: The user before the update
+        :param discord.User after: The user after the update
+        :returns: None
+        """
+        if not user_update_changes(before, after):
+            return
+
+        member_lookup_cache.invalidate_member(after.id)
+        member_lookup_cache.invalidate_names(str(after), after.name)
+        guild = self.bot.get_guild(bot_guild_id())
+        member = guild.get_member(after.id) if guild is not None else None
+        if member is not None and member_directory.indexed:
+            member_directory.add(member)
+        await membertracking_writes.rename(after.id, before, after)
+
+    @commands.Cog.listener()
+    async def on_socket_response(self, msg):
+        """
+        Without a member cache discord.py drops the updates and removals of members it has not cached, so the member
+        role changes are picked out of the raw gateway events instead.
 
+        :param dict msg: The raw gateway payload
+        :returns: None
+        """
+        if msg.get('t') not in ('GUILD_MEMBER_UPDATE', 'GUILD_MEMBER_REMOVE') or not is_lean_member_cache():
+            return
+
+        data = msg['d']
+        event = 'raw_member_update' if msg['t'] == 'GUILD_MEMBER_UPDATE' else 'raw_member_remove'
+        event_counts[f'{event}.received'] += 1
+        if int(data['guild_id']) != bot_guild_id():
+            event_counts[f'{event}.dropped_other_guild'] += 1
+            return
+
+        member_id = int(data['user']['id'])
+        if self.bot.get_guild(bot_guild_id()).get_member(member_id) is not None:
+            # Cached members still come through on_member_update
+            return
+        member_lookup_cache.invalidate_member(member_id)
+        if msg['t'] == 'GUILD_MEMBER_REMOVE':
+            # Leaving the guild is not a role change, forget them so a rejoin with the role is tracked again
+            member_directory.role_holder_ids.discard(member_id)
+            return
+
+        has_role = str(get_member_role_id()) in data['roles']
+        if has_role == (member_id in member_directory.role_holder_ids):
+            event_counts[f'{event}.dropped_unchanged'] += 1
+            return
+
+        event_counts[f'{event}.member_role_changed'] += 1
+        username = f'{data["user"]["username"]}#{data["user"]["discriminator"]}'
+        log.info(f'Member role {"Added" if has_role else "Removed"} for user: {username}')
+        if has_role:
+            member_directory.role_holder_ids.add(member_id)
+            membertracking_writes.add(member_id, username)
+        else:
+            member_directory.role_holder_ids.discard(member_id)
+            membertracking_writes.remove(member_id, username)
@@ -1,3 +1,5 @@
+import logging
+
 import discord
 from discord.ext import commands
 from discord_slash import SlashContext, cog_ext
@@ -5,6 +7,8 @@ from discord_slash.utils.manage_commands import create_option, create_choice
 
 from ptn.aco.constants import bot_guild_id
 
+log = logging.getLogger(__name__)
+
 
 class Helper(commands.Cog):
 
@@ -35,6 +39,22 @@ class Helper(commands.Cog):
                         name='grant_affiliate_status',
                         value='grant_affiliate_status'
                     ),
+                    create_choice(
+                        name='reconcile_members',
+                        value='reconcile_members'
+                    ),
+                    create_choice(
+                        name='metrics',
+                        value='metrics'
+                    ),
+                    create_choice(
+                        name='quarantine',
+                        value='quarantine'
+                    ),
+                    create_choice(
+                        name='retry_quarantine',
+                        value='retry_quarantine'
+                    ),
                 ]
             ),
         ]
@@ -47,7 +67,7 @@ class Helper(commands.Cog):
         :param command:
         :returns: None
         """
-        print(f'User {ctx.author} has requested help for command: {command}')
+        log.info(f'User {ctx.author} has requested help for command: {command}')
         # For each value we just populate some data.
         if command == 'grant_affiliate_status':
             params = [
@@ -60,8 +80,15 @@ class Helper(commands.Cog):
             method_desc = 'Grants or removes the ACO role to the provided user'
             roles = ['Admin', 'Mod']
         elif command == 'scan_aco_applications':
-            params = None
-            method_desc = 'Starts a manual scan for new applications. Triggers automatically every 24 hours.'
+            params = [
+                {
+                    'name': 'full_rescan',
+                    'type': 'boolean',
+                    'description': 'Optional. Re-check every row of the form, not just those added since the last scan'
+                }
+            ]
+            method_desc = 'Starts a manual scan for new applications. Triggers automatically when new rows appear ' \
+                          'on the form.'
             roles = ['Admin', 'Mod']
         elif command == 'find_user':
             params = [
@@ -73,8 +100,40 @@ class Helper(commands.Cog):
             ]
             method_desc = 'Searches the roles for a user'
             roles = ['Admin', 'Mod']
+        elif command == 'reconcile_members':
+            params = [
+                {
+                    'name': 'dry_run',
+                    'type': 'boolean',
+                    'description': 'Optional. Report what would change without changing anything, on by default'
+                }
+            ]
+            method_desc = 'Adds member role holders missing from member tracking, renames those who changed ' \
+                          'username and removes anyone tracked who no longer holds the role. Only reports the ' \
+                          'changes unless dry_run is false. Runs automatically on startup, without the removals.'
+            roles = ['Admin', 'Mod']
+        elif command == 'metrics':
+            params = None
+            method_desc = 'Shows scan, database and discord timings since the bot started. The full set is served ' \
+                          'for Prometheus on the local metrics endpoint.'
+            roles = ['Admin', 'Mod']
+        elif command == 'quarantine':
+            params = None
+            method_desc = 'Lists the form rows that could not be recorded, such as rows with a malformed carrier ID, ' \
+                          'and why. The scan skips them and carries on with the rest of the form.'
+            roles = ['Admin', 'Mod']
+        elif command == 'retry_quarantine':
+            params = [
+                {
+                    'name': 'row',
+                    'type': 'integer',
+                    'description': 'Optional. Only retry this form row'
+                }
+            ]
+            method_desc = 'Reads the quarantined rows from the form again once they are fixed, and records them.'
+            roles = ['Admin', 'Mod']
         else:
-            print('User did not provide a valid command.')
+            log.warning('User did not provide a valid command.')
             return await ctx.send(f'Unknown handling for command: {command}.')
 
         response_embed = discord.Embed(
@@ -97,5 +156,5 @@ class Helper(commands.Cog):
             # In the case of no params, just append None to the description.
             response_embed.description += 'None.'
 
-        print(f"Returning the response to: {ctx.author}")
+        log.info(f"Returning the response to: {ctx.author}")
         await ctx.send(embed=response_embed, hidden=True)
@@ -1,12 +1,14 @@
 # Production variables
 import ast
+import logging
 import os
 
-from discord import Intents
+from discord import Intents, MemberCacheFlags
 from discord.ext import commands
-from discord_slash import SlashCommand
 from dotenv import load_dotenv, find_dotenv
 
+from ptn.aco.log import configure_logging
+
 # Get the discord token from the local .env file. Deliberately not hosted in the repo or Discord takes the bot down
 # because the keys are exposed. DO NOT HOST IN THE REPO. Seriously do not do it ...
 load_dotenv(find_dotenv(usecwd=True))
@@ -14,6 +16,8 @@ load_dotenv(find_dotenv(usecwd=True))
 PROD_DISCORD_GUILD = 800080948716503040  # PTN Discord server
 PROD_DB_PATH = os.path.join(os.path.expanduser('~'), 'acobot', 'aco_applications.db')
 PROD_DB_DUMPS_PATH = os.path.join(os.path.expanduser('~'), 'acobot', 'dumps', 'aco_applications.sql')
+PROD_DB_SNAPSHOTS_PATH = os.path.join(os.path.expanduser('~'), 'acobot', 'snapshots')
+PROD_WARM_RESTART_PATH = os.path.join(os.path.expanduser('~'), 'acobot', 'warm_restart.json')
 PROD_MOD_ID = 813814494563401780
 PROD_ACO_BOT_CHANNEL = 909365309473951764  # This is #aco-bot
 PROD_ACO_NOTIFICATION_BOT_CHANNEL = 855394490050805770  # This is #mod-aco-applications
@@ -25,6 +29,8 @@ PROD_ACO_ROLE_ID = 867811399195426837
 TEST_DISCORD_GUILD = 818174236480897055  # test Discord server
 TEST_DB_PATH = os.path.join(os.path.expanduser('~'), 'acobot', 'aco_applications.db')
 TEST_DB_DUMPS_PATH = os.path.join(os.path.expanduser('~'), 'acobot', 'dumps', 'aco_applications.sql')
+TEST_DB_SNAPSHOTS_PATH = os.path.join(os.path.expanduser('~'), 'acobot', 'snapshots')
+TEST_WARM_RESTART_PATH = os.path.join(os.path.expanduser('~'), 'acobot', 'warm_restart.json')
 TEST_MOD_ID = 818174400997228545
 TEST_ACO_BOT_CHANNEL = 909365393875947520
 TEST_ACO_NOTIFICATION_CHANNEL = 909365393875947520
@@ -32,24 +38,127 @@ TEST_ADMIN_ID = 818174400997228545
 TEST_MEMBER_ID = 903289848427851847
 TEST_ACO_ROLE_ID = 903289778680770590
 
+# Scan scheduling, all in seconds. The form is probed for new rows every interval plus up to the jitter, backing off
+# towards the maximum while the probe keeps failing.
+SCAN_INTERVAL = float(os.environ.get('ACO_SCAN_INTERVAL_SECONDS', 60))
+SCAN_JITTER = float(os.environ.get('ACO_SCAN_JITTER_SECONDS', 10))
+SCAN_MAX_BACKOFF = float(os.environ.get('ACO_SCAN_MAX_BACKOFF_SECONDS', 30 * 60))
+
+# The scan streams the form through its stages a page at a time. How many pages may wait between two stages, and how
+# many applicants are looked up in the guild and the database at once.
+SCAN_QUEUE_PAGES = int(os.environ.get('ACO_SCAN_QUEUE_PAGES', 2))
+SCAN_ENRICH_CONCURRENCY = int(os.environ.get('ACO_SCAN_ENRICH_CONCURRENCY', 8))
+
+# The strptime formats form timestamps are read with, separated by ';'. Anything matching none of them has to be ISO
+# 8601, so a day first date is never read as month first. Google forms writes month first timestamps, the ISO ones
+# are how the bot wrote dates.
+SHEET_TIMESTAMP_FORMATS = os.environ.get(
+    'ACO_SHEET_TIMESTAMP_FORMATS', '%m/%d/%Y %H:%M:%S;%Y-%m-%d %H:%M:%S.%f;%Y-%m-%d %H:%M:%S'
+)
+
+# The time zone timestamps without an offset are read in, such as the form's, rather than whatever zone the host is
+# on. Set it to the form's zone, as a tz database name.
+TIMESTAMP_TIMEZONE = os.environ.get('ACO_TIMESTAMP_TIMEZONE', 'UTC')
+
+# Database snapshots, how many of the most recent to keep and whether to gzip them
+SNAPSHOT_KEEP = int(os.environ.get('ACO_SNAPSHOT_KEEP', 10))
+SNAPSHOT_COMPRESS = ast.literal_eval(os.environ.get('ACO_SNAPSHOT_COMPRESS', 'True'))
+
+# Database connections. Reads run on a small pool of reader connections alongside the single writer, a busy
+# connection waits up to the timeout for a lock, and each connection caches this many prepared statements.
+DB_READERS = int(os.environ.get('ACO_DB_READERS', 2))
+DB_BUSY_TIMEOUT = float(os.environ.get('ACO_DB_BUSY_TIMEOUT_SECONDS', 5))
+DB_STATEMENT_CACHE = int(os.environ.get('ACO_DB_STATEMENT_CACHE', 256))
+
+# Member tracking write-behind, the most seconds a change waits before it is written and how many pending changes
+# force an early write
+WRITE_BEHIND_INTERVAL = float(os.environ.get('ACO_WRITE_BEHIND_INTERVAL_SECONDS', 2))
+WRITE_BEHIND_MAX_PENDING = int(os.environ.get('ACO_WRITE_BEHIND_MAX_PENDING', 500))
+
+# Which gateway events the bot subscribes to, see _build_intents
+INTENTS_PROFILE = os.environ.get('ACO_BOT_INTENTS_PROFILE', 'standard').lower()
+
+# 'full' caches every guild member, 'lean' skips member chunking and caches none, looking members up on demand
+# through an LRU of this many names, each kept for the TTL in seconds
+MEMBER_CACHE_MODE = os.environ.get('ACO_MEMBER_CACHE_MODE', 'full').lower()
+MEMBER_LOOKUP_CACHE_SIZE = int(os.environ.get('ACO_MEMBER_LOOKUP_CACHE_SIZE', 1024))
+MEMBER_LOOKUP_CACHE_TTL = float(os.environ.get('ACO_MEMBER_LOOKUP_CACHE_TTL_SECONDS', 5 * 60))
+
+# Logging, the root level, per module overrides such as 'ptn.aco.database.sql=DEBUG,discord=INFO' and an optional
+# log file. SQL statements are only traced when the ptn.aco.database.sql logger is at DEBUG.
+LOG_LEVEL = os.environ.get('ACO_LOG_LEVEL', 'INFO')
+LOG_LEVELS = os.environ.get('ACO_LOG_LEVELS', '')
+LOG_FILE = os.environ.get('ACO_LOG_FILE')
+
+# Local Prometheus endpoint, a port of 0 switches it off
+METRICS_HOST = os.environ.get('ACO_METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('ACO_METRICS_PORT', 9108))
+
+# The caches and scan state written out when the bot exits or restarts are restored on the next start when they are
+# at most this many seconds old, 0 switches the warm restart off
+WARM_RESTART_MAX_AGE = float(os.environ.get('ACO_WARM_RESTART_MAX_AGE_SECONDS', 5 * 60))
+
 _production = ast.literal_eval(os.environ.get('PTN_ACO_BOT_PRODUCTION', 'False'))
 
-# Check the folder exists
-if not os.path.exists(os.path.dirname(PROD_DB_PATH)):
-    print(f'Folder {os.path.dirname(PROD_DB_PATH)} does not exist, making it now.')
-    os.mkdir(os.path.dirname(PROD_DB_PATH))
+configure_logging(LOG_LEVEL, LOG_LEVELS, LOG_FILE)
+log = logging.getLogger(__name__)
 
-# check the dumps folder exists
-if not os.path.exists(os.path.dirname(PROD_DB_DUMPS_PATH)):
-    print(f'Folder {os.path.dirname(PROD_DB_DUMPS_PATH)} does not exist, making it now.')
-    os.mkdir(os.path.dirname(PROD_DB_DUMPS_PATH))
+TOKEN = os.getenv('ACO_BOT_DISCORD_TOKEN_PROD') if _production else os.getenv('ACO_BOT_DISCORD_TOKEN_TESTING')
 
 
-TOKEN = os.getenv('ACO_BOT_DISCORD_TOKEN_PROD') if _production else os.getenv('ACO_BOT_DISCORD_TOKEN_TESTING')
+def _build_intents(profile):
+    """
+    Builds the gateway intents for a profile. 'standard' subscribes only to what the bot uses: guilds and roles,
+    members for the member role tracking, and guild messages for the prefix commands. Presences are left out, so
+    status and activity changes no longer arrive as member updates. 'default' is discord.py's default set plus
+    members, and 'all' is every intent.
+
+    :param str profile: The profile name
+    :returns: The intents
+    :rtype: discord.Intents
+    """
+    if profile == 'all':
+        return Intents.all()
+    if profile == 'default':
+        intents = Intents.default()
+        intents.members = True
+        return intents
+    if profile == 'standard':
+        return Intents(guilds=True, members=True, guild_messages=True)
+    raise ValueError(f'Unknown ACO_BOT_INTENTS_PROFILE: {profile}, expected one of standard, default or all')
+
+
+def _member_cache_options(mode):
+    """
+    Returns the bot options for a member cache mode.
+
+    :param str mode: 'full' or 'lean'
+    :rtype: dict
+    """
+    if mode == 'full':
+        return {}
+    if mode == 'lean':
+        return {'chunk_guilds_at_startup': False, 'member_cache_flags': MemberCacheFlags.none()}
+    raise ValueError(f'Unknown ACO_MEMBER_CACHE_MODE: {mode}, expected full or lean')
+
 
-# The bot object:
-bot = commands.Bot(command_prefix='a/', intents=Intents.all())
-slash = SlashCommand(bot, sync_commands=True)
+# The bot object. The slash command handler is attached when the bot is run, see ptn.aco.application
+bot = commands.Bot(
+    command_prefix='a/', intents=_build_intents(INTENTS_PROFILE), **_member_cache_options(MEMBER_CACHE_MODE)
+)
+
+
+def ensure_data_folders():
+    """
+    Creates the database, dumps and snapshots folders if they are missing. Called when the database is first built
+    rather than on import.
+
+    :returns: None
+    """
+    for folder in (os.path.dirname(get_db_path()), os.path.dirname(get_db_dumps_path()), get_db_snapshots_path()):
+        if not os.path.exists(folder):
+            log.info(f'Folder {folder} does not exist, making it now.')
+            os.makedirs(folder, exist_ok=True)
 
 
 def get_db_path():
@@ -82,6 +191,83 @@ def get_db_dumps_path():
     return PROD_DB_DUMPS_PATH if _production else TEST_DB_DUMPS_PATH
 
 
+def get_db_snapshots_path():
+    """
+    Returns the folder holding the database snapshots
+
+    :returns: A string representation of the path
+    :rtype: str
+    """
+    return PROD_DB_SNAPSHOTS_PATH if _production else TEST_DB_SNAPSHOTS_PATH
+
+
+def get_warm_restart_path():
+    """
+    Returns the file holding the warm restart state
+
+    :returns: A string representation of the path
+    :rtype: str
+    """
+    return PROD_WARM_RESTART_PATH if _production else TEST_WARM_RESTART_PATH
+
+
+def get_warm_restart_max_age():
+    """
+    Returns how old the warm restart state may be and still be restored
+
+    :return: The age in seconds
+    :rtype: float
+    """
+    return max(0.0, WARM_RESTART_MAX_AGE)
+
+
+def get_snapshot_keep():
+    """
+    Returns how many database snapshots to keep
+
+    :returns: The snapshot count
+    :rtype: int
+    """
+    return SNAPSHOT_KEEP
+
+
+def get_snapshot_compress():
+    """
+    Returns whether the database snapshots are gzipped
+
+    :rtype: bool
+    """
+    return SNAPSHOT_COMPRESS
+
+
+def get_db_readers():
+    """
+    Returns how many reader connections the database keeps, 0 runs reads on the writer
+
+    :rtype: int
+    """
+    return max(0, DB_READERS)
+
+
+def get_db_busy_timeout():
+    """
+    Returns how long a database connection waits for a lock
+
+    :return: The timeout in seconds
+    :rtype: float
+    """
+    return DB_BUSY_TIMEOUT
+
+
+def get_db_statement_cache():
+    """
+    Returns how many prepared statements each database connection caches
+
+    :rtype: int
+    """
+    return DB_STATEMENT_CACHE
+
+
 def server_mod_role_id():
     """
     Returns the moderator role ID for the server
@@ -140,3 +326,149 @@ def get_server_aco_role_id():
     :rtype: int
     """
     return PROD_ACO_ROLE_ID if _production else TEST_ACO_ROLE_ID
+
+
+def get_scan_interval():
+    """
+    Returns the seconds between probes of the tracking form
+
+    :return: The interval in seconds
+    :rtype: float
+    """
+    return SCAN_INTERVAL
+
+
+def get_scan_jitter():
+    """
+    Returns the most seconds of random jitter added to each probe interval
+
+    :return: The jitter in seconds
+    :rtype: float
+    """
+    return SCAN_JITTER
+
+
+def get_scan_max_backoff():
+    """
+    Returns the longest wait between probes while they keep failing
+
+    :return: The backoff in seconds
+    :rtype: float
+    """
+    return SCAN_MAX_BACKOFF
+
+
+def get_sheet_timestamp_formats():
+    """
+    Returns the strptime formats tried, in order, when reading a timestamp
+
+    :rtype: tuple[str]
+    """
+    return tuple(fmt for fmt in SHEET_TIMESTAMP_FORMATS.split(';') if fmt)
+
+
+def get_timestamp_timezone():
+    """
+    Returns the time zone timestamps without an offset are read in
+
+    :return: The tz database name
+    :rtype: str
+    """
+    return TIMESTAMP_TIMEZONE
+
+
+def get_scan_queue_pages():
+    """
+    Returns how many pages of the form may wait between two stages of the scan
+
+    :return: The queue size in pages
+    :rtype: int
+    """
+    return max(1, SCAN_QUEUE_PAGES)
+
+
+def get_scan_enrich_concurrency():
+    """
+    Returns how many applicants the scan looks up at once
+
+    :return: The number of concurrent lookups
+    :rtype: int
+    """
+    return max(1, SCAN_ENRICH_CONCURRENCY)
+
+
+def get_write_behind_interval():
+    """
+    Returns the most seconds a member tracking change is held before it is written
+
+    :return: The interval in seconds
+    :rtype: float
+    """
+    return WRITE_BEHIND_INTERVAL
+
+
+def get_write_behind_max_pending():
+    """
+    Returns how many pending member tracking changes force an early write
+
+    :return: The change count
+    :rtype: int
+    """
+    return WRITE_BEHIND_MAX_PENDING
+
+
+def get_intents_profile():
+    """
+    Returns the gateway intents profile the bot was built with
+
+    :return: The profile name
+    :rtype: str
+    """
+    return INTENTS_PROFILE
+
+
+def is_lean_member_cache():
+    """
+    Returns whether the bot runs without a member cache, looking members up on demand instead
+
+    :rtype: bool
+    """
+    return MEMBER_CACHE_MODE == 'lean'
+
+
+def get_member_lookup_cache_size():
+    """
+    Returns how many member lookups are kept in the lean mode LRU
+
+    :return: The entry count
+    :rtype: int
+    """
+    return MEMBER_LOOKUP_CACHE_SIZE
+
+
+def get_member_lookup_cache_ttl():
+    """
+    Returns how long a member lookup is kept in the lean mode LRU
+
+    :return: The TTL in seconds
+    :rtype: float
+    """
+    return MEMBER_LOOKUP_CACHE_TTL
+
+
+def get_metrics_host():
+    """
+    Returns the address the metrics endpoint listens on
+
+    :rtype: str
+    """
+    return METRICS_HOST
+
+
+def get_metrics_port():
+    """
+    Returns the port the metrics endpoint listens on, 0 when it is switched off
+
+    :rtype: int
+    """
+    return METRICS_PORT
@@ -1,105 +1,405 @@
+import asyncio
+import functools
+import logging
 import os
 import sqlite3
 import threading
+from concurrent.futures import ThreadPoolExecutor
 
-from ptn.aco.constants import get_db_path, get_db_dumps_path
+from ptn.aco.constants import get_db_path, get_db_dumps_path, get_db_snapshots_path, get_snapshot_keep, \
+    get_snapshot_compress, get_db_readers, get_db_busy_timeout, get_db_statement_cache, ensure_data_folders
+from ptn.aco.database.migrations import migrate
+from ptn.aco.database.snapshot import take_snapshot, restore_latest_snapshot, restore_sql_dump
+from ptn.aco.metrics import db_latency, snapshot_duration
+from ptn.aco.startup import startup_timer
 
-print(f'Starting DB at: {get_db_path()}')
-
-affiliator_conn = sqlite3.connect(get_db_path())
-affiliator_conn.row_factory = sqlite3.Row
-affiliator_db = affiliator_conn.cursor()
-affiliator_conn.set_trace_callback(print)
+log = logging.getLogger(__name__)
+# Every statement run is logged here at DEBUG, and only then is the trace callback installed
+sql_log = logging.getLogger('ptn.aco.database.sql')
 
 db_sql_store = get_db_dumps_path()
-affiliator_lock = threading.Lock()
+
+# True once the database is built, or the task building it
+_database_build = None
 
 
-def dump_database():
+def _operation_name(func, default):
     """
-    Dumps the affiliate user database into sql.
+    Labels database calls in the metrics by the function run, which keeps the label count bounded by the code.
 
-    :returns: None
+    :rtype: str
     """
-    with open(db_sql_store, 'w') as f:
-        for line in affiliator_conn.iterdump():
-            f.write(line)
+    name = getattr(func, '__name__', '<lambda>')
+    return default if name == '<lambda>' else name.lstrip('_')
 
 
-def build_database_on_startup():
-    print('Checking whether the affiliate db exists')
-    affiliator_db.execute(
+def _sql_trace_callback():
+    """
+    :returns: The sqlite trace callback, None unless SQL tracing is switched on
+    :rtype: function
+    """
+    return sql_log.debug if sql_log.isEnabledFor(logging.DEBUG) else None
+
+
+class AffiliatorDatabase:
+
+    def __init__(self, db_path, readers=2, busy_timeout=5.0, cached_statements=256):
+        """
+        Async access to the affiliator database, so a slow query or dump never blocks the discord event loop.
+
+        Every write runs on a single dedicated writer thread which owns the writing connection, so writes are
+        serialized and never contend for the lock among themselves. Reads run on a small pool of reader connections.
+        The database is in WAL mode, so readers see the last committed state without blocking the writer or being
+        blocked by it, and with synchronous=NORMAL a commit only waits on fsync at checkpoints.
+
+        :param str db_path: The path to the sqlite database file
+        :param int readers: How many reader connections, 0 runs reads on the writer
+        :param float busy_timeout: Seconds a connection waits for a lock held elsewhere, such as by a snapshot
+        :param int cached_statements: How many prepared statements each connection caches
+        """
+        self.db_path = db_path
+        self.readers = readers
+        self.busy_timeout = busy_timeout
+        self.cached_statements = cached_statements
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='affiliator-db')
+        # Without readers the writer thread serves the reads too
+        self._reader_executor = ThreadPoolExecutor(
+            max_workers=readers, thread_name_prefix='affiliator-db-read'
+        ) if readers else self._executor
+        self._conn = None
+        self._local = threading.local()
+        self._reader_conns = []
+        self._reader_lock = threading.Lock()
+
+    def _open(self, query_only=False):
+        """
+        Opens a connection with the bot's pragmas.
+
+        :param bool query_only: Refuse writes, for the reader connections
+        :rtype: sqlite3.Connection
+        """
+        conn = sqlite3.connect(
+            self.db_path, timeout=self.busy_timeout, cached_statements=self.cached_statements,
+            check_same_thread=not query_only
+        )
+        conn.row_factory = sqlite3.Row
+        if not query_only:
+            # Stored in the database file, so readers and snapshot connections pick it up too
+            conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout * 1000)}")
+        if query_only:
+            conn.execute("PRAGMA query_only = 1")
+        conn.set_trace_callback(_sql_trace_callback())
+        return conn
+
+    def _connection(self):
+        """
+        Returns the writer thread connection, opening it on first use. Only ever called from the writer thread.
+
+        :returns: The sqlite connection
+        :rtype: sqlite3.Connection
+        """
+        if self._conn is None:
+            log.info(f'Starting DB at: {self.db_path}')
+            self._conn = self._open()
+        return self._conn
+
+    def _reader_connection(self):
+        """
+        Returns the calling reader thread's connection, opening it on first use, or the writer's when there are no
+        readers.
+
+        :rtype: sqlite3.Connection
+        """
+        if not self.readers:
+            return self._connection()
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._open(query_only=True)
+            with self._reader_lock:
+                self._reader_conns.append(conn)
+        return conn
+
+    def _read_call(self, func, *args):
+        return func(self._reader_connection(), *args)
+
+    def _read_in_transaction(self, func, *args):
+        # One read transaction, so every statement sees the same committed state
+        conn = self._reader_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("BEGIN")
+            return func(cursor, *args)
+        finally:
+            conn.rollback()
+            cursor.close()
+
+    def _call(self, func, *args):
+        return func(self._connection(), *args)
+
+    def _call_in_transaction(self, func, *args):
+        conn = self._connection()
+        cursor = conn.cursor()
+        try:
+            result = func(cursor, *args)
+            conn.commit()
+            return result
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    async def _submit(self, operation, func, *args):
+        loop = asyncio.get_running_loop()
+        with db_latency.time(operation=operation):
+            return await loop.run_in_executor(self._executor, functools.partial(func, *args))
+
+    async def _submit_read(self, operation, func, *args):
+        loop = asyncio.get_running_loop()
+        with db_latency.time(operation=operation):
+            return await loop.run_in_executor(self._reader_executor, functools.partial(func, *args))
+
+    def run_sync(self, func, *args):
+        """
+        Runs func(connection, *args) on the worker thread and blocks until it is done. Only intended for startup,
+        before the event loop is running.
+
+        :returns: Whatever func returns
+        """
+        return self._executor.submit(self._call, func, *args).result()
+
+    async def run(self, func, *args):
+        """
+        Runs func(connection, *args) on the worker thread.
+
+        :returns: Whatever func returns
+        """
+        return await self._submit(_operation_name(func, 'run'), self._call, func, *args)
+
+    async def read(self, func, *args):
+        """
+        Runs func(cursor, *args) on a reader connection inside a read transaction, so it sees one consistent state and
+        runs alongside the writer. func must not write.
+
+        :returns: Whatever func returns
+        """
+        return await self._submit_read(_operation_name(func, 'read'), self._read_in_transaction, func, *args)
+
+    async def query(self, sql, params=()):
+        """
+        Runs a read query on a reader connection.
+
+        :param str sql: The SQL statement
+        :param tuple params: The statement parameters
+        :returns: All the matching rows
+        :rtype: list[sqlite3.Row]
+        """
+        return await self._submit_read('query', self._read_call, lambda conn: conn.execute(sql, params).fetchall())
+
+    async def query_one(self, sql, params=()):
+        """
+        Runs a read query on a reader connection and returns the first row.
+
+        :param str sql: The SQL statement
+        :param tuple params: The statement parameters
+        :returns: The first row or None
+        :rtype: sqlite3.Row
+        """
+        return await self._submit_read(
+            'query_one', self._read_call, lambda conn: conn.execute(sql, params).fetchone()
+        )
+
+    async def execute(self, sql, params=()):
+        """
+        Runs a single write statement in its own transaction.
+
+        :param str sql: The SQL statement
+        :param tuple params: The statement parameters
+        :returns: The number of rows changed
+        :rtype: int
+        """
+        return await self._submit(
+            'execute', self._call_in_transaction, lambda cursor: cursor.execute(sql, params).rowcount
+        )
+
+    async def executemany(self, sql, seq_of_params):
+        """
+        Runs a write statement for each parameter set, all in one transaction.
+
+        :param str sql: The SQL statement
+        :param iterable seq_of_params: The parameter sets
+        :returns: The number of rows changed
+        :rtype: int
+        """
+        return await self._submit(
+            'executemany', self._call_in_transaction, lambda cursor: cursor.executemany(sql, seq_of_params).rowcount
+        )
+
+    async def transaction(self, func, *args):
+        """
+        Runs func(cursor, *args) on the worker thread inside a transaction. The transaction is committed when func
+        returns and rolled back if it raises.
+
+        :returns: Whatever func returns
+        """
+        return await self._submit(_operation_name(func, 'transaction'), self._call_in_transaction, func, *args)
+
+    def close(self):
+        """
+        Waits for outstanding work and closes the connections.
+
+        :returns: None
+        """
+        def _close(conn):
+            conn.close()
+            self._conn = None
+
+        if self._reader_executor is not self._executor:
+            self._reader_executor.shutdown(wait=True)
+        with self._reader_lock:
+            for conn in self._reader_conns:
+                conn.close()
+            self._reader_conns = []
+        if self._conn is not None:
+            self._executor.submit(self._call, _close).result()
+        self._executor.shutdown(wait=True)
+
+
+affiliator_service = AffiliatorDatabase(
+    get_db_path(), get_db_readers(), get_db_busy_timeout(), get_db_statement_cache()
+)
+
+
+class SnapshotWriter:
+
+    def __init__(self, db_path, snapshot_dir, keep, compress):
+        """
+        Takes database snapshots in the background. Requests made while a snapshot is being written are coalesced
+        into a single follow up snapshot.
+
+        :param str db_path: The live database
+        :param str snapshot_dir: The snapshot folder
+        :param int keep: How many snapshots to keep
+        :param bool compress: gzip the snapshots
+        """
+        self.db_path = db_path
+        self.snapshot_dir = snapshot_dir
+        self.keep = keep
+        self.compress = compress
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='affiliator-snapshot')
+        self._requested = False
+        self._task = None
+
+    async def snapshot(self):
+        """
+        Writes a snapshot now.
+
+        :returns: The snapshot path
+        :rtype: str
+        """
+        loop = asyncio.get_running_loop()
+        with snapshot_duration.time():
+            path = await loop.run_in_executor(self._executor, functools.partial(
+                take_snapshot, self.db_path, self.snapshot_dir, self.keep, self.compress
+            ))
+        log.info(f'Wrote the database snapshot: {path}')
+        return path
+
+    def request(self):
+        """
+        Asks for a snapshot without waiting for it.
+
+        :returns: None
+        """
+        self._requested = True
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        while self._requested:
+            self._requested = False
+            try:
+                await self.snapshot()
+            except Exception:
+                log.exception('Failed to write the database snapshot')
+
+    async def wait(self):
+        """
+        Waits for any snapshot in progress or requested to be written.
+
+        :returns: None
+        """
+        if self._task is not None:
+            await self._task
+
+
+affiliator_snapshots = SnapshotWriter(
+    get_db_path(), get_db_snapshots_path(), get_snapshot_keep(), get_snapshot_compress()
+)
+
+
+def _build_database(conn):
+    log.info('Checking whether the affiliate db exists')
+    affiliator_db = conn.execute(
         '''SELECT count(name) FROM sqlite_master WHERE TYPE = 'table' AND name = 'acoapplications' ''')
     if not bool(affiliator_db.fetchone()[0]):
+        # Do not trace every restored statement
+        conn.set_trace_callback(None)
+        try:
+            log.info('Recreating database from the latest snapshot ...')
+            snapshot = restore_latest_snapshot(conn, get_db_snapshots_path())
+            if snapshot:
+                log.info(f'Restored the database from: {snapshot}')
+            elif os.path.exists(db_sql_store):
+                # recreate from the older SQL dump backup file
+                log.info('No snapshot found, recreating database from the SQL dump ...')
+                restore_sql_dump(conn, db_sql_store)
+        finally:
+            conn.set_trace_callback(_sql_trace_callback())
 
-        if os.path.exists(db_sql_store):
-            # recreate from backup file
-            print('Recreating database from backup ...')
-            with open(db_sql_store) as f:
-                sql_script = f.read()
-                affiliator_db.executescript(sql_script)
-        else:
-            print('Creating a fresh database')
-            affiliator_db.execute('''
-                CREATE TABLE acoapplications( 
-                    entry INTEGER PRIMARY KEY AUTOINCREMENT,
-                    discord_username TEXT NOT NULL,
-                    ptn_nickname TEXT NOT NULL,
-                    cmdr_name TEXT NOT NULL,
-                    fleet_carrier_name TEXT NOT NULL,
-                    fleet_carrier_id TEXT NOT NULL,
-                    ack BOOLEAN,
-                    user_claims_member BOOLEAN,
-                    timestamp DATETIME,
-                    UNIQUE (fleet_carrier_name, timestamp)
-                ) 
-            ''')
-            affiliator_conn.commit()
-            print('Affiliate Database created')
-    else:
-        print('The Affiliate database already exists')
-
-    print('Checking whether the the input tracking database exists')
-    affiliator_db.execute(
-        '''SELECT count(name) FROM sqlite_master WHERE TYPE = 'table' AND name = 'trackingforms' '''
-    )
-    if not bool(affiliator_db.fetchone()[0]):
-        print('Creating a fresh trackingforms database')
-        affiliator_db.execute('''
-                CREATE TABLE trackingforms(
-                    entry INTEGER PRIMARY KEY AUTOINCREMENT,
-                    worksheet_key TEXT UNIQUE,
-                    worksheet_with_data_id INT
-                ) 
-            ''')
-        # Some default values in the case we need to make the table. These will need to be set accordingly,
-        # remove this once we have them in place
-        affiliator_db.execute('''
-            INSERT INTO trackingforms VALUES(
-                NULL,
-                '1-AK8MeguKMOK4cifTntIVUVcbY9oQUIPhMMkrUmztwE',
-                0
-            ) 
-        ''')
-        affiliator_conn.commit()
-        print('Forms Database created')
-    else:
-        print('The tracking forms database already exists')
-
-    print('Checking whether the the member tracking database exists')
-    affiliator_db.execute(
-        '''SELECT count(name) FROM sqlite_master WHERE TYPE = 'table' AND name = 'membertracking' '''
-    )
-    if not bool(affiliator_db.fetchone()[0]):
-        print('Creating a fresh membertracking database')
-        affiliator_db.execute('''
-                CREATE TABLE membertracking(
-                    entry INTEGER PRIMARY KEY AUTOINCREMENT,
-                    discord_username TEXT UNIQUE,
-                    date DATETIME
-                ) 
-            ''')
-        affiliator_conn.commit()
-        print('Member tracking database created')
-    else:
-        print('The member tracking table already exists')
+    migrate(conn)
+
+
+def build_database_on_startup():
+    """
+    Restores the database from the newest valid snapshot, or the older SQL dump, when it is empty, then creates or
+    upgrades the tables to the latest schema. Runs on the database worker thread and blocks until done, so call it
+    before the bot starts.
+
+    :returns: None
+    """
+    global _database_build
+    ensure_data_folders()
+    affiliator_service.run_sync(_build_database)
+    _database_build = True
+
+
+def start_database_build(loop=None):
+    """
+    Starts building the database as build_database_on_startup does, without waiting for it, so the restore and
+    migrations overlap with connecting to discord. Anything else written meanwhile queues behind it on the writer.
+
+    :param asyncio.AbstractEventLoop loop: The loop to run on, defaults to the running loop
+    :returns: The build task
+    :rtype: asyncio.Future
+    """
+    global _database_build
+    if _database_build is None:
+        ensure_data_folders()
+        _database_build = asyncio.ensure_future(
+            startup_timer.run('database', affiliator_service.run(_build_database)), loop=loop
+        )
+    return _database_build
+
+
+async def database_ready():
+    """
+    Waits for the database to be built, starting the build if nothing has yet.
+
+    :returns: None
+    """
+    build = start_database_build()
+    if build is not True:
+        await build
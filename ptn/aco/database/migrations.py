@@ -0,0 +1,250 @@
+import logging
+
+from ptn.aco.database.normalise import carrier_id_key, username_key, timestamp_epoch
+
+log = logging.getLogger(__name__)
+
+
+def _table_exists(affiliator_db, table):
+    affiliator_db.execute(
+        "SELECT count(name) FROM sqlite_master WHERE TYPE = 'table' AND name = (?)", (table,)
+    )
+    return bool(affiliator_db.fetchone()[0])
+
+
+def _timestamp_epoch_or_none(value):
+    """
+    timestamp_epoch for backfills, leaving NULL where the old text is not a timestamp rather than failing the migration.
+    """
+    try:
+        return timestamp_epoch(value)
+    except ValueError:
+        return None
+
+
+def _column_exists(affiliator_db, table, column):
+    affiliator_db.execute(f"PRAGMA table_info({table})")
+    return column in [row[1] for row in affiliator_db.fetchall()]
+
+
+def _create_tables(affiliator_db):
+    """Create the applications, tracking forms and member tracking tables"""
+    log.info('Checking whether the affiliate db exists')
+    if not _table_exists(affiliator_db, 'acoapplications'):
+        log.info('Creating a fresh database')
+        affiliator_db.execute('''
+            CREATE TABLE acoapplications(
+                entry INTEGER PRIMARY KEY AUTOINCREMENT,
+                discord_username TEXT NOT NULL,
+                ptn_nickname TEXT NOT NULL,
+                cmdr_name TEXT NOT NULL,
+                fleet_carrier_name TEXT NOT NULL,
+                fleet_carrier_id TEXT NOT NULL,
+                ack BOOLEAN,
+                user_claims_member BOOLEAN,
+                timestamp DATETIME,
+                UNIQUE (fleet_carrier_name, timestamp)
+            )
+        ''')
+        log.info('Affiliate Database created')
+    else:
+        log.info('The Affiliate database already exists')
+
+    log.info('Checking whether the the input tracking database exists')
+    if not _table_exists(affiliator_db, 'trackingforms'):
+        log.info('Creating a fresh trackingforms database')
+        affiliator_db.execute('''
+            CREATE TABLE trackingforms(
+                entry INTEGER PRIMARY KEY AUTOINCREMENT,
+                worksheet_key TEXT UNIQUE,
+                worksheet_with_data_id INT
+            )
+        ''')
+        # Some default values in the case we need to make the table. These will need to be set accordingly,
+        # remove this once we have them in place
+        affiliator_db.execute('''
+            INSERT INTO trackingforms VALUES(
+                NULL,
+                '1-AK8MeguKMOK4cifTntIVUVcbY9oQUIPhMMkrUmztwE',
+                0
+            )
+        ''')
+        log.info('Forms Database created')
+    else:
+        log.info('The tracking forms database already exists')
+
+    log.info('Checking whether the the member tracking database exists')
+    if not _table_exists(affiliator_db, 'membertracking'):
+        log.info('Creating a fresh membertracking database')
+        affiliator_db.execute('''
+            CREATE TABLE membertracking(
+                entry INTEGER PRIMARY KEY AUTOINCREMENT,
+                discord_username TEXT UNIQUE,
+                date DATETIME
+            )
+        ''')
+        log.info('Member tracking database created')
+    else:
+        log.info('The member tracking table already exists')
+
+
+def _add_scan_watermark(affiliator_db):
+    """Track the sheet row the last scan got up to, row 1 being the headers"""
+    if not _column_exists(affiliator_db, 'trackingforms', 'last_row_index'):
+        affiliator_db.execute("ALTER TABLE trackingforms ADD COLUMN last_row_index INT DEFAULT 1")
+
+
+def _add_lookup_keys(affiliator_db):
+    """Add indexed exact match keys for carrier IDs and discord usernames"""
+    if not _column_exists(affiliator_db, 'acoapplications', 'carrier_id_key'):
+        affiliator_db.execute("ALTER TABLE acoapplications ADD COLUMN carrier_id_key TEXT")
+    affiliator_db.execute("UPDATE acoapplications SET carrier_id_key = aco_carrier_id_key(fleet_carrier_id)")
+    affiliator_db.execute('''
+        CREATE INDEX IF NOT EXISTS acoapplications_carrier_id_key ON acoapplications(carrier_id_key, timestamp)
+    ''')
+
+    if not _column_exists(affiliator_db, 'membertracking', 'username_key'):
+        affiliator_db.execute("ALTER TABLE membertracking ADD COLUMN username_key TEXT")
+    affiliator_db.execute("UPDATE membertracking SET username_key = aco_username_key(discord_username)")
+    affiliator_db.execute('''
+        CREATE INDEX IF NOT EXISTS membertracking_username_key ON membertracking(username_key)
+    ''')
+
+
+def _add_notification_outbox(affiliator_db):
+    """Add the outbox of notifications waiting to be posted to discord"""
+    affiliator_db.execute('''
+        CREATE TABLE IF NOT EXISTS notificationoutbox(
+            entry INTEGER PRIMARY KEY AUTOINCREMENT,
+            idempotency_key TEXT UNIQUE NOT NULL,
+            payload TEXT NOT NULL,
+            created DATETIME,
+            attempts INT DEFAULT 0,
+            next_attempt REAL DEFAULT 0,
+            last_error TEXT,
+            message_id INT,
+            delivered DATETIME
+        )
+    ''')
+    affiliator_db.execute('''
+        CREATE INDEX IF NOT EXISTS notificationoutbox_pending ON notificationoutbox(next_attempt)
+        WHERE delivered IS NULL
+    ''')
+
+
+def _add_quarantine(affiliator_db):
+    """Add the quarantine of form rows that could not be recorded"""
+    affiliator_db.execute('''
+        CREATE TABLE IF NOT EXISTS quarantine(
+            entry INTEGER PRIMARY KEY AUTOINCREMENT,
+            form_entry INT NOT NULL,
+            sheet_row INT NOT NULL,
+            cells TEXT NOT NULL,
+            reason TEXT NOT NULL,
+            attempts INT DEFAULT 1,
+            created DATETIME,
+            last_attempt DATETIME,
+            UNIQUE (form_entry, sheet_row)
+        )
+    ''')
+
+
+def _add_epoch_timestamps(affiliator_db):
+    """Add indexed integer epoch columns for the application timestamps and member tracking dates"""
+    if not _column_exists(affiliator_db, 'acoapplications', 'timestamp_epoch'):
+        affiliator_db.execute("ALTER TABLE acoapplications ADD COLUMN timestamp_epoch INTEGER")
+    affiliator_db.execute("UPDATE acoapplications SET timestamp_epoch = aco_timestamp_epoch(timestamp)")
+    # Duplicates are now matched on the epoch, so the text timestamp index is replaced
+    affiliator_db.execute("DROP INDEX IF EXISTS acoapplications_carrier_id_key")
+    affiliator_db.execute('''
+        CREATE INDEX IF NOT EXISTS acoapplications_carrier_id_epoch ON acoapplications(carrier_id_key, timestamp_epoch)
+    ''')
+    affiliator_db.execute('''
+        CREATE INDEX IF NOT EXISTS acoapplications_timestamp_epoch ON acoapplications(timestamp_epoch)
+    ''')
+
+    if not _column_exists(affiliator_db, 'membertracking', 'date_epoch'):
+        affiliator_db.execute("ALTER TABLE membertracking ADD COLUMN date_epoch INTEGER")
+    affiliator_db.execute("UPDATE membertracking SET date_epoch = aco_timestamp_epoch(date)")
+    affiliator_db.execute('''
+        CREATE INDEX IF NOT EXISTS membertracking_date_epoch ON membertracking(date_epoch)
+    ''')
+    _warn_unreadable_epochs(affiliator_db)
+
+
+def _warn_unreadable_epochs(affiliator_db):
+    for table, column, epoch_column in (('acoapplications', 'timestamp', 'timestamp_epoch'),
+                                        ('membertracking', 'date', 'date_epoch')):
+        affiliator_db.execute(
+            f"SELECT count(*) FROM {table} WHERE {epoch_column} IS NULL AND {column} IS NOT NULL AND {column} != ''"
+        )
+        unreadable = affiliator_db.fetchone()[0]
+        if unreadable:
+            log.warning(f'{unreadable} rows of {table} have a {column} that could not be read, left without an epoch')
+
+
+def _reread_epochs_in_one_zone(affiliator_db):
+    """Re-read the epoch columns in the configured time zone, they were read in the zone of the host"""
+    affiliator_db.execute("UPDATE acoapplications SET timestamp_epoch = aco_timestamp_epoch(timestamp)")
+    affiliator_db.execute("UPDATE membertracking SET date_epoch = aco_timestamp_epoch(date)")
+    _warn_unreadable_epochs(affiliator_db)
+
+
+def _add_member_ids(affiliator_db):
+    """Track members by their member ID, so a member who renames keeps their tracking date"""
+    if not _column_exists(affiliator_db, 'membertracking', 'member_id'):
+        affiliator_db.execute("ALTER TABLE membertracking ADD COLUMN member_id INTEGER")
+    # Existing rows are claimed by their members as they are next seen, matched on the username
+    affiliator_db.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS membertracking_member_id ON membertracking(member_id)
+    ''')
+
+
+# Append new migrations to the end, never reorder or remove them. Each one's position in the list is the schema
+# version it upgrades to, which is stored in PRAGMA user_version. Migrations should tolerate running against a
+# database restored from a dump, which carries the tables but not the user_version.
+MIGRATIONS = [
+    _create_tables,
+    _add_scan_watermark,
+    _add_lookup_keys,
+    _add_notification_outbox,
+    _add_quarantine,
+    _add_epoch_timestamps,
+    _add_member_ids,
+    _reread_epochs_in_one_zone,
+]
+
+
+def migrate(conn):
+    """
+    Upgrades the database schema in place to the latest version. Each migration runs in its own transaction along
+    with the user_version bump, so a failure leaves the database on the last good version.
+
+    :param sqlite3.Connection conn: The database connection
+    :returns: The schema version the database is now on
+    :rtype: int
+    """
+    # The same normalisation is used in python when writing rows, so backfills use it too rather than SQL UPPER/LOWER,
+    # which only handle ASCII.
+    conn.create_function('aco_carrier_id_key', 1, carrier_id_key, deterministic=True)
+    conn.create_function('aco_username_key', 1, username_key, deterministic=True)
+    conn.create_function('aco_timestamp_epoch', 1, _timestamp_epoch_or_none)
+
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    log.info(f'Database schema is on version {version} of {len(MIGRATIONS)}')
+
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        log.info(f'Applying database migration {number}: {migration.__doc__}')
+        cursor = conn.cursor()
+        try:
+            cursor.execute("BEGIN")
+            migration(cursor)
+            cursor.execute(f"PRAGMA user_version = {number}")
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    return len(MIGRATIONS)
@@ -0,0 +1,131 @@
+import re
+from datetime import datetime
+from functools import lru_cache
+
+from dateutil import parser, tz
+
+from ptn.aco.constants import get_sheet_timestamp_formats, get_timestamp_timezone
+
+# Read once, they are tried for every timestamp
+TIMESTAMP_FORMATS = get_sheet_timestamp_formats()
+TIMESTAMP_ZONE = tz.gettz(get_timestamp_timezone())
+if TIMESTAMP_ZONE is None:
+    raise ValueError(f'Unknown timestamp time zone: {get_timestamp_timezone()}')
+
+# The strptime directives that are plain numbers, which a format can be matched with a regex for
+_NUMERIC_DIRECTIVES = {
+    'Y': r'(?P<year>\d{4})',
+    'm': r'(?P<month>\d{1,2})',
+    'd': r'(?P<day>\d{1,2})',
+    'H': r'(?P<hour>\d{1,2})',
+    'M': r'(?P<minute>\d{1,2})',
+    'S': r'(?P<second>\d{1,2})',
+    'f': r'\d{1,6}',
+}
+
+
+def carrier_id_key(fleet_carrier_id):
+    """
+    Returns the exact match lookup key for a fleet carrier ID.
+
+    :param str fleet_carrier_id: The carrier ID as entered on the form
+    :returns: The normalised key
+    :rtype: str
+    """
+    return str(fleet_carrier_id).strip().upper() if fleet_carrier_id is not None else None
+
+
+def username_key(discord_username):
+    """
+    Returns the exact match lookup key for a discord username, as name#discriminator.
+
+    :param str discord_username: The username, or anything that str() turns into one such as a discord.Member
+    :returns: The normalised key
+    :rtype: str
+    """
+    return str(discord_username).strip().lower() if discord_username is not None else None
+
+
+@lru_cache(maxsize=None)
+def _format_pattern(fmt):
+    """
+    Compiles a strptime format made only of numeric directives into a regex, which reads a timestamp several times
+    faster than strptime. Whitespace matches any run of whitespace, as it does for strptime.
+
+    :param str fmt: The strptime format
+    :returns: The pattern, or None when the format uses other directives and is left to strptime
+    :rtype: re.Pattern
+    """
+    pattern = []
+    for index, part in enumerate(re.split(r'%(.)', fmt)):
+        if index % 2 == 0:
+            # Literal text between the directives
+            for token in re.split(r'(\s+)', part):
+                if token:
+                    pattern.append(r'\s+' if token.isspace() else re.escape(token))
+        elif part in _NUMERIC_DIRECTIVES:
+            pattern.append(_NUMERIC_DIRECTIVES[part])
+        else:
+            return None
+    return re.compile(''.join(pattern))
+
+
+def _parse_format(text, fmt):
+    """
+    Reads a timestamp in the format, dropping any fraction of a second.
+
+    :rtype: datetime
+    :raises ValueError: If the text does not match the format
+    """
+    pattern = _format_pattern(fmt)
+    if pattern is None:
+        return datetime.strptime(text, fmt)
+    match = pattern.fullmatch(text)
+    if match is None:
+        raise ValueError(f'{text} does not match {fmt}')
+    fields = match.groupdict()
+    return datetime(int(fields.get('year') or 1900), int(fields.get('month') or 1), int(fields.get('day') or 1),
+                    int(fields.get('hour') or 0), int(fields.get('minute') or 0), int(fields.get('second') or 0))
+
+
+def _epoch(moment, zone):
+    """
+    :param datetime moment: The timestamp, read in the zone when it has no offset of its own
+    :param datetime.tzinfo zone: The time zone
+    :rtype: int
+    """
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=zone)
+    return int(moment.timestamp())
+
+
+def timestamp_epoch(value, formats=TIMESTAMP_FORMATS, zone=TIMESTAMP_ZONE):
+    """
+    Returns a timestamp as whole seconds since the epoch. Timestamps without an offset are read in the one configured
+    zone, so the epochs do not depend on the host they were worked out on. Strings are tried against the fixed formats
+    first, and otherwise have to be ISO 8601.
+
+    :param value: The timestamp, as a string, datetime or seconds since the epoch
+    :param tuple[str] formats: The strptime formats to try, in order
+    :param datetime.tzinfo zone: The time zone timestamps without an offset are in
+    :returns: The seconds since the epoch, None for a blank value
+    :rtype: int
+    :raises ValueError: If the value is not a timestamp
+    """
+    if value is None or value == '':
+        return None
+    if isinstance(value, datetime):
+        return _epoch(value, zone)
+    if isinstance(value, (int, float)):
+        return int(value)
+
+    text = str(value).strip()
+    for fmt in formats:
+        try:
+            return _epoch(_parse_format(text, fmt), zone)
+        except ValueError:
+            pass
+    try:
+        return _epoch(parser.isoparse(text), zone)
+    except OverflowError as ex:
+        raise ValueError(f'Timestamp out of range: {text}') from ex
@@ -0,0 +1,344 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from datetime import datetime
+
+log = logging.getLogger(__name__)
+
+SNAPSHOT_PREFIX = 'aco_applications-'
+SNAPSHOT_SUFFIXES = ('.db', '.db.gz')
+
+# Copy buffer for compressing and decompressing snapshots
+CHUNK_SIZE = 1024 * 1024
+
+# Pages copied per step when restoring, and how often to report restore progress
+RESTORE_PAGES_PER_STEP = 1024
+PROGRESS_EVERY_BYTES = 16 * 1024 * 1024
+PROGRESS_EVERY_STATEMENTS = 10000
+
+
+class SnapshotVerificationError(Exception):
+    pass
+
+
+def _fsync_directory(path):
+    """
+    Makes a rename inside the directory durable. Not every platform can open a directory, so this is best effort.
+
+    :param str path: The directory
+    :returns: None
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _file_sha256(path):
+    """
+    :param str path: The file to hash
+    :returns: The hex sha256 of the file, read in chunks
+    :rtype: str
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def manifest_path(snapshot_path):
+    return f'{snapshot_path}.json'
+
+
+def _write_manifest(snapshot_path, sha256, size):
+    """
+    Writes the manifest next to the snapshot, through a temp file and rename.
+
+    :param str snapshot_path: The final snapshot path
+    :param str sha256: The hex sha256 of the snapshot file
+    :param int size: The snapshot file size in bytes
+    :returns: None
+    """
+    temp_path = f'{manifest_path(snapshot_path)}.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump({
+            'snapshot': os.path.basename(snapshot_path),
+            'sha256': sha256,
+            'size': size,
+            'created': datetime.now().isoformat(),
+        }, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, manifest_path(snapshot_path))
+
+
+def read_manifest(snapshot_path):
+    """
+    :param str snapshot_path: The snapshot path
+    :returns: The snapshot manifest, or None for a snapshot written without one
+    :rtype: dict
+    """
+    try:
+        with open(manifest_path(snapshot_path)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def list_snapshots(snapshot_dir):
+    """
+    Returns the snapshots in the folder, newest first. The timestamp in the file name sorts chronologically.
+
+    :param str snapshot_dir: The snapshot folder
+    :returns: The snapshot paths
+    :rtype: list[str]
+    """
+    if not os.path.isdir(snapshot_dir):
+        return []
+    names = [
+        name for name in os.listdir(snapshot_dir)
+        if name.startswith(SNAPSHOT_PREFIX) and name.endswith(SNAPSHOT_SUFFIXES)
+    ]
+    return [os.path.join(snapshot_dir, name) for name in sorted(names, reverse=True)]
+
+
+def rotate_snapshots(snapshot_dir, keep):
+    """
+    Deletes all but the newest snapshots.
+
+    :param str snapshot_dir: The snapshot folder
+    :param int keep: How many snapshots to keep
+    :returns: The deleted paths
+    :rtype: list[str]
+    """
+    removed = list_snapshots(snapshot_dir)[max(keep, 1):]
+    for path in removed:
+        os.remove(path)
+        if os.path.exists(manifest_path(path)):
+            os.remove(manifest_path(path))
+    return removed
+
+
+def take_snapshot(db_path, snapshot_dir, keep=10, compress=True):
+    """
+    Copies the live database with the sqlite online backup API on its own connection, so writers are only blocked
+    for the page copy. The copy is written to a temp file and renamed into place, so a snapshot on disk is always
+    complete, and it is only renamed once its checksum manifest is on disk.
+
+    :param str db_path: The live database
+    :param str snapshot_dir: The snapshot folder
+    :param int keep: How many snapshots to keep
+    :param bool compress: gzip the snapshot
+    :returns: The path of the new snapshot
+    :rtype: str
+    """
+    name = f'{SNAPSHOT_PREFIX}{datetime.now().strftime("%Y%m%dT%H%M%S%f")}.db{".gz" if compress else ""}'
+    final_path = os.path.join(snapshot_dir, name)
+
+    fd, temp_db = tempfile.mkstemp(prefix='.snapshot-', suffix='.db', dir=snapshot_dir)
+    os.close(fd)
+    temp_gz = None
+    try:
+        source = sqlite3.connect(db_path)
+        target = sqlite3.connect(temp_db)
+        try:
+            source.backup(target)
+        finally:
+            target.close()
+            source.close()
+
+        if compress:
+            temp_gz = f'{temp_db}.gz'
+            with open(temp_db, 'rb') as f_in, gzip.open(temp_gz, 'wb', compresslevel=6) as f_out:
+                shutil.copyfileobj(f_in, f_out, CHUNK_SIZE)
+            written = temp_gz
+        else:
+            written = temp_db
+
+        with open(written, 'rb+') as f:
+            os.fsync(f.fileno())
+        _write_manifest(final_path, _file_sha256(written), os.path.getsize(written))
+        os.replace(written, final_path)
+        _fsync_directory(snapshot_dir)
+    finally:
+        for path in (temp_db, temp_gz):
+            if path and os.path.exists(path):
+                os.remove(path)
+
+    rotate_snapshots(snapshot_dir, keep)
+    return final_path
+
+
+def _report_progress(label, done, total, started):
+    percent = f' ({done / total:.0%})' if total else ''
+    log.info(f'{label}: {done / (1024 * 1024):.1f} MiB{percent} after {time.monotonic() - started:.1f}s')
+
+
+def _extract_snapshot(path, work_dir, manifest):
+    """
+    Checks the snapshot against its manifest, then streams it into a plain sqlite temp file in chunks. Nothing is
+    decompressed, let alone applied, until the checksum matches.
+
+    :param str path: The snapshot path
+    :param str work_dir: Where to put the extracted copy
+    :param dict manifest: The snapshot manifest, if it has one
+    :returns: The extracted sqlite file path
+    :rtype: str
+    """
+    total = os.path.getsize(path)
+    if manifest is not None:
+        if total != manifest.get('size') or _file_sha256(path) != manifest.get('sha256'):
+            raise SnapshotVerificationError(f'Checksum does not match the manifest for {path}')
+
+    started = time.monotonic()
+    fd, temp_db = tempfile.mkstemp(prefix='.restore-', suffix='.db', dir=work_dir)
+    try:
+        with os.fdopen(fd, 'wb') as f_out, open(path, 'rb') as raw:
+            source = gzip.GzipFile(fileobj=raw, mode='rb') if path.endswith('.gz') else raw
+            next_report = PROGRESS_EVERY_BYTES
+            for chunk in iter(lambda: source.read(CHUNK_SIZE), b''):
+                f_out.write(chunk)
+                if raw.tell() >= next_report:
+                    _report_progress(f'Reading snapshot {os.path.basename(path)}', raw.tell(), total, started)
+                    next_report += PROGRESS_EVERY_BYTES
+        return temp_db
+    except BaseException:
+        os.remove(temp_db)
+        raise
+
+
+def _is_valid_snapshot(conn):
+    """
+    Checks the snapshot is a readable database holding the applications table.
+
+    :param sqlite3.Connection conn: The snapshot connection
+    :rtype: bool
+    """
+    if conn.execute("PRAGMA quick_check").fetchone()[0] != 'ok':
+        return False
+    return bool(conn.execute(
+        "SELECT count(name) FROM sqlite_master WHERE TYPE = 'table' AND name = 'acoapplications'"
+    ).fetchone()[0])
+
+
+def _restore_snapshot(path, conn, work_dir, manifest):
+    """
+    Verifies one snapshot and copies it into the connection a step of pages at a time.
+
+    :returns: None
+    """
+    snapshot_file = _extract_snapshot(path, work_dir, manifest)
+    try:
+        # Snapshots of the WAL mode database are WAL mode too. The extracted copy is private and never written, so it
+        # is opened immutable, which reads it without creating -wal and -shm files next to it.
+        snapshot = sqlite3.connect(f'file:{snapshot_file}?mode=ro&immutable=1', uri=True)
+        try:
+            if not _is_valid_snapshot(snapshot):
+                raise SnapshotVerificationError(f'Snapshot {path} failed the integrity check')
+
+            started = time.monotonic()
+
+            def _progress(status, remaining, total):
+                if total and (total - remaining) % (RESTORE_PAGES_PER_STEP * 16) == 0:
+                    log.info(f'Restoring {os.path.basename(path)}: {total - remaining}/{total} pages '
+                             f'after {time.monotonic() - started:.1f}s')
+
+            snapshot.backup(conn, pages=RESTORE_PAGES_PER_STEP, progress=_progress)
+        finally:
+            snapshot.close()
+    finally:
+        for leftover in (snapshot_file, f'{snapshot_file}-wal', f'{snapshot_file}-shm'):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+
+def restore_latest_snapshot(conn, snapshot_dir):
+    """
+    Restores the newest valid snapshot into the connection, falling back to older snapshots when one is damaged.
+    Snapshots with a manifest are checksum verified first. Snapshots written before manifests existed are only used
+    when none of the verified ones can be.
+
+    :param sqlite3.Connection conn: The live database connection to overwrite
+    :param str snapshot_dir: The snapshot folder
+    :returns: The snapshot restored, or None if there was no usable snapshot
+    :rtype: str
+    """
+    snapshots = [(path, read_manifest(path)) for path in list_snapshots(snapshot_dir)]
+    verified = [snapshot for snapshot in snapshots if snapshot[1] is not None]
+    unverified = [snapshot for snapshot in snapshots if snapshot[1] is None]
+
+    for path, manifest in verified + unverified:
+        if manifest is None:
+            log.warning(f'Snapshot {path} has no manifest, restoring it without a checksum')
+        started = time.monotonic()
+        try:
+            _restore_snapshot(path, conn, snapshot_dir, manifest)
+        except (OSError, EOFError, sqlite3.DatabaseError, SnapshotVerificationError) as ex:
+            log.warning(f'Snapshot {path} could not be restored, trying an older one: {ex}')
+            continue
+        log.info(f'Restored {path} in {time.monotonic() - started:.2f}s')
+        return path
+    return None
+
+
+def _iter_sql_statements(f):
+    """
+    Yields complete SQL statements from a dump file, reading it in chunks. iterdump output was written without line
+    breaks, so statements are split on semicolons that sqlite agrees end a statement.
+
+    :param file f: The open dump file
+    :returns: Generator of SQL statements
+    """
+    buffer = ''
+    for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+        buffer += chunk
+        start = 0
+        end = buffer.find(';')
+        while end != -1:
+            if sqlite3.complete_statement(buffer[start:end + 1]):
+                yield buffer[start:end + 1]
+                start = end + 1
+            end = buffer.find(';', end + 1)
+        buffer = buffer[start:]
+    if buffer.strip():
+        yield buffer
+
+
+def restore_sql_dump(conn, dump_path):
+    """
+    Replays an SQL dump into the connection one statement at a time, so the dump never has to fit in memory.
+
+    :param sqlite3.Connection conn: The live database connection
+    :param str dump_path: The SQL dump path
+    :returns: The number of statements applied
+    :rtype: int
+    """
+    total = os.path.getsize(dump_path)
+    started = time.monotonic()
+    count = 0
+    done = 0
+    with open(dump_path) as f:
+        for statement in _iter_sql_statements(f):
+            conn.execute(statement)
+            count += 1
+            # Characters rather than bytes, but close enough for a progress report
+            done += len(statement)
+            if count % PROGRESS_EVERY_STATEMENTS == 0:
+                _report_progress(f'Replaying {os.path.basename(dump_path)}', done, total, started)
+    if conn.in_transaction:
+        conn.commit()
+    log.info(f'Replayed {count} statements from {dump_path} in {time.monotonic() - started:.2f}s')
+    return count
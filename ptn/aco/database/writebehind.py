@@ -0,0 +1,250 @@
+import asyncio
+import logging
+from datetime import datetime, timezone
+
+from ptn.aco.constants import get_write_behind_interval, get_write_behind_max_pending
+from ptn.aco.database.database import affiliator_service
+from ptn.aco.database.normalise import username_key, timestamp_epoch
+
+log = logging.getLogger(__name__)
+
+
+def claim_tracked_rows(affiliator_db, members):
+    """
+    Stamps the member ID on rows tracked from before member IDs were stored, matched on the username they were
+    tracked under, unless the member already has a row of their own.
+
+    :param sqlite3.Cursor affiliator_db: The transaction cursor
+    :param list[tuple] members: (member ID, username key) for each member
+    :returns: None
+    """
+    affiliator_db.executemany('''
+        UPDATE membertracking SET member_id = ?1
+        WHERE member_id IS NULL AND username_key = ?2
+        AND NOT EXISTS (SELECT 1 FROM membertracking WHERE member_id = ?1)
+    ''', members)
+
+
+def track_members(affiliator_db, members, insert=True):
+    """
+    Brings the tracked rows of the members up to date with their current usernames, keeping their tracking dates,
+    and starts tracking those without a row. Rows are matched on the member ID, so a member who renamed keeps the
+    date they got the member role.
+
+    A row of someone else still holding one of the usernames, who must have renamed since, loses the username rather
+    than the row. Each statement runs for every member before the next, so members swapping names do not clash on the
+    unique username.
+
+    :param sqlite3.Cursor affiliator_db: The transaction cursor
+    :param list[tuple] members: (member ID, discord username, date) for each member, the date used for new rows
+    :param bool insert: Start tracking members without a row, otherwise only existing rows are renamed
+    :returns: The number of members inserted
+    :rtype: int
+    """
+    if not members:
+        return 0
+    keyed = [(member_id, username, username_key(username), date) for member_id, username, date in members]
+    claim_tracked_rows(affiliator_db, [(member_id, key) for member_id, _, key, _ in keyed])
+    affiliator_db.executemany('''
+        UPDATE membertracking SET discord_username = NULL, username_key = NULL
+        WHERE username_key = ?2 AND member_id IS NOT ?1
+    ''', [(member_id, key) for member_id, _, key, _ in keyed])
+    affiliator_db.executemany('''
+        UPDATE membertracking SET discord_username = ?2, username_key = ?3
+        WHERE member_id = ?1 AND discord_username IS NOT ?2
+    ''', [(member_id, username, key) for member_id, username, key, _ in keyed])
+    if not insert:
+        return 0
+    # A member already tracked keeps their original date
+    return affiliator_db.executemany('''
+        INSERT OR IGNORE INTO membertracking(member_id, discord_username, username_key, date, date_epoch)
+        SELECT ?1, ?2, ?3, ?4, ?5 WHERE NOT EXISTS (SELECT 1 FROM membertracking WHERE member_id = ?1)
+    ''', [
+        (member_id, username, key, date, timestamp_epoch(date)) for member_id, username, key, date in keyed
+    ]).rowcount
+
+
+def _apply_membertracking_writes(affiliator_db, deletes, inserts):
+    """
+    Writes a batch of member tracking changes. Deletes go first, so a member who lost and regained the role is tracked
+    again from when they regained it.
+
+    :param sqlite3.Cursor affiliator_db: The transaction cursor
+    :param list[tuple] deletes: (member ID, username key) for each member to stop tracking
+    :param list[tuple] inserts: (member ID, discord username, date) for each member to start tracking
+    :returns: The number of members deleted and inserted
+    :rtype: tuple[int, int]
+    """
+    # Rows tracked before member IDs were stored are matched on the username
+    deleted = affiliator_db.executemany(
+        "DELETE FROM membertracking WHERE member_id = ?1 OR (member_id IS NULL AND username_key = ?2)", deletes
+    ).rowcount if deletes else 0
+    inserted = track_members(affiliator_db, inserts)
+    return deleted, inserted
+
+
+def _rename_membertracking(affiliator_db, member_id, before, after):
+    """
+    Renames the tracked row of a member who changed username, claiming a row tracked under the old username first.
+    """
+    claim_tracked_rows(affiliator_db, [(member_id, username_key(before))])
+    track_members(affiliator_db, [(member_id, after, None)], insert=False)
+
+
+class MemberTrackingWriter:
+
+    def __init__(self, db, flush_interval, max_pending):
+        """
+        Write-behind buffer for the member tracking changes from role updates. Changes are held in memory, coalesced
+        per member, and written together in one transaction once they have waited flush_interval seconds or
+        max_pending members have changes, so a burst of role changes costs a handful of commits rather than one each.
+
+        :param AffiliatorDatabase db: The database service
+        :param float flush_interval: The most seconds a change is held before it is written
+        :param int max_pending: How many members with pending changes force an early write
+        """
+        self.db = db
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        # member ID -> [discord username to delete first or None, (discord username, date) to insert or None]
+        self._pending = {}
+        self._event = None
+        self._lock = None
+        self._task = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _merge(self, member_id, delete, insert):
+        """
+        Folds a change into whatever is already pending for the member, as if both were applied in order.
+        """
+        pending = self._pending.get(member_id)
+        if pending is None:
+            self._pending[member_id] = [delete, insert]
+        elif delete:
+            pending[0], pending[1] = delete, insert
+        elif pending[1] is None:
+            pending[1] = insert
+
+    def add(self, member_id, username, date=None):
+        """
+        Starts tracking a member who gained the member role.
+
+        :param int member_id: The member ID
+        :param str username: Their name#discriminator
+        :param datetime date: When they gained the role, defaults to now
+        :returns: None
+        """
+        self._merge(member_id, None, (str(username), date or datetime.now(timezone.utc)))
+        self._schedule()
+
+    def remove(self, member_id, username):
+        """
+        Stops tracking a member who lost the member role.
+
+        :param int member_id: The member ID
+        :param str username: Their name#discriminator, for rows tracked before member IDs were stored
+        :returns: None
+        """
+        self._merge(member_id, str(username), None)
+        self._schedule()
+
+    async def rename(self, member_id, before, after):
+        """
+        Renames the tracked row of a member who changed username, so they keep their tracking date. Pending changes
+        are written first, so one for the member is not written under the old username afterwards.
+
+        :param int member_id: The member ID
+        :param str before: Their old name#discriminator
+        :param str after: Their new name#discriminator
+        :returns: None
+        """
+        await self.flush()
+        await self.db.transaction(_rename_membertracking, member_id, str(before), str(after))
+
+    def export_pending(self):
+        """
+        :returns: The changes not yet written, as [member ID, discord username to delete, discord username to insert,
+            ISO date], the last two None when there is nothing to insert
+        :rtype: list[list]
+        """
+        return [
+            [member_id, delete, insert[0], insert[1].isoformat()] if insert is not None
+            else [member_id, delete, None, None]
+            for member_id, (delete, insert) in self._pending.items()
+        ]
+
+    def restore_pending(self, pending):
+        """
+        Queues the changes carried over a restart, merged under anything already pending.
+
+        :param list[list] pending: As returned by export_pending
+        :returns: None
+        """
+        newer, self._pending = self._pending, {}
+        for member_id, delete, username, date in pending:
+            self._merge(member_id, delete, (username, datetime.fromisoformat(date)) if username is not None else None)
+        for member_id, (delete, insert) in newer.items():
+            self._merge(member_id, delete, insert)
+        if self._pending:
+            log.info('Restored member tracking changes from before the restart', extra={'members': len(pending)})
+            self._schedule()
+
+    def _schedule(self):
+        if self._event is None:
+            self._event = asyncio.Event()
+        if len(self._pending) >= self.max_pending:
+            self._event.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._flush_soon())
+
+    async def _flush_soon(self):
+        try:
+            await asyncio.wait_for(self._event.wait(), self.flush_interval)
+        except asyncio.TimeoutError:
+            pass
+        self._event.clear()
+        try:
+            await self.flush()
+        except Exception:
+            log.exception('Failed writing the member tracking changes, they will be retried')
+        finally:
+            self._task = None
+            if self._pending:
+                self._schedule()
+
+    async def flush(self):
+        """
+        Writes every pending change now. Call it before reading membertracking and before shutting down.
+
+        :returns: The number of members whose changes were written
+        :rtype: int
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            batch, self._pending = self._pending, {}
+            if not batch:
+                return 0
+
+            deletes = [(member_id, username_key(delete)) for member_id, (delete, _) in batch.items() if delete]
+            inserts = [(member_id, *insert) for member_id, (_, insert) in batch.items() if insert is not None]
+            try:
+                deleted, inserted = await self.db.transaction(_apply_membertracking_writes, deletes, inserts)
+            except BaseException:
+                # Put the batch back under anything that changed while it was being written
+                newer, self._pending = self._pending, {}
+                for member_id, (delete, insert) in list(batch.items()) + list(newer.items()):
+                    self._merge(member_id, delete, insert)
+                raise
+
+            log.info('Wrote member tracking changes', extra={
+                'members': len(batch), 'removed': deleted, 'added': inserted, 'already_tracked': len(inserts) - inserted
+            })
+            return len(batch)
+
+
+membertracking_writes = MemberTrackingWriter(
+    affiliator_service, get_write_behind_interval(), get_write_behind_max_pending()
+)
@@ -0,0 +1,63 @@
+from collections import Counter
+
+# Gateway events seen by the listeners and how many were dropped before doing any work, keyed by event.outcome
+event_counts = Counter()
+
+
+def member_update_changes(before, after, guild_id, member_role_id):
+    """
+    Cheap pre-filter for on_member_update, run before anything resolves roles or touches the database. Compares the
+    raw role ID arrays discord.py keeps on each member rather than building role lists, and counts the outcome.
+
+    Only the nickname is compared. discord.py shares the user between before and after and renames it before the
+    member update is dispatched, so username and discriminator changes never show here, they arrive as on_user_update.
+
+    :param discord.Member before: The member before the update
+    :param discord.Member after: The member after the update
+    :param int guild_id: The bot guild ID
+    :param int member_role_id: The member role ID
+    :returns: Whether the nickname changed and whether the member role changed
+    :rtype: tuple[bool, bool]
+    """
+    event_counts['member_update.received'] += 1
+    if after.guild.id != guild_id:
+        event_counts['member_update.dropped_other_guild'] += 1
+        return False, False
+
+    nick_changed = before.nick != after.nick
+    # _roles is the sorted array of role IDs, so an unchanged role set is a single array compare
+    role_changed = before._roles != after._roles \
+        and before._roles.has(member_role_id) != after._roles.has(member_role_id)
+
+    if nick_changed:
+        event_counts['member_update.nick_changed'] += 1
+    if role_changed:
+        event_counts['member_update.member_role_changed'] += 1
+    if not nick_changed and not role_changed:
+        event_counts['member_update.dropped_unchanged'] += 1
+    return nick_changed, role_changed
+
+
+def user_update_changes(before, after):
+    """
+    Cheap pre-filter for on_user_update, which also fires for avatar and flag changes.
+
+    :param discord.User before: The user before the update
+    :param discord.User after: The user after the update
+    :returns: Whether the username or discriminator changed
+    :rtype: bool
+    """
+    event_counts['user_update.received'] += 1
+    if before.name == after.name and before.discriminator == after.discriminator:
+        event_counts['user_update.dropped_unchanged'] += 1
+        return False
+    event_counts['user_update.names_changed'] += 1
+    return True
+
+
+def summarise_event_counts():
+    """
+    :returns: A line per counter, for logging or posting
+    :rtype: str
+    """
+    return '\n'.join(f'{name}: {count}' for name, count in sorted(event_counts.items())) or 'No events counted yet'
@@ -0,0 +1,125 @@
+import atexit
+import copy
+import logging
+import logging.handlers
+import os
+import queue
+
+# Attributes every LogRecord has, anything else on a record came in through extra= and is logged as key=value
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+# Loggers that are too chatty at INFO unless asked for
+DEFAULT_MODULE_LEVELS = {
+    'discord': logging.WARNING,
+}
+
+_listener = None
+
+
+def _format_value(value):
+    text = str(value)
+    if not text or any(char.isspace() or char in '"=' for char in text):
+        text = '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
+    return text
+
+
+class KeyValueFormatter(logging.Formatter):
+
+    def __init__(self):
+        """
+        Formats records as a single line of timestamp, level, logger and message, followed by any structured fields
+        passed through extra= as key=value pairs.
+        """
+        super().__init__(fmt='%(asctime)s %(levelname)s %(name)s %(message)s', datefmt='%Y-%m-%dT%H:%M:%S')
+
+    def formatMessage(self, record):
+        # Fields go on the message line, ahead of any traceback
+        line = super().formatMessage(record)
+        fields = ' '.join(
+            f'{key}={_format_value(value)}' for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES
+        )
+        return f'{line} {fields}' if fields else line
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+
+    def prepare(self, record):
+        # Resolve the message and traceback while the exception still exists, but leave the layout to the listener
+        # so the structured fields stay ahead of the traceback
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def parse_module_levels(spec):
+    """
+    Parses per module levels, e.g. 'ptn.aco.database=DEBUG,discord=INFO'.
+
+    :param str spec: Comma separated logger=level pairs
+    :returns: The levels keyed by logger name
+    :rtype: dict[str, int]
+    """
+    levels = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        name, _, level = item.partition('=')
+        levels[name.strip()] = logging.getLevelName(level.strip().upper())
+        if not isinstance(levels[name.strip()], int):
+            raise ValueError(f'Unknown log level in ACO_LOG_LEVELS: {item}')
+    return levels
+
+
+def configure_logging(level='INFO', module_levels='', log_file=None):
+    """
+    Sends all logging through a queue to a listener thread, which does the console and file writes, so logging from
+    the event loop or the database thread never waits on I/O. Safe to call more than once, the last call wins.
+
+    :param str level: The root log level
+    :param str module_levels: Per module overrides, see parse_module_levels
+    :param str log_file: Also write to this file, rotated at 10 MiB, when given
+    :returns: None
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+
+    formatter = KeyValueFormatter()
+    handlers = [logging.StreamHandler()]
+    if log_file:
+        os.makedirs(os.path.dirname(log_file), exist_ok=True)
+        handlers.append(logging.handlers.RotatingFileHandler(
+            log_file, maxBytes=10 * 1024 * 1024, backupCount=5, encoding='utf-8'
+        ))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_QueueHandler(log_queue))
+    root.setLevel(level.upper())
+
+    for name, module_level in {**DEFAULT_MODULE_LEVELS, **parse_module_levels(module_levels)}.items():
+        logging.getLogger(name).setLevel(module_level)
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+
+
+def stop_logging():
+    """
+    Writes out anything still queued and stops the listener thread.
+
+    :returns: None
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(stop_logging)
@@ -0,0 +1,313 @@
+import logging
+import time
+from collections import OrderedDict
+
+from ptn.aco.constants import get_member_role_id, is_lean_member_cache, get_member_lookup_cache_size, \
+    get_member_lookup_cache_ttl
+
+log = logging.getLogger(__name__)
+
+# Most members a name lookup asks discord for, its own limit
+QUERY_MEMBERS_LIMIT = 100
+
+
+class MemberDirectory:
+
+    def __init__(self, member_role_id):
+        """
+        Index of the guild members by name#discriminator, name and display name, so looking up an applicant is a dict
+        lookup rather than a scan of every member. Built once the guild is ready and then kept current from the
+        member join, leave and update events. Also holds the member role, so it is not searched for on every lookup.
+
+        :param int member_role_id: The member role ID
+        """
+        self.member_role_id = member_role_id
+        self.member_role = None  #: discord.Role
+        self.guild = None  #: discord.Guild
+        self._by_tag = {}
+        self._by_name = {}
+        self._by_display_name = {}
+        # The keys each member is indexed under, so they can be removed when the member changes
+        self._keys = {}
+        self.indexed = False
+        # IDs of the member role holders, only kept without a member cache, to spot role changes from raw events
+        self.role_holder_ids = set()
+
+    def __len__(self):
+        return len(self._keys)
+
+    @staticmethod
+    def _index(index, key, member):
+        index.setdefault(key, {})[member.id] = member
+
+    @staticmethod
+    def _unindex(index, key, member_id):
+        members = index.get(key)
+        if members is not None:
+            members.pop(member_id, None)
+            if not members:
+                del index[key]
+
+    def build(self, guild, index_members=True):
+        """
+        Indexes every member of the guild.
+
+        :param discord.Guild guild: The guild
+        :param bool index_members: Index the cached members, off when there is no member cache to index
+        :returns: None
+        """
+        self.guild = guild
+        self.refresh_role()
+        self._by_tag, self._by_name, self._by_display_name, self._keys = {}, {}, {}, {}
+        self.indexed = index_members
+        if index_members:
+            for member in guild.members:
+                self.add(member)
+            log.info(f'Member directory built with {len(self)} members')
+        else:
+            log.info('Member directory not indexed, members are looked up on demand')
+
+    def refresh_role(self):
+        """
+        Looks the member role up again, for when roles change.
+
+        :returns: None
+        """
+        if self.guild is not None:
+            self.member_role = self.guild.get_role(self.member_role_id)
+
+    def add(self, member):
+        """
+        :param discord.Member member: The member to index
+        :returns: None
+        """
+        self.remove(member)
+        keys = (str(member), member.name, member.display_name)
+        self._index(self._by_tag, keys[0], member)
+        self._index(self._by_name, keys[1], member)
+        self._index(self._by_display_name, keys[2], member)
+        self._keys[member.id] = keys
+
+    def remove(self, member):
+        """
+        :param discord.Member member: The member to drop from the index
+        :returns: None
+        """
+        keys = self._keys.pop(member.id, None)
+        if keys:
+            self._unindex(self._by_tag, keys[0], member.id)
+            self._unindex(self._by_name, keys[1], member.id)
+            self._unindex(self._by_display_name, keys[2], member.id)
+
+    def get_member_named(self, name):
+        """
+        Matches like discord.Guild.get_member_named, first on name#discriminator, then name, then nickname.
+
+        :param str name: The name to look for
+        :returns: The member, or None
+        :rtype: discord.Member
+        """
+        if self.guild is None:
+            return None
+
+        for index in (self._by_tag, self._by_name, self._by_display_name):
+            members = index.get(name)
+            if members:
+                return next(iter(members.values()))
+        return None
+
+    def has_member_role(self, member):
+        """
+        :param discord.Member member: The member to check
+        :rtype: bool
+        """
+        if self.member_role is None:
+            self.refresh_role()
+        return self.member_role in member.roles
+
+
+member_directory = MemberDirectory(get_member_role_id())
+
+
+def _match_named(members, name):
+    """
+    Picks the member matching the name the way discord.Guild.get_member_named does.
+
+    :param list[discord.Member] members: The candidates
+    :param str name: The name to look for
+    :returns: The member, or None
+    :rtype: discord.Member
+    """
+    for key in (str, lambda member: member.name, lambda member: member.display_name):
+        for member in members:
+            if key(member) == name:
+                return member
+    return None
+
+
+class MemberLookupCache:
+
+    def __init__(self, max_size, ttl):
+        """
+        Size bounded LRU of member lookups by name, used when the bot keeps no member cache. Misses are cached too,
+        so repeated lookups of someone who is not in the guild do not each go to discord. Entries expire after the
+        TTL and are dropped as soon as the member they name changes.
+
+        :param int max_size: The most names kept
+        :param float ttl: Seconds an entry is kept
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        # name -> (expiry, member or None)
+        self._entries = OrderedDict()
+        # member ID -> names the member is cached under
+        self._names_by_id = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _drop(self, name):
+        _, member = self._entries.pop(name)
+        if member is not None:
+            names = self._names_by_id.get(member.id)
+            if names is not None:
+                names.discard(name)
+                if not names:
+                    del self._names_by_id[member.id]
+
+    def get(self, name):
+        """
+        :param str name: The name looked up
+        :returns: Whether the name is cached, and the member, which is None for a cached miss
+        :rtype: tuple[bool, discord.Member]
+        """
+        entry = self._entries.get(name)
+        if entry is None:
+            return False, None
+        if entry[0] < time.monotonic():
+            self._drop(name)
+            return False, None
+        self._entries.move_to_end(name)
+        return True, entry[1]
+
+    def put(self, name, member):
+        """
+        :param str name: The name looked up
+        :param discord.Member member: The member found, or None if there was no match
+        :returns: None
+        """
+        if name in self._entries:
+            self._drop(name)
+        self._entries[name] = (time.monotonic() + self.ttl, member)
+        if member is not None:
+            self._names_by_id.setdefault(member.id, set()).add(name)
+        while len(self._entries) > self.max_size:
+            self._drop(next(iter(self._entries)))
+
+    def invalidate_member(self, member_id):
+        """
+        Drops the entries for a member, for when their roles or names change.
+
+        :param int member_id: The member ID
+        :returns: None
+        """
+        for name in list(self._names_by_id.get(member_id, ())):
+            self._drop(name)
+
+    def invalidate_names(self, *names):
+        """
+        Drops the entries for the names, for when someone who may have been cached as a miss joins.
+
+        :returns: None
+        """
+        for name in names:
+            if name in self._entries:
+                self._drop(name)
+
+    def export_misses(self):
+        """
+        :returns: The names cached as not in the guild, with when each expires as a timestamp. Members themselves are
+            not kept, they cannot be rebuilt without asking discord again.
+        :rtype: dict[str, float]
+        """
+        now, wall_clock = time.monotonic(), time.time()
+        return {
+            name: wall_clock + expiry - now for name, (expiry, member) in self._entries.items()
+            if member is None and expiry > now
+        }
+
+    def restore_misses(self, misses):
+        """
+        Caches the names again as not in the guild, for whatever is left of their TTL.
+
+        :param dict[str, float] misses: As returned by export_misses
+        :returns: None
+        """
+        now, wall_clock = time.monotonic(), time.time()
+        for name, expires in misses.items():
+            remaining = min(expires - wall_clock, self.ttl)
+            if remaining > 0 and name not in self._entries:
+                self._entries[name] = (now + remaining, None)
+        while len(self._entries) > self.max_size:
+            self._drop(next(iter(self._entries)))
+
+    async def lookup(self, guild, name):
+        """
+        Looks a member up by name, through the cache and then discord's member search.
+
+        :param discord.Guild guild: The guild
+        :param str name: The name to look for
+        :returns: The member, or None
+        :rtype: discord.Member
+        """
+        cached, member = self.get(name)
+        if cached:
+            self.hits += 1
+            return member
+
+        self.misses += 1
+        # The search matches the start of usernames, so drop any #discriminator
+        query = name[:-5] if len(name) > 5 and name[-5] == '#' and name[-4:].isdigit() else name
+        members = await guild.query_members(query=query, limit=QUERY_MEMBERS_LIMIT, cache=False)
+        member = _match_named(members, name)
+        self.put(name, member)
+        return member
+
+
+member_lookup_cache = MemberLookupCache(get_member_lookup_cache_size(), get_member_lookup_cache_ttl())
+
+
+async def find_member(guild, name):
+    """
+    Looks a member up by name through the directory, falling back to the guild when it is not built yet, and to the
+    lookup cache and discord when there is no member cache.
+
+    :param discord.Guild guild: The guild
+    :param str name: The name to look for
+    :returns: The member, or None
+    :rtype: discord.Member
+    """
+    if member_directory.guild is guild and member_directory.indexed:
+        return member_directory.get_member_named(name)
+    member = guild.get_member_named(name)
+    if member is None and is_lean_member_cache():
+        member = await member_lookup_cache.lookup(guild, name)
+    return member
+
+
+async def member_role_holders(guild, role_id):
+    """
+    Returns the members holding the role. Without a member cache they are paged in from discord, so this is slow on a
+    large guild and only meant for reconciliation.
+
+    :param discord.Guild guild: The guild
+    :param int role_id: The role ID
+    :rtype: list[discord.Member]
+    """
+    if not is_lean_member_cache():
+        role = guild.get_role(role_id)
+        return role.members if role is not None else []
+    return [member async for member in guild.fetch_members(limit=None) if member._roles.has(role_id)]
+
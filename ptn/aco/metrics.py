@@ -0,0 +1,234 @@
+import functools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from aiohttp import web
+
+from ptn.aco.constants import get_metrics_host, get_metrics_port
+from ptn.aco.events import event_counts
+
+log = logging.getLogger(__name__)
+
+# Latency buckets in seconds, from a fast sqlite query up to a slow scan
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _label_text(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+class Counter:
+
+    def __init__(self, name, documentation):
+        """
+        A monotonically increasing count, optionally split by labels.
+
+        :param str name: The metric name
+        :param str documentation: The help text
+        """
+        self.name = name
+        self.documentation = documentation
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def total(self):
+        return sum(self._values.values())
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_label_text(labels)} {value}')
+        return lines
+
+
+class Histogram:
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        """
+        Counts observations into cumulative buckets, optionally split by labels.
+
+        :param str name: The metric name
+        :param str documentation: The help text
+        :param tuple buckets: The bucket upper bounds, ascending
+        """
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        # labels -> [bucket counts..., sum, count]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * (len(self.buckets) + 2)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[index] += 1
+                    break
+            state[-2] += value
+            state[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observes how long the block took, whether or not it raised.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def timed(self, **labels):
+        """
+        Decorates a coroutine function to observe how long each call takes.
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with self.time(**labels):
+                    return await func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def summary(self):
+        """
+        :returns: The observation count and sum per label set
+        :rtype: dict[tuple, tuple[int, float]]
+        """
+        with self._lock:
+            return {labels: (state[-1], state[-2]) for labels, state in self._values.items()}
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for labels, state in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, state):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{_label_text(labels + (("le", bound),))} {cumulative}')
+                lines.append(f'{self.name}_bucket{_label_text(labels + (("le", "+Inf"),))} {state[-1]}')
+                lines.append(f'{self.name}_sum{_label_text(labels)} {state[-2]}')
+                lines.append(f'{self.name}_count{_label_text(labels)} {state[-1]}')
+        return lines
+
+
+scan_duration = Histogram('aco_scan_duration_seconds', 'Time taken by each scan of the tracking form')
+scan_stage_duration = Histogram(
+    'aco_scan_stage_duration_seconds', 'Time taken by each scan stage per page of the form'
+)
+scan_rows_fetched = Counter('aco_scan_rows_fetched_total', 'Form rows read by scans')
+scan_rows_new = Counter('aco_scan_rows_new_total', 'Form rows found to be new applications')
+db_latency = Histogram('aco_db_query_duration_seconds', 'Database call latency including the wait for the worker')
+snapshot_duration = Histogram('aco_snapshot_duration_seconds', 'Time taken to write each database snapshot')
+discord_latency = Histogram('aco_discord_request_duration_seconds', 'Discord REST request latency')
+discord_rate_limits = Counter('aco_discord_rate_limits_total', 'Discord 429 responses')
+
+METRICS = (
+    scan_duration, scan_stage_duration, scan_rows_fetched, scan_rows_new, db_latency, snapshot_duration, discord_latency,
+    discord_rate_limits
+)
+
+
+def _render_event_counts():
+    lines = ['# HELP aco_gateway_events_total Gateway events by listener and what the early filter did with them',
+             '# TYPE aco_gateway_events_total counter']
+    for key, count in sorted(event_counts.items()):
+        event, _, outcome = key.partition('.')
+        lines.append(f'aco_gateway_events_total{_label_text((("event", event), ("outcome", outcome)))} {count}')
+    return lines
+
+
+def render_metrics():
+    """
+    :returns: Every metric in the Prometheus text exposition format
+    :rtype: str
+    """
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    lines.extend(_render_event_counts())
+    return '\n'.join(lines) + '\n'
+
+
+class _RateLimitCounter(logging.Handler):
+
+    def emit(self, record):
+        # discord.py logs a warning for each 429 it waits out
+        if record.levelno >= logging.WARNING and 'rate limit' in record.getMessage().lower():
+            discord_rate_limits.inc(source='discord.py')
+
+
+def instrument_discord(client):
+    """
+    Times every REST request discord.py makes and counts the 429s it handles. Requests are labelled with the route
+    template, such as /channels/{channel_id}/messages, so the label count stays bounded.
+
+    :param discord.Client client: The bot
+    :returns: None
+    """
+    http = client.http
+    if getattr(http.request, 'instrumented', False):
+        return
+    request = http.request
+
+    @functools.wraps(request)
+    async def _timed_request(route, **kwargs):
+        with discord_latency.time(method=route.method, route=route.path):
+            return await request(route, **kwargs)
+
+    _timed_request.instrumented = True
+    http.request = _timed_request
+    logging.getLogger('discord.http').addHandler(_RateLimitCounter(logging.WARNING))
+
+
+class MetricsServer:
+
+    def __init__(self, host, port):
+        """
+        Serves the metrics for Prometheus to scrape on /metrics.
+
+        :param str host: The address to listen on
+        :param int port: The port, 0 disables the endpoint
+        """
+        self.host = host
+        self.port = port
+        self._runner = None
+
+    async def _handle_metrics(self, request):
+        return web.Response(text=render_metrics(), content_type='text/plain', charset='utf-8')
+
+    async def start(self):
+        if self._runner is not None or not self.port:
+            return
+        app = web.Application()
+        app.router.add_get('/metrics', self._handle_metrics)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        log.info('Serving metrics', extra={'host': self.host, 'port': self.port})
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+metrics_server = MetricsServer(get_metrics_host(), get_metrics_port())
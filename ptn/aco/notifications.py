@@ -0,0 +1,111 @@
+import asyncio
+import logging
+
+from discord import HTTPException
+
+from ptn.aco.metrics import discord_rate_limits
+
+log = logging.getLogger(__name__)
+
+VOTE_REACTIONS = ('👍', '👎')
+
+
+class NotificationDispatcher:
+
+    def __init__(self, max_concurrency=4, max_retries=3):
+        """
+        Posts application embeds for voting. Messages go out in order, while the vote reactions for messages already
+        sent are added concurrently, so reactions no longer hold up the next message. discord.py already waits out
+        rate limits per route, this adds a bound on the calls in flight and a retry for any 429 that still gets
+        through.
+
+        :param int max_concurrency: The most reaction calls in flight at once
+        :param int max_retries: How many times to retry a call that was rate limited
+        """
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self._semaphore = None
+
+    @property
+    def semaphore(self):
+        # Created on first use so it binds to the running loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    async def _call(self, func, *args, **kwargs):
+        """
+        Runs a discord call, retrying when it is rate limited.
+
+        :returns: Whatever the call returns
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await func(*args, **kwargs)
+            except HTTPException as ex:
+                if ex.status != 429 or attempt == self.max_retries:
+                    raise
+                retry_after = getattr(ex, 'retry_after', None) or 2 ** attempt
+                log.warning('Rate limited by discord', extra={'retry_after': retry_after, 'attempt': attempt + 1})
+                discord_rate_limits.inc(source='dispatcher')
+                await asyncio.sleep(retry_after)
+
+    async def _add_reactions(self, message, reactions):
+        # Reactions on one message are added in order so they display in order
+        async with self.semaphore:
+            for reaction in reactions:
+                await self._call(message.add_reaction, reaction)
+
+    async def send(self, channel, content=None, embed=None, reactions=()):
+        """
+        Sends one message and adds its reactions.
+
+        :param discord.TextChannel channel: Where to send it
+        :param str content: The message text
+        :param discord.Embed embed: The message embed
+        :param tuple reactions: Reactions to add to the message
+        :returns: The message
+        :rtype: discord.Message
+        """
+        message = await self._call(channel.send, content=content, embed=embed)
+        if reactions:
+            await self._add_reactions(message, reactions)
+        return message
+
+    def add_reactions(self, message, reactions=VOTE_REACTIONS):
+        """
+        Adds the reactions in the background.
+
+        :param discord.Message message: The message to react to
+        :param tuple reactions: The reactions to add
+        :returns: The task adding them
+        :rtype: asyncio.Task
+        """
+        return asyncio.ensure_future(self._add_reactions(message, reactions))
+
+    async def post_for_vote(self, channel, embeds, reactions=VOTE_REACTIONS, on_posted=None):
+        """
+        Posts each embed as its own message, so each can be voted on, and pipelines the vote reactions.
+
+        :param discord.TextChannel channel: Where to post them
+        :param list[discord.Embed] embeds: The embeds to post
+        :param tuple reactions: The vote reactions to add to each message
+        :param coroutine function on_posted: Awaited with (index, message) as soon as each message is posted
+        :returns: The messages, in the same order as the embeds
+        :rtype: list[discord.Message]
+        """
+        messages = []
+        reaction_tasks = []
+        try:
+            for index, embed in enumerate(embeds):
+                message = await self._call(channel.send, embed=embed)
+                messages.append(message)
+                reaction_tasks.append(self.add_reactions(message, reactions))
+                if on_posted:
+                    await on_posted(index, message)
+        finally:
+            # A failed reaction should not lose the messages already posted, so just log them
+            for result in await asyncio.gather(*reaction_tasks, return_exceptions=True):
+                if isinstance(result, Exception):
+                    log.error('Failed adding the vote reactions', extra={'error': result})
+        return messages
@@ -0,0 +1,224 @@
+import asyncio
+import json
+import logging
+import time
+from datetime import datetime
+
+import discord
+
+log = logging.getLogger(__name__)
+
+# How far back in the channel to look for a notification that might already have been posted
+HISTORY_LIMIT = 100
+
+# Idempotency keys of new application notifications start with this, the header is only announced for those
+APPLICATION_KEY_PREFIX = 'aco-application-'
+
+
+def idempotency_footer(text, key):
+    """
+    Returns the embed footer text carrying the outbox key, which is how a retry spots a message already posted.
+
+    :param str text: The footer text
+    :param str key: The outbox idempotency key
+    :rtype: str
+    """
+    return f'{text} | Ref: {key}'
+
+
+def enqueue_notification(affiliator_db, key, embed):
+    """
+    Adds a notification to the outbox. Call it inside the transaction writing whatever the notification is about, so
+    both are recorded or neither is.
+
+    :param sqlite3.Cursor affiliator_db: The transaction cursor
+    :param str key: The idempotency key, a notification with a key already in the outbox is ignored
+    :param discord.Embed embed: The embed to post
+    :returns: None
+    """
+    embed.set_footer(text=idempotency_footer(embed.footer.text, key))
+    affiliator_db.execute(
+        "INSERT OR IGNORE INTO notificationoutbox(idempotency_key, payload, created) VALUES(?, ?, ?)",
+        (key, json.dumps(embed.to_dict()), datetime.now())
+    )
+
+
+def _claim_due(affiliator_db, now, limit):
+    """
+    Returns the notifications due for delivery and counts the attempt up front, so after a crash we know the
+    outcome of the send is unknown.
+
+    :rtype: list[dict]
+    """
+    affiliator_db.execute('''
+        SELECT entry, idempotency_key, payload, attempts FROM notificationoutbox
+        WHERE delivered IS NULL AND next_attempt <= (?)
+        ORDER BY entry
+        LIMIT (?)
+    ''', (now, limit))
+    rows = [dict(row) for row in affiliator_db.fetchall()]
+    affiliator_db.executemany(
+        "UPDATE notificationoutbox SET attempts = attempts + 1 WHERE entry = (?)", [(row['entry'],) for row in rows]
+    )
+    return rows
+
+
+def _mark_delivered(affiliator_db, entry, message_id):
+    affiliator_db.execute(
+        "UPDATE notificationoutbox SET delivered = (?), message_id = (?), last_error = NULL WHERE entry = (?)",
+        (datetime.now(), message_id, entry)
+    )
+
+
+def _record_failure(affiliator_db, rows, error, now, retry_base, retry_max):
+    affiliator_db.executemany(
+        "UPDATE notificationoutbox SET last_error = (?), next_attempt = (?) WHERE entry = (?)",
+        [
+            (error, now + min(retry_base * 2 ** row['attempts'], retry_max), row['entry'])
+            for row in rows
+        ]
+    )
+
+
+class NotificationOutbox:
+
+    def __init__(self, db, get_channel, dispatcher, poll_interval=60, batch_size=50, retry_base=30,
+                 retry_max=30 * 60):
+        """
+        Delivers the notifications written to the outbox table. Scans only write to the outbox, and this worker posts
+        them in the background, retrying with backoff until discord takes them. Each notification is marked
+        delivered as soon as its message is posted, and a retry first checks the channel for the message, so a
+        notification is neither lost nor posted twice.
+
+        :param AffiliatorDatabase db: The database service
+        :param function get_channel: Returns the channel to post to
+        :param NotificationDispatcher dispatcher: Used to post the messages
+        :param float poll_interval: Seconds between checks for notifications due a retry
+        :param int batch_size: The most notifications posted in one go
+        :param float retry_base: Seconds to wait after the first failure, doubled each attempt
+        :param float retry_max: The longest wait between attempts
+        """
+        self.db = db
+        self.get_channel = get_channel
+        self.dispatcher = dispatcher
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self._event = None
+        self._task = None
+
+    def start(self):
+        if self.is_running():
+            return
+        self._event = asyncio.Event()
+        self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def is_running(self):
+        return self._task is not None and not self._task.done()
+
+    def kick(self):
+        """
+        Wakes the worker to deliver new notifications straight away.
+
+        :returns: None
+        """
+        if self._event is not None:
+            self._event.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._event.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._event.clear()
+            try:
+                await self.drain()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception('Failed delivering notifications, they will be retried')
+
+    async def _find_posted(self, channel, keys):
+        """
+        Looks through the recent channel history for messages carrying any of the keys.
+
+        :returns: The posted messages keyed by their idempotency key
+        :rtype: dict[str, discord.Message]
+        """
+        found = {}
+        async for message in channel.history(limit=HISTORY_LIMIT):
+            if message.author != channel.guild.me:
+                continue
+            for embed in message.embeds:
+                footer = embed.footer.text if isinstance(embed.footer.text, str) else ''
+                for key in keys:
+                    if footer.endswith(f'Ref: {key}'):
+                        found[key] = message
+        return found
+
+    async def drain(self):
+        """
+        Posts every notification that is due.
+
+        :returns: The number of notifications delivered
+        :rtype: int
+        """
+        delivered = 0
+        while True:
+            rows = await self.db.transaction(_claim_due, time.time(), self.batch_size)
+            if not rows:
+                return delivered
+            channel = self.get_channel()
+
+            # An earlier attempt may have posted the message and died before recording it
+            retried = [row['idempotency_key'] for row in rows if row['attempts']]
+            posted = await self._find_posted(channel, retried) if retried else {}
+            pending = []
+            for row in rows:
+                message = posted.get(row['idempotency_key'])
+                if message:
+                    log.info('Notification was already posted, recording it', extra={'key': row['idempotency_key']})
+                    self.dispatcher.add_reactions(message)
+                    await self.db.transaction(_mark_delivered, row['entry'], message.id)
+                    delivered += 1
+                else:
+                    pending.append(row)
+
+            if not pending:
+                continue
+
+            done = set()
+
+            async def _on_posted(index, message):
+                await self.db.transaction(_mark_delivered, pending[index]['entry'], message.id)
+                done.add(index)
+
+            # Quarantine notices and retries of notifications that may have gone out before are not announced
+            applications = sum(
+                1 for row in pending
+                if row['idempotency_key'].startswith(APPLICATION_KEY_PREFIX) and not row['attempts']
+            )
+            try:
+                if applications:
+                    await self.dispatcher.send(channel, f'Priority transmission {applications} application'
+                                                        f'{"s" if applications > 1 else ""} incoming.')
+                await self.dispatcher.post_for_vote(
+                    channel,
+                    [discord.Embed.from_dict(json.loads(row['payload'])) for row in pending],
+                    on_posted=_on_posted
+                )
+            except Exception as ex:
+                failed = [row for index, row in enumerate(pending) if index not in done]
+                await self.db.transaction(
+                    _record_failure, failed, str(ex), time.time(), self.retry_base, self.retry_max
+                )
+                raise
+            finally:
+                delivered += len(done)
@@ -0,0 +1,134 @@
+import asyncio
+import time
+
+# Marks the end of the stream on a stage's queue
+_END = object()
+
+
+class Stage:
+
+    def __init__(self, name, func):
+        """
+        One step of a pipeline. The function is awaited once per item, in order, and whatever it returns is handed to
+        the next stage. Returning None drops the item.
+
+        :param str name: Used for the timings and when logging
+        :param coroutine function func: Takes an item, returns the item for the next stage or None
+        """
+        self.name = name
+        self.func = func
+        self.items = 0
+        self.seconds = 0.0
+
+    async def __call__(self, item):
+        started = time.perf_counter()
+        try:
+            return await self.func(item)
+        finally:
+            self.items += 1
+            self.seconds += time.perf_counter() - started
+
+
+class Pipeline:
+
+    def __init__(self, name, source, stages, source_name='source', queue_size=2, histogram=None):
+        """
+        Streams items from an async iterable through a chain of stages. Each stage runs as its own task with a bounded
+        queue in front of it, so a slow stage holds the ones before it back rather than letting items pile up in
+        memory, and stages waiting on I/O overlap with the others.
+
+        :param str name: Used when logging
+        :param async iterable source: Produces the items, timed as the first stage
+        :param list[Stage] stages: The stages, in order
+        :param str source_name: The label for the time spent waiting on the source
+        :param int queue_size: How many items may wait in front of each stage
+        :param Histogram histogram: Observes each stage call, labelled by stage, when given
+        """
+        self.name = name
+        self.source = source
+        self.source_name = source_name
+        self.stages = list(stages)
+        self.queue_size = queue_size
+        self.histogram = histogram
+        self.source_items = 0
+        self.source_seconds = 0.0
+
+    def replace(self, name, func):
+        """
+        Swaps the function of the named stage, e.g. to try a different implementation of one step.
+
+        :param str name: The stage name
+        :param coroutine function func: The new stage function
+        :returns: None
+        """
+        for stage in self.stages:
+            if stage.name == name:
+                stage.func = func
+                return
+        raise KeyError(f'No stage named {name} in the {self.name} pipeline')
+
+    def _observe(self, stage_name, seconds):
+        if self.histogram is not None:
+            self.histogram.observe(seconds, stage=stage_name)
+
+    async def _feed(self, queue):
+        iterator = self.source.__aiter__()
+        while True:
+            started = time.perf_counter()
+            try:
+                item = await iterator.__anext__()
+            except StopAsyncIteration:
+                break
+            finally:
+                elapsed = time.perf_counter() - started
+                self.source_seconds += elapsed
+            self.source_items += 1
+            self._observe(self.source_name, elapsed)
+            await queue.put(item)
+        await queue.put(_END)
+
+    async def _work(self, stage, inbox, outbox):
+        while True:
+            item = await inbox.get()
+            if item is _END:
+                break
+            before = stage.seconds
+            result = await stage(item)
+            self._observe(stage.name, stage.seconds - before)
+            if result is not None and outbox is not None:
+                await outbox.put(result)
+        if outbox is not None:
+            await outbox.put(_END)
+
+    async def run(self):
+        """
+        Runs the stream to the end. If any stage raises, the others are cancelled and the error is raised here.
+
+        :returns: Items handled and seconds spent per stage, the source first
+        :rtype: dict[str, dict]
+        """
+        queues = [asyncio.Queue(self.queue_size) for _ in self.stages]
+        tasks = [asyncio.ensure_future(self._feed(queues[0]))] if self.stages else []
+        for index, stage in enumerate(self.stages):
+            outbox = queues[index + 1] if index + 1 < len(queues) else None
+            tasks.append(asyncio.ensure_future(self._work(stage, queues[index], outbox)))
+
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        finally:
+            for task in tasks:
+                task.cancel()
+        for task in tasks:
+            if task.done() and not task.cancelled() and task.exception() is not None:
+                raise task.exception()
+        return self.timings()
+
+    def timings(self):
+        """
+        :returns: Items handled and seconds spent per stage, the source first
+        :rtype: dict[str, dict]
+        """
+        timings = {self.source_name: {'items': self.source_items, 'seconds': self.source_seconds}}
+        for stage in self.stages:
+            timings[stage.name] = {'items': stage.items, 'seconds': stage.seconds}
+        return timings
@@ -0,0 +1,95 @@
+import json
+import logging
+from datetime import datetime
+
+import discord
+
+from ptn.aco.outbox import enqueue_notification
+
+log = logging.getLogger(__name__)
+
+
+def _quarantine_embed(sheet_row, cells, reason):
+    """
+    Builds the notification posted when a form row is first held back.
+
+    :param int sheet_row: The sheet row
+    :param list[str] cells: The row's cells
+    :param str reason: Why the row could not be recorded
+    :rtype: discord.Embed
+    """
+    embed = discord.Embed(
+        title='ACO application held back.',
+        description=f'**Form row:** {sheet_row}\n'
+                    f'**Reason:** {reason}\n'
+                    f'**Row:** {" | ".join(str(cell) for cell in cells)[:1000]}'
+    )
+    embed.set_footer(text='Fix the row in the form, then use /retry_quarantine')
+    return embed
+
+
+def quarantine_rows(affiliator_db, form_entry, rows):
+    """
+    Holds back form rows that could not be recorded, so the scan can carry on over the rest. A row already held back
+    has its reason and cells updated and its attempts counted up. The first time a row is held back a notification
+    goes into the outbox.
+
+    :param sqlite3.Cursor affiliator_db: The transaction cursor
+    :param int form_entry: The trackingforms entry the rows are from
+    :param list[tuple[int, list, str]] rows: (sheet row, cells, reason) for each row
+    :returns: None
+    """
+    now = datetime.now()
+    for sheet_row, cells, reason in rows:
+        affiliator_db.execute('''
+            INSERT INTO quarantine(form_entry, sheet_row, cells, reason, created, last_attempt)
+            VALUES(?, ?, ?, ?, ?, ?)
+            ON CONFLICT(form_entry, sheet_row) DO UPDATE SET
+                cells = excluded.cells, reason = excluded.reason, attempts = attempts + 1,
+                last_attempt = excluded.last_attempt
+        ''', (form_entry, sheet_row, json.dumps(cells), reason, now, now))
+        affiliator_db.execute(
+            "SELECT entry, attempts FROM quarantine WHERE form_entry = (?) AND sheet_row = (?)", (form_entry, sheet_row)
+        )
+        entry, attempts = affiliator_db.fetchone()
+        log.warning('Quarantined a form row', extra={'sheet_row': sheet_row, 'reason': reason, 'attempts': attempts})
+        if attempts == 1:
+            enqueue_notification(affiliator_db, f'aco-quarantine-{entry}', _quarantine_embed(sheet_row, cells, reason))
+
+
+def release_rows(affiliator_db, form_entry, sheet_rows):
+    """
+    Takes rows out of quarantine, once they have been recorded or no longer need to be.
+
+    :param sqlite3.Cursor affiliator_db: The transaction cursor
+    :param int form_entry: The trackingforms entry the rows are from
+    :param iterable[int] sheet_rows: The sheet rows
+    :returns: How many rows were released
+    :rtype: int
+    """
+    return affiliator_db.executemany(
+        "DELETE FROM quarantine WHERE form_entry = (?) AND sheet_row = (?)",
+        [(form_entry, sheet_row) for sheet_row in sheet_rows]
+    ).rowcount
+
+
+def list_quarantined(affiliator_db, form_entry, sheet_row=None):
+    """
+    :param sqlite3.Cursor affiliator_db: The transaction cursor
+    :param int form_entry: The trackingforms entry
+    :param int sheet_row: Only this row, when given
+    :returns: The quarantined rows in sheet order, with their cells decoded
+    :rtype: list[dict]
+    """
+    if sheet_row is None:
+        affiliator_db.execute(
+            "SELECT * FROM quarantine WHERE form_entry = (?) ORDER BY sheet_row", (form_entry,)
+        )
+    else:
+        affiliator_db.execute(
+            "SELECT * FROM quarantine WHERE form_entry = (?) AND sheet_row = (?)", (form_entry, sheet_row)
+        )
+    rows = [dict(row) for row in affiliator_db.fetchall()]
+    for row in rows:
+        row['cells'] = json.loads(row['cells'])
+    return rows
@@ -0,0 +1,118 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timezone
+
+from ptn.aco.database.normalise import username_key
+from ptn.aco.database.writebehind import track_members
+
+log = logging.getLogger(__name__)
+
+# Members keyed between yields to the event loop, so a large guild does not hold up gateway events
+COLLECT_CHUNK_SIZE = 1000
+
+
+def _reconcile_membertracking(affiliator_db, holders, now, dry_run, remove):
+    """
+    Diffs the member role holders against membertracking as sets, matching rows on the member ID or, for rows tracked
+    before member IDs were stored, the username. Then applies the changes as batched statements in this one
+    transaction. Members who renamed keep their row and tracking date.
+
+    :param sqlite3.Cursor affiliator_db: The transaction cursor
+    :param dict[int, str] holders: The discord usernames of the role holders, keyed by their member ID
+    :param datetime now: The tracking date to use for newly found holders
+    :param bool dry_run: Work out the changes without applying them
+    :param bool remove: Also stop tracking anyone who no longer holds the role
+    :returns: The usernames added, renamed as (before, after), and removed
+    :rtype: tuple[list[str], list[tuple[str, str]], list[str]]
+    """
+    affiliator_db.execute("SELECT entry, member_id, username_key, discord_username FROM membertracking")
+    tracked = {}
+    unclaimed = {}
+    untracked = {}
+    for entry, member_id, key, username in affiliator_db.fetchall():
+        if member_id is not None:
+            tracked[member_id] = (entry, username)
+        elif key is not None:
+            unclaimed[key] = (entry, username)
+        else:
+            untracked[entry] = username
+
+    added = []
+    renamed = []
+    changed = []
+    for member_id, username in holders.items():
+        if member_id in tracked:
+            entry, tracked_as = tracked.pop(member_id)
+            if tracked_as != username:
+                renamed.append((tracked_as, username))
+                changed.append((member_id, username, now))
+        elif username_key(username) in unclaimed:
+            entry, tracked_as = unclaimed.pop(username_key(username))
+            if tracked_as != username:
+                renamed.append((tracked_as, username))
+            changed.append((member_id, username, now))
+        else:
+            added.append(username)
+            changed.append((member_id, username, now))
+
+    # Whatever no holder matched
+    stale = {entry: username or f'member {member_id}' for member_id, (entry, username) in tracked.items()}
+    stale.update(unclaimed.values())
+    stale.update((entry, username or 'an unknown member') for entry, username in untracked.items())
+    removed = sorted(stale.values()) if remove else []
+
+    if not dry_run:
+        track_members(affiliator_db, changed)
+        if remove:
+            affiliator_db.executemany("DELETE FROM membertracking WHERE entry = (?)", [(entry,) for entry in stale])
+
+    return sorted(added), sorted(renamed), removed
+
+
+async def reconcile_members(db, role_holders, dry_run=False, remove=False, progress=None):
+    """
+    Brings membertracking in line with who actually holds the member role, for anyone given the role or renamed while
+    the bot was offline. Holders found this way are tracked from now, as there is no way of knowing when they got the
+    role. Only removes anyone tracked who no longer holds the role when asked to, as the tracking date cannot be
+    brought back once removed.
+
+    :param AffiliatorDatabase db: The database service
+    :param iterable role_holders: The members holding the member role
+    :param bool dry_run: Report the changes without applying them
+    :param bool remove: Also stop tracking anyone who no longer holds the role
+    :param coroutine function progress: Awaited with a status line as each stage finishes
+    :returns: The report of what changed
+    :rtype: dict
+    """
+    started = time.monotonic()
+    holders = {}
+    for count, member in enumerate(role_holders, 1):
+        holders[member.id] = str(member)
+        if count % COLLECT_CHUNK_SIZE == 0:
+            await asyncio.sleep(0)
+    if progress:
+        await progress(f'Found {len(holders)} members with the member role.')
+
+    added, renamed, removed = await db.transaction(
+        _reconcile_membertracking, holders, datetime.now(timezone.utc), dry_run, remove
+    )
+    report = {
+        'holders': len(holders),
+        'added': added,
+        'renamed': renamed,
+        'removed': removed,
+        'dry_run': dry_run,
+        'elapsed': time.monotonic() - started,
+    }
+    log.info('Member tracking reconciliation', extra={
+        'dry_run': dry_run, 'holders': len(holders), 'added': len(added), 'renamed': len(renamed),
+        'removed': len(removed),
+        'elapsed': f'{report["elapsed"]:.2f}'
+    })
+    if progress:
+        await progress(f'{"Would add" if dry_run else "Added"} {len(added)}, '
+                       f'{"would rename" if dry_run else "renamed"} {len(renamed)} and '
+                       f'{"would remove" if dry_run else "removed"} {len(removed)} tracked members '
+                       f'in {report["elapsed"]:.2f}s.')
+    return report
@@ -0,0 +1,470 @@
+import asyncio
+import logging
+import sqlite3
+
+import discord
+
+from ptn.aco.UserData import UserData, FIELDS, SHEET_HEADERS, sheet_columns
+from ptn.aco.constants import get_scan_queue_pages, get_scan_enrich_concurrency
+from ptn.aco.database.normalise import carrier_id_key, timestamp_epoch
+from ptn.aco.database.writebehind import membertracking_writes
+from ptn.aco.metrics import scan_stage_duration, scan_rows_fetched, scan_rows_new
+from ptn.aco.outbox import enqueue_notification, APPLICATION_KEY_PREFIX
+from ptn.aco.pipeline import Pipeline, Stage
+from ptn.aco.quarantine import quarantine_rows, release_rows
+from ptn.aco.sheets import rowcol_to_a1
+
+log = logging.getLogger(__name__)
+
+# How many sheet rows to request per range read while scanning
+SCAN_PAGE_SIZE = 500
+
+
+def fetch_watermark(affiliator_db, form_entry):
+    """
+    :param sqlite3.Cursor affiliator_db: The transaction cursor
+    :param int form_entry: The trackingforms entry
+    :returns: The last sheet row already scanned, row 1 being the headers
+    :rtype: int
+    """
+    affiliator_db.execute(
+        "SELECT last_row_index FROM trackingforms WHERE entry = (?)", (form_entry,)
+    )
+    return affiliator_db.fetchone()['last_row_index'] or 1
+
+
+def _find_new_records(affiliator_db, keys, seen):
+    """
+    Diffs the sheet records against acoapplications in one set based query. The keys are loaded into a temp table and
+    joined on carrier ID and timestamp epoch, rather than querying the table once per sheet row.
+
+    :param sqlite3.Cursor affiliator_db: The transaction cursor
+    :param list[tuple] keys: (record index, carrier ID, timestamp epoch) for every sheet record
+    :param set seen: The (carrier ID, timestamp epoch) pairs already found new by this scan, updated in place
+    :returns: The record indexes that are not yet in the database in sheet order, and (record index, reason) for the
+        records that match more than one application
+    :rtype: tuple[list[int], list[tuple[int, str]]]
+    """
+    affiliator_db.execute('''
+        CREATE TEMP TABLE IF NOT EXISTS sheetkeys(
+            record_index INTEGER PRIMARY KEY,
+            fleet_carrier_id TEXT,
+            timestamp_epoch INTEGER
+        )
+    ''')
+    affiliator_db.execute("DELETE FROM sheetkeys")
+    affiliator_db.executemany("INSERT INTO sheetkeys VALUES(?, ?, ?)", keys)
+    affiliator_db.execute('''
+        SELECT sheetkeys.record_index, sheetkeys.fleet_carrier_id, sheetkeys.timestamp_epoch,
+            count(acoapplications.entry) AS matches
+        FROM sheetkeys
+        LEFT JOIN acoapplications
+            ON acoapplications.carrier_id_key = sheetkeys.fleet_carrier_id
+            AND acoapplications.timestamp_epoch = sheetkeys.timestamp_epoch
+        GROUP BY sheetkeys.record_index
+        HAVING matches != 1
+        ORDER BY sheetkeys.record_index
+    ''')
+    results = affiliator_db.fetchall()
+    affiliator_db.execute("DELETE FROM sheetkeys")
+
+    new_records = []
+    conflicts = []
+    for record_index, fleet_carrier_id, timestamp, matches in results:
+        if matches > 1:
+            conflicts.append((
+                record_index, f'{matches} users are listed with this carrier ID: {fleet_carrier_id}. Problem in the DB!'
+            ))
+        # A record repeated in the sheet is only a single new application
+        elif (fleet_carrier_id, timestamp) not in seen:
+            seen.add((fleet_carrier_id, timestamp))
+            new_records.append(record_index)
+    return new_records, conflicts
+
+
+def _application_embed(user, status, application_attempt):
+    """
+    Builds the notification embed for a new application.
+
+    :param UserData user: The application
+    :param dict status: The applicant's membership status
+    :param int application_attempt: How many times this carrier has applied, including this time
+    :rtype: discord.Embed
+    """
+    embed = discord.Embed(
+        title='New ACO application detected.',
+        description=f'**User:** {user.ptn_nickname}\n'
+                    f'**Discord Username:** {user.discord_username}\n'
+                    f'**Cmdr Name:** {user.cmdr_name}\n'
+                    f'**Fleet Carrier:** {user.fleet_carrier_name} ({user.fleet_carrier_id})\n'
+                    f'**Has member role:** {status["member"]}.\n'
+                    f'**Eligible for ACO:** {status["eligible_for_aco"]}\n'
+                    f'{status["reason"]}'
+                    f'**Applied At:** {user.timestamp}\n'
+                    f'**Application Attempt:** {application_attempt}'
+    )
+    embed.set_footer(text='Please validate membership and vote on this proposal')
+    return embed
+
+
+def _advance_watermark(affiliator_db, form_entry, last_row_index):
+    affiliator_db.execute(
+        "UPDATE trackingforms SET last_row_index = max(coalesce(last_row_index, 1), ?) WHERE entry = (?)",
+        (last_row_index, form_entry)
+    )
+
+
+def _record_page(affiliator_db, applications, quarantined, form_entry, last_row_index):
+    """
+    Inserts the new applications along with their notifications in the outbox, quarantines the rows that could not be
+    recorded, and moves the form watermark up, all in one transaction. The rows are never skipped without being
+    recorded or quarantined, and never recorded without a notification.
+
+    Each application is inserted under its own savepoint, so one the database refuses, such as a second carrier ID for
+    a carrier name and timestamp already recorded, is quarantined without losing the rest of the page.
+
+    :param sqlite3.Cursor affiliator_db: The transaction cursor
+    :param list[tuple[int, list, UserData, dict]] applications: The sheet row, cells, application and membership
+        status of each new application
+    :param list[tuple[int, list, str]] quarantined: The sheet row, cells and reason for each row held back
+    :param int form_entry: The trackingforms entry being scanned
+    :param int last_row_index: The last sheet row processed by this scan, None leaves the watermark alone. The
+        watermark never moves back, so a full rescan that fails partway does not leave the rows after this page to be
+        read again by the next scan
+    :returns: The sheet rows of the applications the database refused, which were quarantined instead
+    :rtype: list[int]
+    """
+    if not affiliator_db.connection.in_transaction:
+        # Otherwise the first savepoint would open the transaction, and releasing it would commit
+        affiliator_db.execute("BEGIN")
+
+    if last_row_index is not None:
+        _advance_watermark(affiliator_db, form_entry, last_row_index)
+
+    recorded = []
+    refused = []
+    for sheet_row, cells, user, status in applications:
+        affiliator_db.execute("SAVEPOINT application")
+        try:
+            _insert_application(affiliator_db, user, status)
+        except sqlite3.IntegrityError as ex:
+            affiliator_db.execute("ROLLBACK TO application")
+            log.warning('The database refused an application', extra={'sheet_row': sheet_row, 'error': ex})
+            refused.append((sheet_row, cells, f'Clashes with an application already recorded: {ex}'))
+        else:
+            recorded.append(sheet_row)
+        finally:
+            affiliator_db.execute("RELEASE application")
+
+    quarantine_rows(affiliator_db, form_entry, quarantined + refused)
+    # A row that was held back on an earlier scan and has now been recorded
+    release_rows(affiliator_db, form_entry, recorded)
+    return [sheet_row for sheet_row, _, _ in refused]
+
+
+def _insert_application(affiliator_db, user, status):
+    """
+    Inserts an application and queues its notification.
+
+    :param sqlite3.Cursor affiliator_db: The transaction cursor
+    :param UserData user: The application
+    :param dict status: The applicant's membership status
+    :returns: None
+    :raises sqlite3.IntegrityError: If the application clashes with one already recorded
+    """
+    affiliator_db.execute('''
+        INSERT INTO acoapplications(
+            discord_username, ptn_nickname, cmdr_name, fleet_carrier_name, fleet_carrier_id, ack, user_claims_member,
+            timestamp, timestamp_epoch, carrier_id_key
+        ) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (
+        user.discord_username, user.ptn_nickname, user.cmdr_name,
+        user.fleet_carrier_name, user.fleet_carrier_id, user.ack,
+        user.user_claims_member, user.timestamp, timestamp_epoch(user.timestamp),
+        carrier_id_key(user.fleet_carrier_id)
+        )
+    )
+    application_entry = affiliator_db.lastrowid
+
+    # Allow flagging of multiple attempts to join. We already stuck it in the DB, so the counter is this value.
+    affiliator_db.execute(
+        "SELECT count(*) FROM acoapplications WHERE carrier_id_key = (?)",
+        (carrier_id_key(user.fleet_carrier_id),)
+    )
+    application_attempt = affiliator_db.fetchone()[0]
+
+    enqueue_notification(
+        affiliator_db, f'{APPLICATION_KEY_PREFIX}{application_entry}',
+        _application_embed(user, status, application_attempt)
+    )
+
+
+class ScanPage:
+
+    def __init__(self, rows):
+        """
+        A batch of form rows as it moves through the scan stages.
+
+        :param list[tuple[int, list[str]]] rows: (sheet row, cells) for each row read
+        """
+        self.first_row = rows[0][0] if rows else None
+        self.rows = rows
+        self.records = {}  #: {sheet row: the row's cells}
+        self.last_row = None  #: The last sheet row holding a record
+        self.new_rows = []  #: The sheet rows not yet in the database
+        self.applications = []  #: [(sheet row, cells, UserData, membership status)]
+        self.quarantined = []  #: [(sheet row, cells, reason)]
+
+
+class FormScan:
+
+    def __init__(self, db, sheet, form_entry, membership_status, notify=None, page_size=SCAN_PAGE_SIZE,
+                 sheet_rows=None):
+        """
+        One scan of the tracking form, streamed a page at a time through the stages
+
+            fetch -> parse -> diff -> enrich -> record -> notify
+
+        with a bounded queue between each, so the next page is read from google while the last one is diffed and its
+        applicants are looked up, and memory is bounded by the queue sizes rather than the size of the form. Any stage
+        can be swapped through the pipeline's replace.
+
+        A row that cannot be recorded, such as one with a malformed carrier ID, is quarantined with the reason and the
+        scan carries on over the rest of the form.
+
+        :param AffiliatorDatabase db: The database service
+        :param SheetsClient sheet: The opened tracking form
+        :param int form_entry: The trackingforms entry being scanned
+        :param coroutine function membership_status: Takes a UserData, returns its membership status
+        :param callable notify: Called after each page of applications is recorded, to have them posted
+        :param int page_size: How many sheet rows to request per range read
+        :param list[int] sheet_rows: Only scan these rows, leaving the watermark alone. Used to retry quarantined rows.
+        """
+        self.db = db
+        self.sheet = sheet
+        self.form_entry = form_entry
+        self.membership_status = membership_status
+        self.notify = notify
+        self.page_size = page_size
+        self.sheet_rows = sorted(set(sheet_rows)) if sheet_rows is not None else None
+
+        self.watermark = 1
+        self.headers = []
+        self.columns = ()  #: Where each UserData field is in the rows, see sheet_columns
+        self.rows_read = 0
+        self.added_count = 0
+        self.quarantined_rows = set()
+        self.last_row = None  #: The last sheet row with a record
+        self.written_row = None  #: The watermark last written alongside applications
+        self._seen = set()
+        self._flushed = False
+        self._lookups = asyncio.Semaphore(get_scan_enrich_concurrency())
+
+        self.pipeline = Pipeline('form scan', self.fetch(), [
+            Stage('parse', self.parse),
+            Stage('diff', self.diff),
+            Stage('enrich', self.enrich),
+            Stage('record', self.record),
+            Stage('notify', self.send_notifications),
+        ], source_name='fetch', queue_size=get_scan_queue_pages(), histogram=scan_stage_duration)
+
+    def _row_range(self, start, end):
+        return f'{rowcol_to_a1(start, 1)}:{rowcol_to_a1(end, len(self.headers))}'
+
+    async def fetch(self):
+        """
+        Reads the form rows after the watermark, one bounded range read per page, so only the new part of the sheet is
+        requested. When retrying, reads only the given rows.
+        """
+        self.headers = await self.sheet.row_values(1)
+        self.columns = sheet_columns(self.headers)
+        for field in ('timestamp', 'fleet_carrier_id'):
+            if self.columns[FIELDS.index(field)] is None:
+                raise ValueError(f'The tracking form has no {SHEET_HEADERS[field]} column')
+
+        if self.sheet_rows is not None:
+            for index in range(0, len(self.sheet_rows), self.page_size):
+                batch = self.sheet_rows[index:index + self.page_size]
+                pages = await asyncio.gather(*(self.sheet.get_values(self._row_range(row, row)) for row in batch))
+                yield ScanPage([(row, cells[0] if cells else []) for row, cells in zip(batch, pages)])
+            return
+
+        start = self.watermark + 1
+        while True:
+            end = start + self.page_size - 1
+            rows = await self.sheet.get_values(self._row_range(start, end))
+            yield ScanPage(list(enumerate(rows, start)))
+            if len(rows) < self.page_size:
+                return
+            start = end + 1
+
+    async def parse(self, page):
+        """
+        Keys the rows by their sheet row, skipping blank rows. The cells are kept as the strings the sheet returned,
+        numericising them would turn carrier IDs such as 10E-854 into floats.
+        """
+        width = len(self.headers)
+        for sheet_row, row in page.rows:
+            if not any(row):
+                # Blank row, nothing to record here
+                continue
+            if len(row) < width:
+                row = row + [''] * (width - len(row))
+            page.records[sheet_row] = row
+        page.rows = None
+        if not page.records:
+            return None
+
+        page.last_row = max(page.records)
+        self.rows_read += len(page.records)
+        scan_rows_fetched.inc(len(page.records))
+        return page
+
+    async def diff(self, page):
+        """
+        Checks which records are in the database already by their timestamp and carrier ID. This allows multiple
+        applications. The timestamps are read into epoch seconds here, once per row, and a row without a readable
+        timestamp is quarantined as it could never be matched.
+        """
+        timestamp = self.columns[FIELDS.index('timestamp')]
+        carrier_id = self.columns[FIELDS.index('fleet_carrier_id')]
+        keys = []
+        for index, row in page.records.items():
+            try:
+                epoch = timestamp_epoch(row[timestamp])
+            except ValueError:
+                page.quarantined.append((index, row, f'Unreadable {SHEET_HEADERS["timestamp"]}: {row[timestamp]}'))
+                continue
+            if epoch is None:
+                page.quarantined.append((index, row, f'Missing {SHEET_HEADERS["timestamp"]}'))
+                continue
+            keys.append((index, carrier_id_key(row[carrier_id]), epoch))
+        page.new_rows, conflicts = await self.db.transaction(_find_new_records, keys, self._seen)
+        page.quarantined.extend((sheet_row, page.records[sheet_row], reason) for sheet_row, reason in conflicts)
+        scan_rows_new.inc(len(page.new_rows))
+        log.debug('Diffed a page of the form against the database',
+                  extra={'first_row': page.first_row, 'records': len(keys), 'new': len(page.new_rows)})
+        return page
+
+    async def _lookup(self, user):
+        async with self._lookups:
+            try:
+                return await self.membership_status(user), None
+            except Exception as ex:
+                log.exception('Failed working out the membership status',
+                              extra={'discord_username': user.discord_username})
+                return None, f'Membership lookup failed: {ex}'
+
+    def _parse_row(self, page, sheet_row):
+        """
+        Builds the application for a new row, quarantining the row if it is not a valid application.
+
+        :returns: The application, or None if the row was quarantined
+        :rtype: UserData
+        """
+        cells = page.records[sheet_row]
+        try:
+            user = UserData.from_sheet_row(cells, self.columns)
+        except ValueError as ex:
+            page.quarantined.append((sheet_row, cells, str(ex)))
+            return None
+
+        missing = user.missing_fields()
+        if missing:
+            page.quarantined.append((sheet_row, cells, f'Missing {", ".join(missing)}'))
+            return None
+        return user
+
+    async def enrich(self, page):
+        """
+        Works out the membership status of each new applicant, a few applicants at a time.
+        """
+        new_users = [(sheet_row, self._parse_row(page, sheet_row)) for sheet_row in page.new_rows]
+        new_users = [(sheet_row, user) for sheet_row, user in new_users if user is not None]
+        if not new_users:
+            page.records = None
+            return page
+
+        if not self._flushed:
+            # Make sure the membership checks see any role changes still held in the write-behind buffer
+            await membertracking_writes.flush()
+            self._flushed = True
+
+        for _, user in new_users:
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug('New application', extra=user.to_dictionary())
+            log.info('Application is not yet in the database - adding it',
+                     extra={'carrier_name': user.fleet_carrier_name})
+        statuses = await asyncio.gather(*(self._lookup(user) for _, user in new_users))
+        for (sheet_row, user), (status, error) in zip(new_users, statuses):
+            if error is None:
+                page.applications.append((sheet_row, page.records[sheet_row], user, status))
+            else:
+                page.quarantined.append((sheet_row, page.records[sheet_row], error))
+        page.records = None
+        return page
+
+    async def record(self, page):
+        """
+        Writes the page's new applications and their notifications, the quarantined rows and the watermark in one
+        transaction. Pages with nothing to write only move the watermark on once the scan finishes.
+        """
+        self.last_row = page.last_row
+        if not page.applications and not page.quarantined:
+            return None
+
+        last_row = page.last_row if self.sheet_rows is None else None
+        refused = await self.db.transaction(
+            _record_page, page.applications, page.quarantined, self.form_entry, last_row
+        )
+        self.written_row = last_row
+        self.added_count += len(page.applications) - len(refused)
+        self.quarantined_rows.update(sheet_row for sheet_row, _, _ in page.quarantined)
+        self.quarantined_rows.update(refused)
+        return page
+
+    async def send_notifications(self, page):
+        """
+        Has the outbox post the page's notifications while the rest of the form is scanned.
+        """
+        if self.notify is not None:
+            self.notify()
+        return None
+
+    async def run(self, full_rescan=False):
+        """
+        Runs the scan to the end of the form.
+
+        :param bool full_rescan: Scan the whole form instead of starting from the watermark
+        :returns: Whether the database was updated, the number of new applications and quarantined rows, the rows
+            read and the time spent in each stage
+        :rtype: dict
+        """
+        if self.sheet_rows is None:
+            # Only look at the rows since the last scan, unless we were asked to check them all again
+            self.watermark = 1 if full_rescan else await self.db.read(fetch_watermark, self.form_entry)
+        stages = await self.pipeline.run()
+
+        released = 0
+        if self.sheet_rows is not None:
+            # Retried rows that are recorded, already in the database or now blank need no more attention
+            released = await self.db.transaction(
+                release_rows, self.form_entry, [row for row in self.sheet_rows if row not in self.quarantined_rows]
+            )
+        elif self.last_row is not None and self.last_row != self.written_row and self.last_row > self.watermark:
+            # Nothing new after the last recorded page, but there is no need to check these rows again
+            await self.db.transaction(_advance_watermark, self.form_entry, self.last_row)
+
+        log.info('Scanned the tracking form', extra={
+            'after_row': self.watermark, 'records': self.rows_read, 'added': self.added_count,
+            'quarantined': len(self.quarantined_rows),
+            **{f'{name}_seconds': round(timing['seconds'], 3) for name, timing in stages.items()}
+        })
+        return {
+            'updated_db': self.added_count > 0 or bool(self.quarantined_rows) or released > 0,
+            'added_count': self.added_count,
+            'quarantined_count': len(self.quarantined_rows),
+            'released_count': released,
+            'rows_read': self.rows_read,
+            'stages': stages,
+        }
@@ -0,0 +1,112 @@
+import asyncio
+import logging
+import random
+from datetime import datetime, timedelta
+
+log = logging.getLogger(__name__)
+
+# The most times the interval is doubled while backing off, so a long outage cannot overflow the delay
+MAX_BACKOFF_DOUBLINGS = 16
+
+
+class ChangeProbeScheduler:
+
+    def __init__(self, probe, action, interval, jitter=0, max_backoff=None, name='scheduler'):
+        """
+        Polls a cheap probe on a fixed interval and only runs the expensive action when the probe reports a change.
+        Errors back off exponentially up to max_backoff, and every sleep gets a random jitter added.
+
+        :param coroutine function probe: Returns True when the action should run
+        :param coroutine function action: The work to do when a change is detected
+        :param float interval: Seconds between probes
+        :param float jitter: Up to this many seconds are randomly added to each sleep
+        :param float max_backoff: The longest sleep after repeated failures, defaults to the interval
+        :param str name: Used when logging
+        """
+        self.probe = probe
+        self.action = action
+        self.interval = interval
+        self.jitter = jitter
+        self.max_backoff = max(max_backoff or interval, interval)
+        self.name = name
+
+        self.failures = 0
+        self.last_probe = None  #: datetime
+        self.last_run = None  #: datetime
+        self.next_run = None  #: datetime
+        self._task = None
+
+    def start(self):
+        """
+        Starts polling in the background.
+
+        :returns: None
+        """
+        if self.is_running():
+            raise RuntimeError(f'{self.name} is already running')
+        self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        """
+        Cancels the polling task.
+
+        :returns: None
+        """
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def is_running(self):
+        return self._task is not None and not self._task.done()
+
+    def export_state(self):
+        """
+        :returns: The failure count and when the next probe is due as a timestamp, to carry over a restart
+        :rtype: dict
+        """
+        return {'failures': self.failures, 'next_run': self.next_run.timestamp() if self.next_run else None}
+
+    def restore_state(self, state):
+        """
+        Carries the backoff and the probe timing over from before a restart, so a restart neither probes early nor
+        forgets that the probe was failing. Call it before start.
+
+        :param dict state: As returned by export_state
+        :returns: None
+        """
+        self.failures = state.get('failures', 0)
+        if state.get('next_run') is not None:
+            self.next_run = datetime.fromtimestamp(state['next_run'])
+
+    def _next_delay(self):
+        """
+        Returns how long to sleep before the next probe.
+
+        :rtype: float
+        """
+        delay = self.interval
+        if self.failures:
+            delay = min(self.interval * 2 ** min(self.failures, MAX_BACKOFF_DOUBLINGS), self.max_backoff)
+        return delay + random.uniform(0, self.jitter)
+
+    async def _run(self):
+        # A probe already scheduled, before a stop or a restart, is kept to
+        if self.next_run is not None:
+            await asyncio.sleep(max(0.0, (self.next_run - datetime.now()).total_seconds()))
+
+        while True:
+            try:
+                self.last_probe = datetime.now()
+                if await self.probe():
+                    self.last_run = datetime.now()
+                    await self.action()
+                self.failures = 0
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.failures += 1
+                log.exception(f'{self.name} failed', extra={'failures': self.failures})
+
+            delay = self._next_delay()
+            self.next_run = datetime.now() + timedelta(seconds=delay)
+            await asyncio.sleep(delay)
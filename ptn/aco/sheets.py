@@ -0,0 +1,146 @@
+import asyncio
+import functools
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+SCOPE = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+CREDENTIALS_PATH = os.path.join(os.path.expanduser('~'), '.ptnuserdata.json')
+
+
+class SheetUnavailable(EnvironmentError):
+    pass
+
+
+def _gspread():
+    # gspread and the google auth libraries take a few hundred milliseconds to import, so they are only loaded once
+    # the sheet is first used rather than when the bot starts
+    import gspread
+    return gspread
+
+
+def rowcol_to_a1(row, col):
+    """
+    Converts a row and column number to an A1 cell reference, as gspread.utils.rowcol_to_a1 does, without importing
+    gspread.
+
+    :param int row: The row, starting at 1
+    :param int col: The column, starting at 1
+    :rtype: str
+    """
+    letters = ''
+    while col:
+        col, remainder = divmod(col - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return f'{letters}{row}'
+
+
+class SheetsClient:
+
+    def __init__(self, worksheet_key, worksheet_id, max_workers=2, timeout=30):
+        """
+        Async access to the tracking form worksheet. gspread is blocking, so every call runs in a small thread pool
+        and is awaited with a timeout. The client is authorized on first use and kept, so its HTTP session is reused
+        across calls, and it is authorized again if the credentials are rejected.
+
+        Giving up on the await does not stop the call, so the HTTP session has the same timeout. A hung request then
+        fails on its pool thread too, rather than holding the thread and eventually blocking every later call.
+
+        :param str worksheet_key: The google sheet key
+        :param int worksheet_id: The index of the worksheet holding the data
+        :param int max_workers: The most sheet calls in flight at once
+        :param float timeout: Seconds to wait for a call before giving up, and for google to connect or send data
+        """
+        self.worksheet_key = worksheet_key
+        self.worksheet_id = worksheet_id
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='sheets')
+        self._lock = threading.Lock()
+        self._client = None
+        self._worksheet = None
+
+    def _authorize(self):
+        if not os.path.exists(CREDENTIALS_PATH):
+            raise EnvironmentError('Cannot find the user data json file.')
+
+        from oauth2client.service_account import ServiceAccountCredentials
+
+        log.info('Authorizing the google sheets client')
+        credentials = ServiceAccountCredentials.from_json_keyfile_name(CREDENTIALS_PATH, SCOPE)
+        client = _gspread().authorize(credentials)
+        client.set_timeout(self.timeout)
+        return client
+
+    def _get_worksheet(self, reauthorize=False):
+        """
+        Returns the worksheet, authorizing and opening it when needed. Runs on a pool thread.
+
+        :param bool reauthorize: Drop the current client and authorize again
+        :rtype: gspread.Worksheet
+        """
+        with self._lock:
+            if reauthorize:
+                self._client = None
+                self._worksheet = None
+            if self._worksheet is None:
+                if self._client is None:
+                    self._client = self._authorize()
+                log.info(f'Building worksheet with the key: {self.worksheet_key}')
+                workbook = self._client.open_by_key(self.worksheet_key)
+                self._worksheet = workbook.get_worksheet(self.worksheet_id)
+                if self._worksheet is None:
+                    raise EnvironmentError(f'No worksheet {self.worksheet_id} in the form {self.worksheet_key}')
+            return self._worksheet
+
+    def _call(self, method, *args, **kwargs):
+        try:
+            return getattr(self._get_worksheet(), method)(*args, **kwargs)
+        except _gspread().exceptions.APIError as ex:
+            if ex.response.status_code != 401:
+                raise
+            log.warning('Google rejected the sheets credentials, authorizing again', extra={'error': ex})
+            return getattr(self._get_worksheet(reauthorize=True), method)(*args, **kwargs)
+
+    async def _submit(self, method, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await asyncio.wait_for(
+            loop.run_in_executor(self._executor, functools.partial(self._call, method, *args, **kwargs)),
+            self.timeout
+        )
+
+    async def open(self):
+        """
+        Authorizes and opens the worksheet if that has not happened yet.
+
+        :returns: None
+        :raises SheetUnavailable: If google refuses to open the worksheet
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            await asyncio.wait_for(loop.run_in_executor(self._executor, self._get_worksheet), self.timeout)
+        except Exception as ex:
+            if isinstance(ex, _gspread().exceptions.APIError):
+                raise SheetUnavailable(str(ex)) from ex
+            raise
+
+    async def row_values(self, row):
+        """
+        :param int row: The sheet row, starting at 1
+        :returns: The values in the row
+        :rtype: list
+        """
+        return await self._submit('row_values', row)
+
+    async def get_values(self, range_name):
+        """
+        :param str range_name: An A1 notation range
+        :returns: The values in the range, one list per row
+        :rtype: list[list]
+        """
+        return await self._submit('get_values', range_name)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,103 @@
+import logging
+import time
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+
+class StartupTimer:
+
+    def __init__(self):
+        """
+        Records how long each startup phase took and when it started, relative to when this module was first
+        imported, so phases that overlap show up as such in the report.
+        """
+        self.started = time.perf_counter()
+        self.phases = {}  #: {name: (seconds after start, seconds taken)}
+        self._open = {}  #: {name: when it began}
+        self.reported = False
+
+    def record(self, name, began, seconds):
+        """
+        :param str name: The phase
+        :param float began: When the phase began, as a perf_counter value
+        :param float seconds: How long it took
+        :returns: None
+        """
+        self.phases[name] = (began - self.started, seconds)
+
+    def mark(self, name):
+        """
+        Records a phase that ran from the start until now.
+
+        :param str name: The phase
+        :returns: None
+        """
+        self.record(name, self.started, time.perf_counter() - self.started)
+
+    def begin(self, name):
+        """
+        Starts timing a phase that ends somewhere else, see end.
+
+        :param str name: The phase
+        :returns: None
+        """
+        self._open[name] = time.perf_counter()
+
+    def end(self, name):
+        """
+        Records a phase started with begin. Ending a phase that was not begun, or was already ended, does nothing.
+
+        :param str name: The phase
+        :returns: None
+        """
+        began = self._open.pop(name, None)
+        if began is not None:
+            self.record(name, began, time.perf_counter() - began)
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Times the block as the named phase, whether or not it raised.
+        """
+        began = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, began, time.perf_counter() - began)
+
+    async def run(self, name, awaitable):
+        """
+        Awaits the awaitable and times it as the named phase.
+
+        :returns: Whatever the awaitable returns
+        """
+        with self.phase(name):
+            return await awaitable
+
+    def report(self):
+        """
+        :returns: One line per phase in the order they started, with the start offset and duration
+        :rtype: str
+        """
+        return '\n'.join(
+            f'{name}: +{began:.2f}s, took {seconds:.2f}s'
+            for name, (began, seconds) in sorted(self.phases.items(), key=lambda item: item[1][0])
+        )
+
+    def log_report(self):
+        """
+        Logs the phases once, the first time the bot is ready.
+
+        :returns: None
+        """
+        if self.reported:
+            return
+        self.reported = True
+        log.info('Startup completed', extra={
+            'total_seconds': round(time.perf_counter() - self.started, 3),
+            **{f'{name}_seconds': round(seconds, 3) for name, (_, seconds) in self.phases.items()}
+        })
+
+
+startup_timer = StartupTimer()
@@ -0,0 +1,118 @@
+import json
+import logging
+import os
+import time
+
+from ptn.aco.constants import get_warm_restart_path, get_warm_restart_max_age
+
+log = logging.getLogger(__name__)
+
+# Bumped whenever a section changes shape, state written by another format is not restored
+STATE_FORMAT = 2
+
+
+class WarmRestartState:
+
+    def __init__(self, path, max_age):
+        """
+        The in-memory state worth keeping across a restart, written to a small JSON file when the bot exits or
+        restarts and handed back section by section on the next start. Anything already in the database, such as the
+        scan watermark and the notification outbox, is not repeated here.
+
+        Each part of the bot registers a function returning its section. The file is read once, on the first take,
+        and removed straight away, so state is only ever restored once and a later crash starts cold.
+
+        :param str path: The state file
+        :param float max_age: Seconds the state stays fresh enough to restore, 0 switches it off
+        """
+        self.path = path
+        self.max_age = max_age
+        self._providers = {}
+        self._sections = None
+
+    def register(self, section, provider):
+        """
+        :param str section: The section name
+        :param function provider: Returns the section as JSON serialisable data, or None to leave it out
+        :returns: None
+        """
+        self._providers[section] = provider
+
+    def save(self, reason):
+        """
+        Writes every registered section, through a temp file and rename. A provider that fails is logged and left
+        out rather than stopping the restart.
+
+        :param str reason: Why the bot is stopping, for the log
+        :returns: The sections written
+        :rtype: list[str]
+        """
+        if not self.max_age:
+            return []
+
+        sections = {}
+        for section, provider in self._providers.items():
+            try:
+                data = provider()
+            except Exception:
+                log.exception('Failed collecting warm restart state', extra={'section': section})
+                continue
+            if data is not None:
+                sections[section] = data
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = f'{self.path}.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({'format': STATE_FORMAT, 'written': time.time(), 'reason': reason, 'sections': sections}, f,
+                      separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+        log.info('Wrote the warm restart state', extra={'reason': reason, 'sections': ','.join(sections)})
+        return list(sections)
+
+    def _load(self):
+        """
+        Reads and removes the state file, keeping its sections only when it is fresh.
+
+        :rtype: dict
+        """
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError):
+            log.exception('Ignoring an unreadable warm restart state')
+            state = None
+        finally:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+        if not isinstance(state, dict) or state.get('format') != STATE_FORMAT:
+            return {}
+        age = time.time() - state.get('written', 0)
+        if not self.max_age or not 0 <= age <= self.max_age:
+            log.info('Warm restart state is too old, starting cold', extra={'age_seconds': round(age, 1)})
+            return {}
+        sections = state.get('sections', {})
+        log.info('Restoring the warm restart state', extra={
+            'age_seconds': round(age, 1), 'reason': state.get('reason'), 'sections': ','.join(sections)
+        })
+        return sections
+
+    def take(self, section):
+        """
+        Hands back a section of the state written before the restart. Each section is only handed out once.
+
+        :param str section: The section name
+        :returns: The section, or None when there is nothing fresh to restore
+        """
+        if self._sections is None:
+            self._sections = self._load()
+        return self._sections.pop(section, None)
+
+
+warm_restart = WarmRestartState(get_warm_restart_path(), get_warm_restart_max_age())
@@ -0,0 +1,89 @@
+import asyncio
+from types import SimpleNamespace
+
+import discord
+from discord.state import ConnectionState
+
+from ptn.aco.commands import DiscordBotCommands as discord_bot_commands
+from ptn.aco.commands.DiscordBotCommands import DiscordBotCommands
+from ptn.aco.constants import bot_guild_id, get_member_role_id
+from ptn.aco.database.database import AffiliatorDatabase
+from ptn.aco.database.migrations import migrate
+from ptn.aco.database.writebehind import MemberTrackingWriter
+from ptn.aco.events import member_update_changes
+from ptn.aco.members import member_directory
+
+
+def _user(name, discriminator='0001', user_id=1001):
+    return {'id': str(user_id), 'username': name, 'discriminator': discriminator, 'avatar': None}
+
+
+def _guild(dispatched):
+    """
+    Builds a real discord.py guild with one member, fed through discord.py's own gateway parsing so the members behave
+    as they do in the bot, sharing their user between copies.
+    """
+    state = ConnectionState(
+        dispatch=lambda event, *args: dispatched.append((event, args)), handlers={}, hooks={}, syncer=None,
+        http=None, loop=None, intents=discord.Intents(guilds=True, members=True)
+    )
+    guild = discord.Guild(data={
+        'id': str(bot_guild_id()), 'name': 'PTN',
+        'roles': [{'id': str(get_member_role_id()), 'name': 'Member', 'permissions': '0'}],
+        'members': [{'user': _user('Jameson'), 'roles': [str(get_member_role_id())], 'nick': None}],
+    }, state=state)
+    state._guilds[guild.id] = guild
+    return state, guild
+
+
+def _tracked_before_member_ids(conn, username, date_epoch):
+    conn.execute("INSERT INTO membertracking(discord_username, username_key, date_epoch) VALUES(?, lower(?), ?)",
+                 (username, username, date_epoch))
+    conn.commit()
+
+
+def test_username_change_reindexes_the_member(tmp_path, monkeypatch):
+    db = AffiliatorDatabase(str(tmp_path / 'aco_applications.db'), readers=0)
+    db.run_sync(migrate)
+    db.run_sync(_tracked_before_member_ids, 'Jameson#0001', 1)
+    monkeypatch.setattr(discord_bot_commands, 'membertracking_writes', MemberTrackingWriter(db, 60, 100))
+
+    dispatched = []
+    state, guild = _guild(dispatched)
+    member_directory.build(guild)
+    assert member_directory.get_member_named('Jameson#0001') is not None
+
+    state.parse_guild_member_update({
+        'guild_id': str(guild.id), 'user': _user('Lave', '0002'), 'roles': [str(get_member_role_id())], 'nick': None
+    })
+    events = dict(dispatched)
+
+    # The member update cannot see the rename, the user is shared and already renamed
+    before, after = events['member_update']
+    assert before.name == after.name == 'Lave'
+    assert member_update_changes(before, after, guild.id, get_member_role_id()) == (False, False)
+
+    cog = DiscordBotCommands(SimpleNamespace(get_guild=lambda guild_id: guild if guild_id == guild.id else None))
+    asyncio.run(cog.on_user_update(*events['user_update']))
+
+    assert member_directory.get_member_named('Lave#0002').id == 1001
+    assert member_directory.get_member_named('Lave').id == 1001
+    assert member_directory.get_member_named('Jameson#0001') is None
+    assert member_directory.get_member_named('Jameson') is None
+
+    # The tracked row follows the rename and keeps its date
+    rows = db.run_sync(lambda conn: conn.execute(
+        "SELECT member_id, discord_username, username_key, date_epoch FROM membertracking"
+    ).fetchall())
+    assert [tuple(row) for row in rows] == [(1001, 'Lave#0002', 'lave#0002', 1)]
+
+
+def test_nickname_change_comes_through_the_member_update():
+    dispatched = []
+    state, guild = _guild(dispatched)
+    state.parse_guild_member_update({
+        'guild_id': str(guild.id), 'user': _user('Jameson'), 'roles': [str(get_member_role_id())], 'nick': 'Commander'
+    })
+    before, after = dict(dispatched)['member_update']
+    assert 'user_update' not in dict(dispatched)
+    assert member_update_changes(before, after, guild.id, get_member_role_id()) == (True, False)
@@ -0,0 +1,97 @@
+import calendar
+import sqlite3
+from datetime import datetime
+
+from ptn.aco.database.migrations import migrate, MIGRATIONS
+
+# The tables as the bot created them before the schema was versioned
+BASELINE_SCHEMA = '''
+    CREATE TABLE acoapplications(
+        entry INTEGER PRIMARY KEY AUTOINCREMENT,
+        discord_username TEXT NOT NULL,
+        ptn_nickname TEXT NOT NULL,
+        cmdr_name TEXT NOT NULL,
+        fleet_carrier_name TEXT NOT NULL,
+        fleet_carrier_id TEXT NOT NULL,
+        ack BOOLEAN,
+        user_claims_member BOOLEAN,
+        timestamp DATETIME,
+        UNIQUE (fleet_carrier_name, timestamp)
+    );
+    CREATE TABLE trackingforms(
+        entry INTEGER PRIMARY KEY AUTOINCREMENT,
+        worksheet_key TEXT UNIQUE,
+        worksheet_with_data_id INT
+    );
+    CREATE TABLE membertracking(
+        entry INTEGER PRIMARY KEY AUTOINCREMENT,
+        discord_username TEXT UNIQUE,
+        date DATETIME
+    );
+    INSERT INTO trackingforms VALUES(NULL, '1-AK8MeguKMOK4cifTntIVUVcbY9oQUIPhMMkrUmztwE', 0);
+    INSERT INTO acoapplications VALUES(
+        NULL, 'Jameson#0001', 'Jameson', 'Cmdr Jameson', 'Sidewinder', 'abc-12e ', 'Yes', 'Yes', '01/02/2021 10:00:00'
+    );
+    INSERT INTO acoapplications VALUES(
+        NULL, 'Lave#0002', 'Lave', 'Cmdr Lave', 'Cobra', 'XYZ-999', 'Yes', 'Yes', 'sometime last week'
+    );
+    INSERT INTO membertracking VALUES(NULL, 'Jameson#0001', '2021-01-01 09:30:00.123456');
+'''
+
+
+def _utc(*fields):
+    return calendar.timegm(datetime(*fields).timetuple())
+
+
+def _baseline(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / 'aco_applications.db'))
+    conn.row_factory = sqlite3.Row
+    conn.executescript(BASELINE_SCHEMA)
+    return conn
+
+
+def _columns(conn, table):
+    return [row['name'] for row in conn.execute(f"PRAGMA table_info({table})")]
+
+
+def test_baseline_database_is_upgraded_and_backfilled(tmp_path):
+    conn = _baseline(tmp_path)
+
+    assert migrate(conn) == len(MIGRATIONS)
+
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == len(MIGRATIONS)
+    applications = [tuple(row) for row in conn.execute(
+        "SELECT carrier_id_key, timestamp_epoch FROM acoapplications ORDER BY entry"
+    )]
+    # A timestamp that cannot be read is left without an epoch rather than failing the migration
+    assert applications == [('ABC-12E', _utc(2021, 1, 2, 10)), ('XYZ-999', None)]
+    tracked = conn.execute("SELECT username_key, date_epoch, member_id FROM membertracking").fetchone()
+    assert tuple(tracked) == ('jameson#0001', _utc(2021, 1, 1, 9, 30), None)
+    assert conn.execute("SELECT last_row_index FROM trackingforms").fetchone()[0] == 1
+    assert 'member_id' in _columns(conn, 'membertracking')
+    assert _columns(conn, 'notificationoutbox') and _columns(conn, 'quarantine')
+    indexes = {row['name'] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert {'acoapplications_carrier_id_epoch', 'membertracking_username_key', 'membertracking_member_id'} <= indexes
+
+
+def test_migrations_are_only_applied_once(tmp_path):
+    conn = _baseline(tmp_path)
+    migrate(conn)
+    conn.execute("UPDATE acoapplications SET carrier_id_key = 'CHANGED'")
+    conn.commit()
+
+    assert migrate(conn) == len(MIGRATIONS)
+    assert conn.execute("SELECT carrier_id_key FROM acoapplications WHERE entry = 1").fetchone()[0] == 'CHANGED'
+
+
+def test_database_restored_from_a_dump_is_migrated_again(tmp_path):
+    """
+    A dump carries the upgraded tables but not the user_version, so every migration runs again over them.
+    """
+    conn = _baseline(tmp_path)
+    migrate(conn)
+    conn.execute("PRAGMA user_version = 0")
+
+    assert migrate(conn) == len(MIGRATIONS)
+    assert conn.execute("SELECT count(*) FROM acoapplications").fetchone()[0] == 2
+    assert conn.execute("SELECT count(*) FROM trackingforms").fetchone()[0] == 1
@@ -0,0 +1,69 @@
+import calendar
+import time
+from datetime import datetime, timezone
+
+import pytest
+from dateutil import tz
+
+from ptn.aco.database.normalise import timestamp_epoch, carrier_id_key, username_key, _format_pattern
+
+FORM_FORMATS = ('%m/%d/%Y %H:%M:%S', '%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S')
+
+
+def _utc(*fields):
+    return calendar.timegm(datetime(*fields).timetuple())
+
+
+def test_form_timestamps_take_the_regex_path():
+    assert _format_pattern('%m/%d/%Y %H:%M:%S') is not None
+    assert timestamp_epoch('1/2/2021 10:00:00', FORM_FORMATS) == _utc(2021, 1, 2, 10)
+    # Any run of whitespace matches, as it does for strptime, and fractions of a second are dropped
+    assert timestamp_epoch(' 01/02/2021  10:00:00 ', FORM_FORMATS) == _utc(2021, 1, 2, 10)
+    assert timestamp_epoch('2021-01-02 10:00:00.999999', FORM_FORMATS) == _utc(2021, 1, 2, 10)
+
+
+def test_formats_with_names_go_through_strptime():
+    assert _format_pattern('%d %b %Y') is None
+    assert timestamp_epoch('02 Jan 2021', ('%d %b %Y',)) == _utc(2021, 1, 2)
+
+
+def test_anything_else_has_to_be_iso_8601():
+    assert timestamp_epoch('2021-01-02T10:00:00', ()) == _utc(2021, 1, 2, 10)
+    assert timestamp_epoch('2021-01-02 10:00:00+01:00', FORM_FORMATS) == _utc(2021, 1, 2, 9)
+    # Not read month or day first by guesswork
+    with pytest.raises(ValueError):
+        timestamp_epoch('02/01/2021 10:00', FORM_FORMATS)
+
+
+@pytest.mark.parametrize('text', ['not a date', '13/45/2021 10:00:00', '2021-02-30 10:00:00'])
+def test_unreadable_timestamps_are_refused(text):
+    with pytest.raises(ValueError):
+        timestamp_epoch(text, FORM_FORMATS)
+
+
+def test_blank_numbers_and_datetimes():
+    assert timestamp_epoch(None) is None
+    assert timestamp_epoch('') is None
+    assert timestamp_epoch(1612260000.7) == 1612260000
+    assert timestamp_epoch(datetime(2021, 1, 2, 10, tzinfo=timezone.utc)) == _utc(2021, 1, 2, 10)
+
+
+def test_configured_zone_is_used_rather_than_the_host_zone(monkeypatch):
+    london = tz.gettz('Europe/London')
+    expected = timestamp_epoch('07/01/2021 10:00:00', FORM_FORMATS, london)
+    assert expected == _utc(2021, 7, 1, 9)
+
+    monkeypatch.setenv('TZ', 'America/New_York')
+    time.tzset()
+    try:
+        assert timestamp_epoch('07/01/2021 10:00:00', FORM_FORMATS, london) == expected
+        assert timestamp_epoch(datetime(2021, 7, 1, 10), FORM_FORMATS) == _utc(2021, 7, 1, 10)
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+
+
+def test_lookup_keys():
+    assert carrier_id_key(' abc-12e ') == 'ABC-12E'
+    assert carrier_id_key(None) is None
+    assert username_key(' Jameson#0001 ') == 'jameson#0001'
@@ -0,0 +1,84 @@
+import asyncio
+
+import discord
+
+from ptn.aco.database.database import AffiliatorDatabase
+from ptn.aco.database.migrations import migrate
+from ptn.aco.outbox import NotificationOutbox, enqueue_notification
+
+
+class FakeMessage:
+
+    def __init__(self, message_id):
+        self.id = message_id
+
+
+class FakeChannel:
+
+    async def history(self, limit):
+        return
+        yield
+
+
+class FakeDispatcher:
+
+    def __init__(self, fail_posts=0):
+        self.headers = []
+        self.posted = []
+        self.fail_posts = fail_posts
+
+    async def send(self, channel, content=None, embed=None, reactions=()):
+        self.headers.append(content)
+
+    async def post_for_vote(self, channel, embeds, on_posted=None):
+        if self.fail_posts:
+            self.fail_posts -= 1
+            raise ConnectionError('discord is down')
+        for index, embed in enumerate(embeds):
+            self.posted.append(embed.title)
+            await on_posted(index, FakeMessage(len(self.posted)))
+
+
+async def _enqueue(db, key, title):
+    await db.transaction(enqueue_notification, key, discord.Embed(title=title))
+
+
+def _outbox(tmp_path, dispatcher):
+    db = AffiliatorDatabase(str(tmp_path / 'aco_applications.db'), readers=0)
+    db.run_sync(migrate)
+    return db, NotificationOutbox(db, FakeChannel, dispatcher, retry_base=0, retry_max=0)
+
+
+def test_header_counts_only_new_applications(tmp_path):
+    dispatcher = FakeDispatcher()
+    db, outbox = _outbox(tmp_path, dispatcher)
+
+    async def scenario():
+        await _enqueue(db, 'aco-application-1', 'Sidewinder')
+        await _enqueue(db, 'aco-quarantine-2', 'Held back')
+        assert await outbox.drain() == 2
+
+    asyncio.run(scenario())
+    assert dispatcher.headers == ['Priority transmission 1 application incoming.']
+    assert dispatcher.posted == ['Sidewinder', 'Held back']
+
+
+def test_quarantine_notices_and_retries_are_not_announced(tmp_path):
+    dispatcher = FakeDispatcher(fail_posts=1)
+    db, outbox = _outbox(tmp_path, dispatcher)
+
+    async def scenario():
+        await _enqueue(db, 'aco-application-1', 'Sidewinder')
+        try:
+            await outbox.drain()
+        except ConnectionError:
+            pass
+        assert dispatcher.headers == ['Priority transmission 1 application incoming.']
+        assert await outbox.drain() == 1
+
+        await _enqueue(db, 'aco-quarantine-2', 'Held back')
+        assert await outbox.drain() == 1
+
+    asyncio.run(scenario())
+    assert dispatcher.headers == ['Priority transmission 1 application incoming.']
+    assert dispatcher.posted == ['Sidewinder', 'Held back']
@@ -0,0 +1,74 @@
+import asyncio
+
+import pytest
+
+from ptn.aco.pipeline import Pipeline, Stage
+
+
+async def _numbers(count=None, stopped=None):
+    number = 0
+    try:
+        while count is None or number < count:
+            number += 1
+            await asyncio.sleep(0)
+            yield number
+    finally:
+        if stopped is not None:
+            stopped.append(number)
+
+
+def test_items_flow_through_the_stages_in_order():
+    """
+    Each stage sees the items in order, and returning None drops an item.
+    """
+    seen = []
+
+    async def odd_only(number):
+        return number if number % 2 else None
+
+    async def collect(number):
+        seen.append(number)
+        return number
+
+    pipeline = Pipeline('test', _numbers(5), [Stage('filter', odd_only), Stage('collect', collect)])
+    timings = asyncio.run(pipeline.run())
+
+    assert seen == [1, 3, 5]
+    assert timings['source']['items'] == 5
+    assert timings['filter']['items'] == 5
+    assert timings['collect']['items'] == 3
+
+
+def test_failing_stage_cancels_the_others():
+    """
+    The error from a failing stage is raised from run, and the source and the stages still busy are cancelled rather
+    than left running.
+    """
+    stopped = []
+    cancelled = []
+
+    async def fail_on_third(number):
+        if number == 3:
+            raise ValueError('bad row')
+        return number
+
+    async def slow_write(number):
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            cancelled.append(number)
+            raise
+        return number
+
+    # The source never ends, so the run only returns because the failure stopped it
+    pipeline = Pipeline('test', _numbers(stopped=stopped), [Stage('parse', fail_on_third), Stage('write', slow_write)])
+
+    async def scenario():
+        with pytest.raises(ValueError, match='bad row'):
+            await asyncio.wait_for(pipeline.run(), 5)
+        # Let the cancellations land, checked before asyncio.run cancels whatever is left over
+        await asyncio.sleep(0)
+        assert cancelled == [1]
+        assert len(stopped) == 1
+
+    asyncio.run(scenario())
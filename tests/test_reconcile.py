@@ -0,0 +1,83 @@
+import asyncio
+from datetime import datetime
+
+from ptn.aco.database.database import AffiliatorDatabase
+from ptn.aco.database.migrations import migrate
+from ptn.aco.reconcile import reconcile_members
+
+
+class Member:
+
+    def __init__(self, member_id, username):
+        self.id = member_id
+        self.username = username
+
+    def __str__(self):
+        return self.username
+
+
+def _database(tmp_path):
+    db = AffiliatorDatabase(str(tmp_path / 'aco_applications.db'), readers=0)
+    db.run_sync(migrate)
+    return db
+
+
+def _track(conn, rows):
+    conn.executemany(
+        "INSERT INTO membertracking(member_id, discord_username, username_key, date, date_epoch) "
+        "VALUES(?, ?, lower(?), ?, ?)",
+        [(member_id, username, username, datetime.fromtimestamp(epoch), epoch) for member_id, username, epoch in rows]
+    )
+    conn.commit()
+
+
+def _tracked(db):
+    return [tuple(row) for row in db.run_sync(lambda conn: conn.execute(
+        "SELECT member_id, discord_username, date_epoch FROM membertracking ORDER BY member_id IS NULL, member_id"
+    ).fetchall())]
+
+
+def test_startup_reconcile_only_adds_and_renames(tmp_path):
+    """
+    Holders who renamed while the bot was offline keep their tracking date, rows tracked before member IDs were stored
+    are claimed by username, and nobody is removed.
+    """
+    db = _database(tmp_path)
+    db.run_sync(_track, [(1, 'Jameson#0001', 100), (None, 'Lave#0002', 200), (3, 'Gone#0003', 300)])
+    holders = [Member(1, 'Jameson#0'), Member(2, 'Lave#0002'), Member(4, 'Sol#0004')]
+
+    report = asyncio.run(reconcile_members(db, holders))
+
+    assert report['added'] == ['Sol#0004']
+    assert report['renamed'] == [('Jameson#0001', 'Jameson#0')]
+    assert report['removed'] == []
+    tracked = _tracked(db)
+    assert tracked[:3] == [(1, 'Jameson#0', 100), (2, 'Lave#0002', 200), (3, 'Gone#0003', 300)]
+    assert tracked[3][:2] == (4, 'Sol#0004')
+
+
+def test_renamed_member_takes_a_stale_username(tmp_path):
+    """
+    A member renamed to a username still on the row of someone who renamed away from it. The stale row keeps its
+    member and date but loses the username.
+    """
+    db = _database(tmp_path)
+    db.run_sync(_track, [(1, 'Jameson#0001', 100), (2, 'Lave#0002', 200)])
+
+    report = asyncio.run(reconcile_members(db, [Member(1, 'Lave#0002'), Member(2, 'Jameson#0001')]))
+
+    assert sorted(report['renamed']) == [('Jameson#0001', 'Lave#0002'), ('Lave#0002', 'Jameson#0001')]
+    assert _tracked(db) == [(1, 'Lave#0002', 100), (2, 'Jameson#0001', 200)]
+
+
+def test_removals_only_on_request(tmp_path):
+    db = _database(tmp_path)
+    db.run_sync(_track, [(1, 'Jameson#0001', 100), (3, 'Gone#0003', 300), (None, 'Legacy#0005', 500)])
+    holders = [Member(1, 'Jameson#0001')]
+
+    report = asyncio.run(reconcile_members(db, holders, dry_run=True, remove=True))
+    assert report['removed'] == ['Gone#0003', 'Legacy#0005']
+    assert len(_tracked(db)) == 3
+
+    asyncio.run(reconcile_members(db, holders, remove=True))
+    assert _tracked(db) == [(1, 'Jameson#0001', 100)]
@@ -0,0 +1,120 @@
+import asyncio
+
+import pytest
+
+from benchmarks.fakes import FakeWorksheet
+from ptn.aco.database.database import AffiliatorDatabase
+from ptn.aco.database.migrations import migrate
+from ptn.aco.quarantine import list_quarantined
+from ptn.aco.scan import FormScan, fetch_watermark
+
+# The trackingforms entry the first migration creates
+FORM_ENTRY = 1
+
+
+def _row(timestamp, carrier_name, carrier_id, cmdr='Cmdr Jameson'):
+    return [timestamp, 'Yes', 'Jameson#0001', 'Jameson', cmdr, carrier_name, carrier_id, 'Yes']
+
+
+async def _eligible(user):
+    return {'member': True, 'eligible_for_aco': True, 'reason': ''}
+
+
+def _database(tmp_path):
+    db = AffiliatorDatabase(str(tmp_path / 'aco_applications.db'), readers=0)
+    db.run_sync(migrate)
+    return db
+
+
+def test_clashing_carrier_name_and_timestamp_is_quarantined(tmp_path):
+    """
+    A mod corrects a carrier ID typo in the form and rescans. The corrected row has the carrier name and timestamp of
+    the application already recorded, which the database refuses. Only that row is held back, the rest of the page is
+    recorded and the watermark moves on.
+    """
+    async def scenario():
+        db = _database(tmp_path)
+        sheet = FakeWorksheet([
+            _row('01/02/2021 10:00:00', 'Sidewinder', 'ABC-12E'),
+            _row('01/02/2021 11:00:00', 'Cobra', 'XYZ-999'),
+        ])
+        first = await FormScan(db, sheet, FORM_ENTRY, _eligible).run()
+        assert first['added_count'] == 2
+
+        sheet.rows[1][6] = 'ABC-123'
+        sheet.rows.append(_row('01/02/2021 12:00:00', 'Python', 'DEF-456'))
+        rescan = await FormScan(db, sheet, FORM_ENTRY, _eligible).run(full_rescan=True)
+        assert rescan['added_count'] == 1
+        assert rescan['quarantined_count'] == 1
+
+        quarantined = await db.read(list_quarantined, FORM_ENTRY)
+        assert [row['sheet_row'] for row in quarantined] == [2]
+        assert await db.read(fetch_watermark, FORM_ENTRY) == 4
+        recorded = await db.query("SELECT fleet_carrier_name FROM acoapplications ORDER BY entry")
+        assert [row[0] for row in recorded] == ['Sidewinder', 'Cobra', 'Python']
+        # Only the recorded applications are notified
+        notified = await db.query_one(
+            "SELECT count(*) FROM notificationoutbox WHERE idempotency_key LIKE 'aco-application-%'"
+        )
+        assert notified[0] == 3
+
+        # Later scans no longer trip over the row
+        later = await FormScan(db, sheet, FORM_ENTRY, _eligible).run()
+        assert later['added_count'] == 0
+        db.close()
+
+    asyncio.run(scenario())
+
+
+def test_clash_within_one_page_keeps_the_first_row(tmp_path):
+    async def scenario():
+        db = _database(tmp_path)
+        sheet = FakeWorksheet([
+            _row('01/02/2021 10:00:00', 'Sidewinder', 'ABC-123'),
+            _row('01/02/2021 10:00:00', 'Sidewinder', 'ABC-124'),
+            _row('01/02/2021 11:00:00', 'Cobra', 'XYZ-999'),
+        ])
+        result = await FormScan(db, sheet, FORM_ENTRY, _eligible).run()
+        assert result['added_count'] == 2
+        assert [row['sheet_row'] for row in await db.read(list_quarantined, FORM_ENTRY)] == [3]
+        assert await db.read(fetch_watermark, FORM_ENTRY) == 4
+        db.close()
+
+    asyncio.run(scenario())
+
+
+class FailingWorksheet(FakeWorksheet):
+
+    def __init__(self, rows, fail_from_row):
+        super().__init__(rows)
+        self.fail_from_row = fail_from_row
+        self.failing = False
+
+    async def get_values(self, range_name):
+        if self.failing and int(range_name.split(':')[0].lstrip('A')) >= self.fail_from_row:
+            # Long enough for the earlier pages to be written
+            await asyncio.sleep(0.2)
+            raise ConnectionError('google is down')
+        return await super().get_values(range_name)
+
+
+def test_failed_full_rescan_does_not_move_the_watermark_back(tmp_path):
+    async def scenario():
+        db = _database(tmp_path)
+        sheet = FailingWorksheet([
+            _row(f'01/02/2021 1{index}:00:00', f'Carrier {index}', f'ABC-12{index}') for index in range(6)
+        ], fail_from_row=4)
+        await FormScan(db, sheet, FORM_ENTRY, _eligible, page_size=2).run()
+        assert await db.read(fetch_watermark, FORM_ENTRY) == 7
+
+        # A row in the first page is now malformed, so that page is written before the second page fails
+        sheet.rows[1][6] = 'oops'
+        sheet.failing = True
+        with pytest.raises(ConnectionError):
+            await FormScan(db, sheet, FORM_ENTRY, _eligible, page_size=2).run(full_rescan=True)
+
+        assert [row['sheet_row'] for row in await db.read(list_quarantined, FORM_ENTRY)] == [2]
+        assert await db.read(fetch_watermark, FORM_ENTRY) == 7
+        db.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,133 @@
+import asyncio
+import gzip
+import hashlib
+import os
+import sqlite3
+
+from ptn.aco.database import snapshot as snapshot_module
+from ptn.aco.database.database import SnapshotWriter
+from ptn.aco.database.snapshot import take_snapshot, restore_latest_snapshot, list_snapshots, read_manifest, \
+    restore_sql_dump
+
+
+def _live_database(path, rows):
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS acoapplications(entry INTEGER PRIMARY KEY, cmdr_name TEXT)")
+    conn.executemany("INSERT INTO acoapplications(cmdr_name) VALUES(?)", [(cmdr,) for cmdr in rows])
+    conn.commit()
+    return conn
+
+
+def _restored(snapshot_dir, tmp_path):
+    conn = sqlite3.connect(str(tmp_path / 'restored.db'))
+    try:
+        snapshot = restore_latest_snapshot(conn, snapshot_dir)
+        return snapshot, [row[0] for row in conn.execute("SELECT cmdr_name FROM acoapplications ORDER BY entry")]
+    finally:
+        conn.close()
+
+
+def test_snapshot_is_written_with_its_manifest(tmp_path):
+    snapshot_dir = str(tmp_path / 'snapshots')
+    os.makedirs(snapshot_dir)
+    _live_database(str(tmp_path / 'live.db'), ['Jameson']).close()
+
+    path = take_snapshot(str(tmp_path / 'live.db'), snapshot_dir)
+
+    manifest = read_manifest(path)
+    with open(path, 'rb') as f:
+        assert manifest['sha256'] == hashlib.sha256(f.read()).hexdigest()
+    assert manifest['size'] == os.path.getsize(path)
+    assert manifest['snapshot'] == os.path.basename(path)
+    with gzip.open(path) as f:
+        assert f.read(16) == b'SQLite format 3\x00'
+    # Nothing half written is left behind
+    assert sorted(os.listdir(snapshot_dir)) == [os.path.basename(path), f'{os.path.basename(path)}.json']
+
+
+def test_only_the_newest_snapshots_are_kept(tmp_path):
+    snapshot_dir = str(tmp_path / 'snapshots')
+    os.makedirs(snapshot_dir)
+    _live_database(str(tmp_path / 'live.db'), ['Jameson']).close()
+
+    paths = [take_snapshot(str(tmp_path / 'live.db'), snapshot_dir, keep=2, compress=False) for _ in range(4)]
+
+    assert list_snapshots(snapshot_dir) == paths[:1:-1]
+    assert sorted(os.listdir(snapshot_dir)) == sorted(
+        name for path in paths[2:] for name in (os.path.basename(path), f'{os.path.basename(path)}.json')
+    )
+
+
+def test_snapshot_requests_are_coalesced(tmp_path):
+    snapshot_dir = str(tmp_path / 'snapshots')
+    os.makedirs(snapshot_dir)
+    _live_database(str(tmp_path / 'live.db'), ['Jameson']).close()
+    writer = SnapshotWriter(str(tmp_path / 'live.db'), snapshot_dir, keep=10, compress=False)
+
+    async def scenario():
+        # The first request starts a snapshot, the rest arrive while it is written and share one follow up
+        writer.request()
+        await asyncio.sleep(0)
+        for _ in range(4):
+            writer.request()
+        await writer.wait()
+
+    asyncio.run(scenario())
+    assert len(list_snapshots(snapshot_dir)) == 2
+
+
+def test_snapshot_round_trip(tmp_path):
+    snapshot_dir = str(tmp_path / 'snapshots')
+    os.makedirs(snapshot_dir)
+    live = _live_database(str(tmp_path / 'live.db'), ['Jameson', 'Lave'])
+    path = take_snapshot(str(tmp_path / 'live.db'), snapshot_dir)
+    live.close()
+
+    assert _restored(snapshot_dir, tmp_path) == (path, ['Jameson', 'Lave'])
+    # Only the snapshot and its manifest are left behind, no extracted copy or its -wal and -shm files
+    assert sorted(os.listdir(snapshot_dir)) == [os.path.basename(path), f'{os.path.basename(path)}.json']
+
+
+def test_checksum_mismatch_falls_back_to_an_older_snapshot(tmp_path):
+    snapshot_dir = str(tmp_path / 'snapshots')
+    os.makedirs(snapshot_dir)
+    live = _live_database(str(tmp_path / 'live.db'), ['Jameson'])
+    older = take_snapshot(str(tmp_path / 'live.db'), snapshot_dir, compress=False)
+    _live_database(str(tmp_path / 'live.db'), ['Lave']).close()
+    newer = take_snapshot(str(tmp_path / 'live.db'), snapshot_dir, compress=False)
+    live.close()
+    assert list_snapshots(snapshot_dir) == [newer, older]
+
+    # Same size, different bytes
+    with open(newer, 'r+b') as f:
+        f.seek(-1, os.SEEK_END)
+        last = f.read(1)
+        f.seek(-1, os.SEEK_END)
+        f.write(bytes([last[0] ^ 0xFF]))
+
+    assert _restored(snapshot_dir, tmp_path) == (older, ['Jameson'])
+    assert not [name for name in os.listdir(snapshot_dir) if name.startswith('.restore-')]
+
+
+def test_sql_dump_is_replayed_a_chunk_at_a_time(tmp_path, monkeypatch):
+    """
+    The old dumps were iterdump output written without line breaks. Statements, and semicolons inside values, are
+    split across the read chunks.
+    """
+    live = _live_database(str(tmp_path / 'live.db'), ['Jameson; the first', "O'Lave;", 'Sol'])
+    dump_path = str(tmp_path / 'aco_applications.sql')
+    with open(dump_path, 'w') as f:
+        f.write(''.join(live.iterdump()))
+    live.close()
+    monkeypatch.setattr(snapshot_module, 'CHUNK_SIZE', 16)
+
+    conn = sqlite3.connect(str(tmp_path / 'restored.db'))
+    count = restore_sql_dump(conn, dump_path)
+
+    assert count == 6
+    assert [row[0] for row in conn.execute("SELECT cmdr_name FROM acoapplications ORDER BY entry")] == [
+        'Jameson; the first', "O'Lave;", 'Sol'
+    ]
+    assert not conn.in_transaction
+    conn.close()
@@ -0,0 +1,35 @@
+import pytest
+
+from ptn.aco.UserData import UserData, sheet_columns
+
+HEADERS = ['Timestamp', 'Member', 'Discord Username', 'P.T.N. Discord Nickname', 'CMDR Name', 'Carrier Name',
+           'Carrier ID', 'Good Conduct']
+
+
+def test_sheet_row_is_read_by_header():
+    # Columns in a different order, with a question the bot does not use
+    headers = ['Carrier ID', 'Extra'] + [header for header in HEADERS if header != 'Carrier ID']
+    row = ['abc-12e', 'ignored', '01/02/2021 10:00:00', 'Yes', ' Jameson#0001 ', 'Jameson', 'Cmdr Jameson',
+           'Sidewinder', 'Yes']
+
+    user = UserData.from_sheet_row(row, sheet_columns(headers))
+
+    assert user.discord_username == 'Jameson#0001'
+    assert user.fleet_carrier_id == 'ABC-12E'
+    assert user.fleet_carrier_name == 'Sidewinder'
+    assert user.timestamp == '01/02/2021 10:00:00'
+    assert user.missing_fields() == []
+
+
+def test_short_row_and_missing_question_are_left_blank():
+    headers = [header for header in HEADERS if header != 'CMDR Name']
+    user = UserData.from_sheet_row(['01/02/2021 10:00:00', 'Yes', 'Jameson#0001'], sheet_columns(headers))
+
+    assert user.discord_username == 'Jameson#0001'
+    assert user.missing_fields() == ['P.T.N. Discord Nickname', 'CMDR Name', 'Carrier Name', 'Carrier ID']
+
+
+def test_malformed_carrier_id_is_refused():
+    row = ['01/02/2021 10:00:00', 'Yes', 'Jameson#0001', 'Jameson', 'Cmdr Jameson', 'Sidewinder', 'AB-12', 'Yes']
+    with pytest.raises(ValueError, match='Incompatible carrier ID'):
+        UserData.from_sheet_row(row, sheet_columns(HEADERS))
@@ -0,0 +1,102 @@
+import asyncio
+from datetime import datetime, timezone
+
+import pytest
+
+from ptn.aco.database.database import AffiliatorDatabase
+from ptn.aco.database.migrations import migrate
+from ptn.aco.database.writebehind import MemberTrackingWriter
+
+JOINED = datetime(2026, 1, 1, tzinfo=timezone.utc)
+REJOINED = datetime(2026, 2, 1, tzinfo=timezone.utc)
+
+
+def _writer(tmp_path):
+    db = AffiliatorDatabase(str(tmp_path / 'aco_applications.db'), readers=0)
+    db.run_sync(migrate)
+    # Long enough that nothing is written until the test flushes
+    return MemberTrackingWriter(db, 60, 100)
+
+
+def _track(conn, member_id, username, date):
+    conn.execute(
+        "INSERT INTO membertracking(member_id, discord_username, username_key, date_epoch) VALUES(?, ?, lower(?), ?)",
+        (member_id, username, username, int(date.timestamp()))
+    )
+    conn.commit()
+
+
+def _tracked(db):
+    return [tuple(row) for row in db.run_sync(lambda conn: conn.execute(
+        "SELECT member_id, discord_username, date_epoch FROM membertracking ORDER BY member_id"
+    ).fetchall())]
+
+
+def test_changes_are_coalesced_per_member(tmp_path):
+    """
+    A member who lost and regained the role before the write is tracked again from when they regained it, and one
+    who gained and lost it is not tracked at all.
+    """
+    writer = _writer(tmp_path)
+    writer.db.run_sync(_track, 1, 'Jameson#0001', JOINED)
+
+    async def scenario():
+        writer.add(1, 'Jameson#0001', JOINED)
+        writer.remove(1, 'Jameson#0001')
+        writer.add(1, 'Jameson#0001', REJOINED)
+        writer.add(2, 'Lave#0002', JOINED)
+        writer.remove(2, 'Lave#0002')
+        assert len(writer) == 2
+        return await writer.flush()
+
+    assert asyncio.run(scenario()) == 2
+    assert len(writer) == 0
+    assert _tracked(writer.db) == [(1, 'Jameson#0001', int(REJOINED.timestamp()))]
+
+
+def test_failed_write_is_retried_under_newer_changes(tmp_path, monkeypatch):
+    """
+    A batch that fails to write is put back, and a change made while it was being written wins over it.
+    """
+    writer = _writer(tmp_path)
+    transaction = writer.db.transaction
+
+    async def failing_transaction(*args):
+        monkeypatch.setattr(writer.db, 'transaction', transaction)
+        writer.remove(2, 'Lave#0002')
+        raise ConnectionError('disk went away')
+
+    async def scenario():
+        writer.add(1, 'Jameson#0001', JOINED)
+        writer.add(2, 'Lave#0002', JOINED)
+        monkeypatch.setattr(writer.db, 'transaction', failing_transaction)
+        with pytest.raises(ConnectionError):
+            await writer.flush()
+        assert len(writer) == 2
+        return await writer.flush()
+
+    assert asyncio.run(scenario()) == 2
+    assert _tracked(writer.db) == [(1, 'Jameson#0001', int(JOINED.timestamp()))]
+
+
+def test_pending_changes_survive_a_restart(tmp_path):
+    """
+    Changes exported before a restart are restored under those made since, and written by the next flush.
+    """
+    before = _writer(tmp_path)
+
+    async def export():
+        before.add(1, 'Jameson#0001', JOINED)
+        before.add(2, 'Lave#0002', JOINED)
+        return before.export_pending()
+
+    pending = asyncio.run(export())
+    after = MemberTrackingWriter(before.db, 60, 100)
+
+    async def restore():
+        after.remove(2, 'Lave#0002')
+        after.restore_pending(pending)
+        return await after.flush()
+
+    assert asyncio.run(restore()) == 2
+    assert _tracked(after.db) == [(1, 'Jameson#0001', int(JOINED.timestamp()))]